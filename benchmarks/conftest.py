@@ -0,0 +1,111 @@
+"""
+Fixtures of the benchmark suite: synthetic images of several sizes and a
+`measure` fixture recording the time (pytest-benchmark) and the peak
+memory (tracemalloc, which sees the numpy allocations) of a call.
+"""
+
+import tracemalloc
+
+import numpy as np
+import pytest
+
+# shapes of the synthetic 3D images (z, y, x)
+SIZES = {
+    "small": (32, 128, 128),
+    "medium": (64, 256, 256),
+    "large": (128, 512, 512),
+}
+
+# 4D movies are smaller, their frames are processed one by one
+MOVIE_SIZES = {
+    "small": (5, 32, 128, 128),
+    "medium": (10, 64, 256, 256),
+}
+
+# side of the cells of the synthetic labels
+CELL_SIZE = 8
+
+
+def synthetic_labels(shape, n_labels=1000, seed=0):
+    """
+    uint16 labels image made of cubic cells of random labels (0 being
+    the background), like a segmentation of densely packed objects
+    """
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(
+        0, n_labels + 1, [-(-n // CELL_SIZE) for n in shape], dtype=np.uint16
+    )
+    labels = coarse
+    for axis in range(len(shape)):
+        labels = np.repeat(labels, CELL_SIZE, axis=axis)
+    return np.ascontiguousarray(labels[tuple(slice(n) for n in shape)])
+
+
+def synthetic_intensity(shape, seed=0):
+    """uint16 intensity image of bright cells on a noisy background"""
+    rng = np.random.default_rng(seed)
+    foreground = synthetic_labels(shape, n_labels=1, seed=seed)
+    noise = rng.normal(100, 20, shape)
+    return np.clip(noise + 400 * foreground, 0, 2**16 - 1).astype(np.uint16)
+
+
+def _movie(shape, synthetic):
+    return np.stack([synthetic(shape[1:], seed=t) for t in range(shape[0])])
+
+
+@pytest.fixture(scope="session", params=list(SIZES))
+def labels_3d(request):
+    return synthetic_labels(SIZES[request.param])
+
+
+@pytest.fixture(scope="session", params=list(MOVIE_SIZES))
+def labels_4d(request):
+    return _movie(MOVIE_SIZES[request.param], synthetic_labels)
+
+
+@pytest.fixture(scope="session", params=list(SIZES))
+def intensity_3d(request):
+    return synthetic_intensity(SIZES[request.param])
+
+
+@pytest.fixture(scope="session", params=list(MOVIE_SIZES))
+def intensity_4d(request):
+    return _movie(MOVIE_SIZES[request.param], synthetic_intensity)
+
+
+def peak_memory(function, *args, **kwargs):
+    """Result of `function(*args, **kwargs)` and its peak memory in bytes"""
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+@pytest.fixture
+def measure(benchmark):
+    """
+    Time `function(*args, **kwargs)` with pytest-benchmark and store its
+    peak memory (MiB) in the `extra_info` of the benchmark. `setup` is
+    called before every round to give fresh arguments (e.g. a copy of an
+    image edited in place) and must return `(args, kwargs)`.
+    """
+
+    def run(function, *args, setup=None, rounds=3, **kwargs):
+        if setup is not None:
+            args, kwargs = setup()
+        result, peak = peak_memory(function, *args, **kwargs)
+        benchmark.extra_info["peak_memory_mib"] = round(peak / 2**20, 2)
+        if setup is None:
+            benchmark.pedantic(
+                function, args, kwargs, rounds=rounds, iterations=1
+            )
+        else:
+            benchmark.pedantic(
+                function, setup=setup, rounds=rounds, iterations=1
+            )
+        return result
+
+    return run
@@ -0,0 +1,63 @@
+"""
+Hot paths of the label widgets: CountLabels, ListLabels,
+MeasureLabelVolume and ChangeLabel, through the functions they run in
+their background workers.
+"""
+
+import numpy as np
+
+from image_manipulation_plugin.label_editing import (
+    relabel,
+    remap_labels,
+    sequential_mapping,
+)
+from image_manipulation_plugin.label_statistics import (
+    label_statistics,
+    label_table,
+    timepoint_statistics,
+)
+from image_manipulation_plugin.processing import volume_table
+
+
+def test_count_and_list_labels_3d(measure, labels_3d):
+    # CountLabels, ListLabels and MeasureLabelVolume share the statistics
+    statistics = measure(label_statistics, labels_3d)
+    assert len(statistics) > 1
+
+
+def test_count_and_list_labels_4d(measure, labels_4d):
+    statistics = measure(timepoint_statistics, labels_4d)
+    assert len(statistics) == labels_4d.shape[0]
+
+
+def test_list_labels_table_4d(measure, labels_4d):
+    # the rows of the ListLabels table, from the cached statistics
+    statistics = timepoint_statistics(labels_4d)
+    table = measure(label_table, statistics)
+    assert len(table["label"]) > 1
+
+
+def test_measure_volume_table_4d(measure, labels_4d):
+    labels, volumes = measure(volume_table, labels_4d)
+    assert volumes.shape == (len(labels), labels_4d.shape[0])
+
+
+def test_change_label_in_place(measure, labels_3d):
+    statistics = label_statistics(labels_3d)
+    label = int(statistics.labels[len(statistics) // 2])
+    boxes = [statistics.bbox(label)]
+
+    def setup():
+        # every round changes a fresh copy
+        return (labels_3d.copy(), label, 0, boxes), {}
+
+    n_changed = measure(relabel, setup=setup)
+    assert n_changed == statistics.count(label)
+
+
+def test_change_labels_with_mapping(measure, labels_3d):
+    mapping = sequential_mapping(labels_3d[::4, ::4, ::4])
+    mapping = {old: new + 5000 for old, new in mapping.items()}
+    out = measure(remap_labels, labels_3d, mapping)
+    assert out.shape == labels_3d.shape
+    assert not np.shares_memory(out, labels_3d)
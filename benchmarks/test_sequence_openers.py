@@ -0,0 +1,69 @@
+"""
+Hot paths of OpenTIFSequence and OpenMHASequence: eager loading, lazy
+loading with all frames read once, and the multiscale pyramid.
+"""
+
+import numpy as np
+import pytest
+from conftest import MOVIE_SIZES, synthetic_intensity
+
+from image_manipulation_plugin.generators import exhaust
+from image_manipulation_plugin.pyramids import iter_pyramid
+from image_manipulation_plugin.sequence_io import open_sequence
+
+
+def _write_sequence(folder, shape, extension):
+    for t in range(shape[0]):
+        frame = synthetic_intensity(shape[1:], seed=t)
+        path = str(folder / f"frame_{t:03d}{extension}")
+        if extension == ".tif":
+            import tifffile
+
+            tifffile.imwrite(path, frame)
+        else:
+            from medpy.io import save
+
+            # medpy stores (x, y, z)
+            save(np.transpose(frame), path)
+    return str(folder / f"frame_000{extension}")
+
+
+@pytest.fixture(
+    scope="session",
+    params=[
+        (size, extension)
+        for size in MOVIE_SIZES
+        for extension in (".tif", ".mha")
+    ],
+    ids=lambda param: f"{param[0]}{param[1]}",
+)
+def sequence(request, tmp_path_factory):
+    size, extension = request.param
+    folder = tmp_path_factory.mktemp(f"{size}_{extension[1:]}")
+    return _write_sequence(folder, MOVIE_SIZES[size], extension), size
+
+
+def test_open_sequence(measure, sequence):
+    path, size = sequence
+    movie = measure(open_sequence, path)
+    assert movie.shape == MOVIE_SIZES[size]
+
+
+def _read_all_frames(path):
+    movie = open_sequence(path, lazy=True)
+    return [movie[t] for t in range(len(movie))]
+
+
+def test_open_sequence_lazily(measure, sequence):
+    path, size = sequence
+    frames = measure(_read_all_frames, path)
+    assert len(frames) == MOVIE_SIZES[size][0]
+
+
+def _pyramid(image):
+    return exhaust(iter_pyramid(image, min_size=64))
+
+
+def test_multiscale_pyramid(measure, intensity_4d):
+    levels = measure(_pyramid, intensity_4d)
+    assert levels[0] is intensity_4d
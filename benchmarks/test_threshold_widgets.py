@@ -0,0 +1,44 @@
+"""
+Hot paths of the thresholding widgets: ThresholdLabels,
+ApplyThresholdOfChoice and ManualThresholding.
+"""
+
+from image_manipulation_plugin.connected_components import label_components
+from image_manipulation_plugin.intensity_histograms import (
+    all_thresholds,
+    intensity_histogram,
+)
+from image_manipulation_plugin.processing import segment
+from image_manipulation_plugin.thresholding import threshold_image
+
+
+def test_intensity_histogram(measure, intensity_3d):
+    histogram = measure(intensity_histogram, intensity_3d)
+    assert histogram.size == intensity_3d.size
+
+
+def test_all_thresholds(measure, intensity_3d):
+    # ThresholdLabels compares all methods on the same histogram
+    histogram = intensity_histogram(intensity_3d)
+    thresholds = measure(all_thresholds, histogram)
+    assert thresholds["Otsu"] is not None
+
+
+def test_apply_threshold_of_choice(measure, intensity_3d):
+    threshold, binary = measure(segment, intensity_3d, "Otsu")
+    assert binary.shape == intensity_3d.shape
+
+
+def test_manual_threshold(measure, intensity_3d):
+    binary = measure(threshold_image, intensity_3d, 300)
+    assert binary.dtype.itemsize == 1
+
+
+def test_connected_components_3d(measure, intensity_3d):
+    labels = measure(label_components, intensity_3d, threshold=300)
+    assert labels.max() > 0
+
+
+def test_threshold_into_components_4d(measure, intensity_4d):
+    threshold, labels = measure(segment, intensity_4d, "Otsu", min_size=10)
+    assert labels.shape == intensity_4d.shape
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from image_manipulation_plugin.connected_components import (
+    label_components,
+    slab_chunks,
+)
+from image_manipulation_plugin.label_dtypes import compact_dtype
+from image_manipulation_plugin.profiling import Profiler
+
+
+def _same_partition(labels, expected):
+    """Whether two labels images have the same components, up to the IDs"""
+    pairs = np.unique(np.stack([labels.ravel(), expected.ravel()]), axis=1)
+    return (
+        len(pairs[0]) == len(np.unique(labels))
+        and len(pairs[1]) == len(np.unique(expected))
+        and np.array_equal(labels == 0, expected == 0)
+    )
+
+
+def test_label_components_matches_scipy():
+    rng = np.random.default_rng(0)
+    image = rng.random((20, 16, 16))
+    for connectivity in (1, 2, 3):
+        structure = ndimage.generate_binary_structure(3, connectivity)
+        expected, n = ndimage.label(image > 0.6, structure)
+        # slabs of 2 planes, merged across 9 boundaries
+        labels = label_components(
+            image,
+            threshold=0.6,
+            connectivity=connectivity,
+            chunk_size=2 * 16 * 16,
+            max_workers=2,
+        )
+        assert labels.dtype == compact_dtype(n)
+        assert labels.max() == n
+        assert _same_partition(labels, expected)
+
+
+def test_label_components_min_size():
+    image = np.zeros((10, 10), dtype=np.uint8)
+    image[0:4, 0:4] = 1  # 16 voxels across two slabs
+    image[8, 8] = 1  # 1 voxel
+    labels = label_components(image, min_size=2, chunk_size=20)
+    assert labels.max() == 1
+    assert np.count_nonzero(labels) == 16
+
+
+def test_label_components_per_timepoint():
+    image = np.ones((3, 4, 5, 5), dtype=np.uint8)
+    labels = label_components(image, chunk_size=25)
+    # components never connect across timepoints
+    for t in range(3):
+        assert len(np.unique(labels[t])) == 1
+    assert sorted(np.unique(labels)) == [1, 2, 3]
+
+
+def test_label_components_to_zarr(tmp_path):
+    # one chunk per slab, never shared by two timepoints
+    assert slab_chunks((8, 6, 16, 16), True, 2 * 16 * 16) == (1, 2, 16, 16)
+    assert slab_chunks((6, 16, 16), False, 2 * 16 * 16) == (2, 16, 16)
+    pytest.importorskip("zarr")
+    rng = np.random.default_rng(1)
+    # small frames, slabs of 2 planes: 4 timepoints would fit one block
+    image = rng.random((8, 6, 16, 16)) > 0.6
+    expected = label_components(image, chunk_size=2 * 16 * 16)
+    labels = label_components(
+        image,
+        path=tmp_path / "labels.zarr",
+        chunk_size=2 * 16 * 16,
+        max_workers=4,
+    )
+    assert labels.chunks == (1, 2, 16, 16)
+    assert np.array_equal(labels[:], expected)
+
+
+def test_label_components_peak_memory():
+    image = np.zeros((64, 128, 128), dtype=bool)
+    for i in range(4):
+        image[i * 16 : i * 16 + 10, 20:100, i * 30 : i * 30 + 20] = True
+    profiler = Profiler()
+    profiler.enable(trace_memory=True)
+    try:
+        labels = profiler.wrap(label_components)(
+            image, chunk_size=4 * 128 * 128, max_workers=2
+        )
+    finally:
+        profiler.disable()
+    assert labels.dtype == np.uint8 and labels.max() == 4
+    # compact provisional slabs and the uint8 output, no uint32 image
+    assert profiler.records[-1]["peak_memory"] < 3 * image.size
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from skimage import filters
+
+from image_manipulation_plugin import intensity_histograms
+from image_manipulation_plugin.intensity_histograms import (
+    all_thresholds,
+    THRESHOLD_METHODS,
+    histogram_cache,
+    intensity_histogram,
+    threshold_from_histogram,
+    threshold_li,
+)
+
+SKIMAGE_METHODS = {
+    method: getattr(filters, f"threshold_{method.lower()}")
+    for method in THRESHOLD_METHODS
+}
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int32, np.float32])
+def test_thresholds_match_skimage(dtype):
+    rng = np.random.default_rng(0)
+    image = rng.gamma(2, 30, (3, 10, 20, 20)).astype(dtype)
+    histogram = intensity_histogram(image)
+    for method, function in SKIMAGE_METHODS.items():
+        expected = function(image)
+        # Li of float images is refined on the image itself
+        result = threshold_from_histogram(histogram, method, image)
+        assert abs(result - expected) <= 1e-5 * abs(expected), method
+    if dtype == np.float32:
+        # iterated on the histogram only, up to half a bin
+        result = threshold_from_histogram(histogram, "Li")
+        assert abs(result - filters.threshold_li(image)) <= (
+            histogram.bin_width / 2
+        )
+
+
+def test_li_of_bimodal_float_image(monkeypatch):
+    rng = np.random.default_rng(3)
+    image = np.concatenate(
+        [rng.normal(2000, 300, 50000), rng.normal(12000, 1500, 20000)]
+    ).astype(np.float32)
+    image = image.reshape(70, 10, 100)
+    expected = filters.threshold_li(image)
+    histogram = intensity_histogram(image)
+    assert abs(threshold_from_histogram(histogram, "Li") - expected) > 1
+    # one pass per iteration, over chunks of a few planes
+    monkeypatch.setattr(intensity_histograms, "CHUNK_SIZE", 3000)
+    assert np.isclose(threshold_li(image, histogram), expected, rtol=1e-5)
+
+
+def test_cache_reuses_histograms_of_timepoints():
+    from napari.layers import Image
+
+    rng = np.random.default_rng(1)
+    data = rng.random((3, 5, 10, 10)).astype(np.float32)
+    layer = Image(data)
+    cache = histogram_cache(layer)
+    assert len(list(cache.compute())) == cache.n_steps() == 6
+
+    histograms = dict(cache._histograms)
+    for method in ["Otsu", "Yen", "Isodata", "Mean"]:
+        expected = SKIMAGE_METHODS[method](data)
+        assert np.isclose(cache.threshold(method), expected)
+    assert np.isclose(
+        cache.threshold("Otsu", 1), filters.threshold_otsu(data[1])
+    )
+    # thresholds of the whole movie did not scan the image again
+    assert all(cache._histograms[key] is h for key, h in histograms.items())
+
+    assert cache.range()[1] == data.max()
+    median = cache.quantile(0.5)
+    assert abs(median - np.median(data)) <= cache.histogram().bin_width
+
+    layer.data = data[:2]
+    assert not cache._histograms
+
+
+def test_all_thresholds_computed_concurrently():
+    image = np.zeros((10, 10), dtype=np.uint8)
+    image[:, 5:] = 200
+    histogram = intensity_histogram(image)
+    thresholds = all_thresholds(histogram, max_workers=3)
+    assert list(thresholds) == sorted(THRESHOLD_METHODS)
+    assert thresholds["Otsu"] == filters.threshold_otsu(image)
+    # a histogram with two values has no minimum between two maxima
+    assert thresholds["Minimum"] is None
@@ -0,0 +1,115 @@
+import numpy as np
+from napari.components import ViewerModel
+from qtpy.QtWidgets import QPushButton
+
+from image_manipulation_plugin.label_creation import (
+    ApplyThresholdOfChoice,
+    ManualThresholding,
+)
+
+
+def _click(widget, text):
+    (button,) = [
+        button
+        for button in widget.findChildren(QPushButton)
+        if button.text() == text
+    ]
+    button.click()
+
+
+def _blobs(shape=(6, 20, 20)):
+    """Dark image with a large and a small bright blob"""
+    image = np.full(shape, 10, dtype=np.uint16)
+    image[..., 1:4, 2:10, 2:10] = 200
+    image[..., 4, 15, 15] = 200
+    return image
+
+
+def _widget(qtbot, widget_class, image):
+    viewer = ViewerModel()
+    viewer.add_image(image, name="image")
+    widget = widget_class(viewer)
+    qtbot.addWidget(widget)
+    return widget
+
+
+def test_apply_threshold_of_choice(qtbot):
+    image = _blobs()
+    widget = _widget(qtbot, ApplyThresholdOfChoice, image)
+    widget.threshold.value = "Otsu"
+
+    _click(widget, "threshold image")
+    qtbot.waitUntil(lambda: "Labels" in widget.viewer.layers)
+    assert widget.output_str.value.startswith(
+        "Labels created using Otsu threshold at"
+    )
+    labels = widget.viewer.layers["Labels"]
+    np.testing.assert_array_equal(labels.data, image > 100)
+
+
+def test_apply_threshold_of_choice_components(qtbot):
+    image = _blobs()
+    widget = _widget(qtbot, ApplyThresholdOfChoice, image)
+    widget.components.value = True
+    widget.min_size.value = 2
+
+    _click(widget, "threshold image")
+    qtbot.waitUntil(lambda: "Labels" in widget.viewer.layers)
+    # the single bright voxel is too small to be a component
+    expected = np.zeros(image.shape, dtype=np.uint8)
+    expected[1:4, 2:10, 2:10] = 1
+    np.testing.assert_array_equal(
+        widget.viewer.layers["Labels"].data, expected
+    )
+
+
+def test_apply_threshold_of_choice_per_timepoint(qtbot):
+    image = _blobs((3, 6, 20, 20))
+    # the illumination drifts over time
+    image = image * np.array([1, 2, 4], dtype=np.uint16)[:, None, None, None]
+    widget = _widget(qtbot, ApplyThresholdOfChoice, image)
+    widget.per_timepoint.value = True
+
+    _click(widget, "threshold image")
+    qtbot.waitUntil(lambda: "Labels" in widget.viewer.layers)
+    assert "thresholds of each time frame" in widget.output_str.value
+    np.testing.assert_array_equal(
+        widget.viewer.layers["Labels"].data, _blobs((3, 6, 20, 20)) > 100
+    )
+
+
+def test_manual_thresholding(qtbot):
+    image = _blobs()
+    widget = _widget(qtbot, ManualThresholding, image)
+    widget.btn.value = 20
+    widget.check.value = True
+
+    _click(widget, "threshold image")
+    qtbot.waitUntil(lambda: "Labels_20%_inverted" in widget.viewer.layers)
+    assert widget.message.value == (
+        "Thresholding at 40.00 (20 % of max intensity)"
+    )
+    np.testing.assert_array_equal(
+        widget.viewer.layers["Labels_20%_inverted"].data, image < 40
+    )
+
+
+def test_manual_thresholding_live_preview(qtbot):
+    image = _blobs()
+    widget = _widget(qtbot, ManualThresholding, image)
+    widget.live.value = True
+    widget.btn.value = 20
+    widget.btn.value = 60
+
+    # the preview is only computed once the slider stops moving
+    qtbot.waitUntil(lambda: widget.message.value == "Preview at 120.00")
+    preview = widget.viewer.layers["Threshold preview"]
+    current = widget.viewer.dims.current_step[0]
+    np.testing.assert_array_equal(
+        preview.data, image[current : current + 1] > 120
+    )
+    # the source layer stays selected
+    assert widget.viewer.layers.selection.active.name == "image"
+
+    widget.live.value = False
+    assert "Threshold preview" not in widget.viewer.layers
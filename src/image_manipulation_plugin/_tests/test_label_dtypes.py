@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from image_manipulation_plugin.label_dtypes import (
+    compact_dtype,
+    compact_labels,
+    parse_dtype,
+)
+
+
+def test_compact_dtype():
+    assert compact_dtype(0) == np.uint8
+    assert compact_dtype(255) == np.uint8
+    assert compact_dtype(256) == np.uint16
+    assert compact_dtype(2**16) == np.uint32
+    assert compact_dtype(2**32) == np.uint64
+    assert compact_dtype(5, -1) == np.int8
+
+
+def test_compact_labels():
+    image = np.arange(300, dtype=np.int64).reshape(3, 100)
+    labels = compact_labels(image)
+    assert labels.dtype == np.uint16
+    np.testing.assert_array_equal(labels, image)
+    assert compact_labels(labels) is labels
+
+    floats = np.array([[0.0, 2.7]])
+    np.testing.assert_array_equal(compact_labels(floats), [[0, 2]])
+    assert compact_labels(floats, parse_dtype("uint32")).dtype == np.uint32
+    assert parse_dtype("auto") is None
+    with pytest.raises(ValueError):
+        compact_labels(image, np.uint8)
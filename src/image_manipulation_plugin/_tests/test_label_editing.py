@@ -0,0 +1,176 @@
+import numpy as np
+import pytest
+
+from image_manipulation_plugin import label_editing
+from image_manipulation_plugin.label_editing import (
+    EditHistory,
+    EditRecord,
+    parse_mapping,
+    relabel,
+    remap_labels,
+    sequential_mapping,
+)
+from image_manipulation_plugin.label_statistics import label_statistics
+
+
+def test_relabel_inside_bounding_box(monkeypatch):
+    # small chunks so that the box is split into several blocks
+    monkeypatch.setattr(label_editing, "CHUNK_SIZE", 10)
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 5, (8, 9, 10))
+    expected = image.copy()
+    expected[expected == 3] = 7
+
+    box = label_statistics(image).bbox(3)
+    assert relabel(image, 3, 7, [box]) == np.count_nonzero(expected == 7)
+    np.testing.assert_array_equal(image, expected)
+
+    # a new label beyond the dtype never wraps nor half-changes the image
+    labels = image.astype(np.uint8)
+    with pytest.raises(ValueError, match="do not fit in uint8"):
+        relabel(labels, 7, 300, [box])
+    np.testing.assert_array_equal(labels, expected)
+
+
+@pytest.mark.parametrize("lut_limit", [2**24, 0])
+def test_remap_labels_single_pass(monkeypatch, lut_limit):
+    # lut_limit=0 forces the sparse (binary search) path
+    monkeypatch.setattr(label_editing, "LUT_LIMIT", lut_limit)
+    image = np.array([[0, 1, 2], [3, 2, 1]], dtype=np.uint8)
+    swapped = remap_labels(image, {1: 2, 2: 1, 9: 4})
+    np.testing.assert_array_equal(swapped, [[0, 2, 1], [3, 1, 2]])
+
+    remap_labels(image, {3: 1}, out=image)
+    np.testing.assert_array_equal(image, [[0, 1, 2], [1, 2, 1]])
+    with pytest.raises(ValueError):
+        remap_labels(image, {1: 300}, out=image)
+    assert remap_labels(image, {1: 300}).dtype == np.uint16
+
+
+def test_parse_and_sequential_mapping():
+    text = "old,new\n1,2\n3 -> 4\n# comment\n\n5\t6"
+    assert parse_mapping(text) == {1: 2, 3: 4, 5: 6}
+    with pytest.raises(ValueError):
+        parse_mapping("1 2\n3")
+    assert sequential_mapping([0, 9, 4, 4, 12]) == {4: 1, 9: 2, 12: 3}
+
+
+def test_edit_history_undo_redo(monkeypatch):
+    monkeypatch.setattr(label_editing, "CHUNK_SIZE", 10)
+    rng = np.random.default_rng(1)
+    original = rng.integers(0, 4, (6, 7, 8)).astype(np.uint8)
+    image = original.copy()
+    history = EditHistory()
+
+    record = EditRecord("relabel")
+    relabel(image, 2, 9, [(slice(1, 5),)], record=record)
+    history.push(record)
+    relabeled = image.copy()
+    record = EditRecord("remap")
+    remap_labels(image, {1: 3, 3: 1}, out=image, record=record)
+    history.push(record)
+    remapped = image.copy()
+
+    # only the changed voxels are stored
+    assert len(record) == np.count_nonzero(remapped != relabeled)
+    coordinates, old, new = record.changes()
+    np.testing.assert_array_equal(relabeled[tuple(coordinates)], old)
+    np.testing.assert_array_equal(remapped[tuple(coordinates)], new)
+
+    assert history.undo(image).description == "remap"
+    np.testing.assert_array_equal(image, relabeled)
+    history.undo(image)
+    np.testing.assert_array_equal(image, original)
+    assert history.undo(image) is None
+    history.redo(image)
+    history.redo(image)
+    np.testing.assert_array_equal(image, remapped)
+    assert not history.can_redo
+
+    # a voxel of the edit painted over: undoing would overwrite it
+    painted = tuple(coordinates[:, 0])
+    image[painted] = 42
+    with pytest.raises(ValueError, match="cannot be undone"):
+        history.undo(image)
+    assert history.can_undo and image[painted] == 42
+
+
+class _ChunkedArray:
+    """Array returning copies of its regions, like a Zarr array"""
+
+    def __init__(self, data, read_only=False):
+        self.data = data
+        self.read_only = read_only
+        self.shape, self.dtype = data.shape, data.dtype
+
+    def __getitem__(self, key):
+        return self.data[key].copy()
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __array__(self, dtype=None, copy=None):
+        return self.data.copy()
+
+
+def test_edits_of_chunked_arrays_are_written_back(monkeypatch):
+    monkeypatch.setattr(label_editing, "CHUNK_SIZE", 10)
+    rng = np.random.default_rng(2)
+    original = rng.integers(0, 4, (6, 7, 8)).astype(np.uint8)
+    image = _ChunkedArray(original.copy())
+    expected = original.copy()
+    expected[expected == 3] = 7
+
+    record = EditRecord("relabel")
+    n_changed = relabel(image, 3, 7, [(slice(None),)], record=record)
+    assert n_changed == np.count_nonzero(original == 3)
+    np.testing.assert_array_equal(image.data, expected)
+    record.apply(image, undo=True)
+    np.testing.assert_array_equal(image.data, original)
+    remap_labels(image, {1: 2, 2: 1}, out=image)
+    np.testing.assert_array_equal(image.data == 1, original == 2)
+
+    # copies can be made of any array-like
+    copy = remap_labels(image, {1: 5})
+    assert isinstance(copy, np.ndarray) and copy.max() == 5
+
+    with pytest.raises(ValueError, match="read-only"):
+        relabel(_ChunkedArray(original, read_only=True), 3, 7, [()])
+    original.flags.writeable = False
+    with pytest.raises(ValueError, match="read-only"):
+        relabel(original, 3, 7, [()])
+
+
+class _FailingArray(_ChunkedArray):
+    """Chunked array whose writes fail after the first `n_writes`"""
+
+    def __init__(self, data, n_writes):
+        super().__init__(data)
+        self.n_writes = n_writes
+
+    def __setitem__(self, key, value):
+        if self.n_writes == 0:
+            raise OSError("disk full")
+        self.n_writes -= 1
+        super().__setitem__(key, value)
+
+
+@pytest.mark.parametrize("edit", ["relabel", "remap"])
+def test_failed_edit_only_records_written_voxels(monkeypatch, edit):
+    monkeypatch.setattr(label_editing, "CHUNK_SIZE", 10)
+    original = np.full((6, 7, 8), 3, dtype=np.uint8)
+    image = _FailingArray(original.copy(), n_writes=2)
+    history = EditHistory()
+    record = EditRecord(edit)
+    with pytest.raises(OSError):
+        if edit == "relabel":
+            relabel(image, 3, 7, [(slice(None),)], record=record)
+        else:
+            remap_labels(image, {3: 7}, out=image, record=record)
+
+    # the voxels of the failed block were not recorded as changed
+    assert 0 < len(record) == np.count_nonzero(image.data != original)
+    history.push(record)
+    image.n_writes = -1
+    history.undo(image)
+    np.testing.assert_array_equal(image.data, original)
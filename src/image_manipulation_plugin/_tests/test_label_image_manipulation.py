@@ -0,0 +1,245 @@
+import threading
+
+import numpy as np
+import pytest
+from napari.components import ViewerModel
+from qtpy.QtWidgets import QPushButton
+from tifffile import imwrite
+
+from image_manipulation_plugin.label_image_manipulation import (
+    ChangeLabel,
+    ListLabels,
+    MeasureLabelVolume,
+    OpenTIFSequence,
+    label_image_manipulation,
+)
+from image_manipulation_plugin.sequence_io import LazySequence
+
+
+def _click(widget, text):
+    (button,) = [
+        button
+        for button in widget.findChildren(QPushButton)
+        if button.text() == text
+    ]
+    button.click()
+
+
+def _change_label(qtbot, labels, label1=3, label2=7):
+    viewer = ViewerModel()
+    layer = viewer.add_labels(labels)
+    widget = ChangeLabel(viewer)
+    qtbot.addWidget(widget)
+    widget.btn_input.value = label1
+    widget.btn_new.value = label2
+    return widget, layer
+
+
+def test_change_label_in_place_and_undo(qtbot):
+    original = np.zeros((3, 4, 10, 10), dtype=np.uint8)
+    original[:, 1:3, 2:5, 2:5] = 3
+    original[1, 0, 0, 0] = 5
+    widget, layer = _change_label(qtbot, original.copy())
+
+    _click(widget, "Change label")
+    qtbot.waitUntil(lambda: "has been changed" in widget.message.value)
+    expected = np.where(original == 3, 7, original)
+    np.testing.assert_array_equal(layer.data, expected)
+
+    _click(widget, "Undo last change")
+    qtbot.waitUntil(lambda: widget.message.value.startswith("Undone"))
+    np.testing.assert_array_equal(layer.data, original)
+    _click(widget, "Redo")
+    qtbot.waitUntil(lambda: widget.message.value.startswith("Redone"))
+    np.testing.assert_array_equal(layer.data, expected)
+
+    # a painted layer has no undo left
+    layer.paint((1, 0, 0, 0), 9, refresh=False)
+    _click(widget, "Undo last change")
+    assert widget.message.value == "There is no change to undo."
+
+
+def test_apply_mapping_in_place_and_undo(qtbot):
+    original = np.zeros((2, 3, 8, 8), dtype=np.uint16)
+    original[:, :, :4] = 3
+    original[1, :, 4:] = 5
+    widget, layer = _change_label(qtbot, original.copy())
+    widget.mapping_table.value = "old new\n3 5\n5 3"
+
+    _click(widget, "Apply mapping")
+    qtbot.waitUntil(
+        lambda: "2 labels have been changed" in widget.message.value
+    )
+    swapped = original.copy()
+    swapped[original == 3], swapped[original == 5] = 5, 3
+    np.testing.assert_array_equal(layer.data, swapped)
+    _click(widget, "Undo last change")
+    qtbot.waitUntil(lambda: widget.message.value.startswith("Undone"))
+    np.testing.assert_array_equal(layer.data, original)
+
+
+def test_cancelled_change_label_is_rolled_back(qtbot, monkeypatch):
+    original = np.zeros((4, 2, 6, 6), dtype=np.uint8)
+    original[:, :, 1:4, 1:4] = 3
+    widget, layer = _change_label(qtbot, original.copy())
+    release = threading.Event()
+    iter_relabel = label_image_manipulation.iter_relabel
+
+    def paused_relabel(*args):
+        # the first box is changed, then the edit waits to be cancelled
+        iterator = iter_relabel(*args)
+        next(iterator)
+        yield
+        release.wait(5)
+        result = yield from iterator
+        return result
+
+    monkeypatch.setattr(
+        label_image_manipulation, "iter_relabel", paused_relabel
+    )
+    _click(widget, "Change label")
+    qtbot.waitUntil(lambda: widget.message.value.startswith("Changing"))
+    assert not np.array_equal(layer.data, original)
+    widget.tasks.cancel()
+    release.set()
+    qtbot.waitUntil(lambda: "left unchanged" in widget.message.value)
+    np.testing.assert_array_equal(layer.data, original)
+    assert not widget._history(layer).can_undo
+
+
+def test_change_label_refusals(qtbot):
+    original = np.zeros((4, 10, 10), dtype=np.uint8)
+    original[1:3, 2:5, 2:5] = 3
+
+    # the new label does not fit in the dtype of the layer
+    widget, layer = _change_label(qtbot, original.copy(), label2=300)
+    _click(widget, "Change label")
+    qtbot.waitUntil(
+        lambda: "does not fit in the uint8" in widget.message.value
+    )
+    np.testing.assert_array_equal(layer.data, original)
+
+    # read-only labels can only be changed in a copy
+    read_only = original.copy()
+    read_only.flags.writeable = False
+    widget, layer = _change_label(qtbot, read_only)
+    _click(widget, "Change label")
+    assert "read-only" in widget.message.value
+    widget.btn_copy.value = "Yes"
+    _click(widget, "Change label")
+    qtbot.waitUntil(lambda: len(widget.viewer.layers) == 2)
+    np.testing.assert_array_equal(
+        widget.viewer.layers["new_labels"].data,
+        np.where(original == 3, 7, original),
+    )
+
+
+def _open_sequence(qtbot, tmp_path, movie, image_type="Labels"):
+    for t, frame in enumerate(movie):
+        imwrite(str(tmp_path / f"frame_{t:03d}.tif"), frame)
+    widget = OpenTIFSequence(ViewerModel())
+    qtbot.addWidget(widget)
+    widget.path_first_image.value = str(tmp_path / "frame_000.tif")
+    widget.type.value = image_type
+    return widget
+
+
+def test_open_sequence(qtbot, tmp_path):
+    movie = np.arange(3 * 2 * 4 * 5, dtype=np.uint16).reshape(3, 2, 4, 5)
+
+    # frames are loaded in the background, labels in the smallest dtype
+    widget = _open_sequence(qtbot, tmp_path, movie % 200)
+    _click(widget, "Open sequence")
+    qtbot.waitUntil(lambda: "Movie" in widget.viewer.layers)
+    assert widget.message.value == "Opened 3 time frames."
+    data = widget.viewer.layers["Movie"].data
+    assert data.dtype == np.uint8
+    np.testing.assert_array_equal(data, movie % 200)
+
+    # lazy movies are only read when napari needs the frames
+    widget = _open_sequence(qtbot, tmp_path, movie, "Intensity")
+    widget.lazy.value = True
+    _click(widget, "Open sequence")
+    data = widget.viewer.layers["Movie"].data
+    assert isinstance(data, LazySequence)
+    np.testing.assert_array_equal(data[2], movie[2])
+
+
+def test_open_sequence_refusals(qtbot, tmp_path):
+    movie = np.zeros((2, 2, 4, 5), dtype=np.uint16)
+    movie[0, 0, 0, 0] = 300
+
+    # labels IDs that do not fit in the chosen dtype are never wrapped
+    widget = _open_sequence(qtbot, tmp_path, movie)
+    widget.lazy.value = True
+    widget.dtype.value = "uint8"
+    _click(widget, "Open sequence")
+    assert "do not fit in uint8" in widget.message.value
+    assert "Movie" not in widget.viewer.layers
+
+    # an existing store is never replaced, it may hold edited labels
+    (tmp_path / "frame_000.zarr").mkdir()
+    widget.to_zarr.value = True
+    _click(widget, "Open sequence")
+    assert widget.message.value.startswith("frame_000.zarr already exists")
+
+
+def test_open_sequence_as_zarr(qtbot, tmp_path):
+    pytest.importorskip("zarr")
+    movie = np.arange(3 * 2 * 4 * 5, dtype=np.uint16).reshape(3, 2, 4, 5)
+    widget = _open_sequence(qtbot, tmp_path, movie)
+    widget.to_zarr.value = True
+    _click(widget, "Open sequence")
+    qtbot.waitUntil(lambda: "Movie" in widget.viewer.layers)
+    np.testing.assert_array_equal(widget.viewer.layers["Movie"].data[:], movie)
+
+    # the store is then opened directly, writable for labels
+    widget = OpenTIFSequence(ViewerModel())
+    qtbot.addWidget(widget)
+    widget.path_first_image.value = str(tmp_path / "frame_000.zarr")
+    _click(widget, "Open sequence")
+    data = widget.viewer.layers["Movie"].data
+    data[0, 0, 0, 0] = 7
+    assert data[0, 0, 0, 0] == 7
+
+
+def test_list_labels_keeps_search(qtbot):
+    labels = np.zeros((2, 4, 10, 10), dtype=np.uint8)
+    for label in range(1, 8):
+        labels[label % 2, :, label] = label
+    viewer = ViewerModel()
+    layer = viewer.add_labels(labels)
+    widget = ListLabels(viewer)
+    qtbot.addWidget(widget)
+
+    _click(widget, "List labels")
+    qtbot.waitUntil(lambda: widget.output_str.value.endswith(" labels"))
+    widget.search.value = "3-5"
+    assert widget.output_str.value == "3 labels shown"
+
+    # the search still filters the labels listed again after an edit
+    labels[:, :, 4] = 0
+    layer.data = labels
+    _click(widget, "List labels")
+    qtbot.waitUntil(lambda: widget.output_str.value == "2 labels shown")
+    assert widget.search.value == "3-5"
+    rows = range(widget.model.rowCount())
+    assert [int(widget.model.label(row)) for row in rows] == [3, 5]
+
+
+def test_measure_volume_table(qtbot):
+    labels = np.zeros((3, 2, 6, 6), dtype=np.uint16)
+    labels[:, :, :2] = 4
+    labels[1:, 0, 3:, 3:] = 9
+    viewer = ViewerModel()
+    viewer.add_labels(labels, name="cells")
+    widget = MeasureLabelVolume(viewer)
+    qtbot.addWidget(widget)
+
+    _click(widget, "Volume table (all timepoints)")
+    qtbot.waitUntil(lambda: widget.message.value.startswith("Volumes of"))
+    assert widget.message.value == (
+        "Volumes of 2 labels at 3 timepoints in cells"
+    )
+    assert widget.table.data.to_list() == [[24, 24, 24], [0, 9, 9]]
+    assert list(widget.table.row_headers) == [4, 9]
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from image_manipulation_plugin.label_statistics import (
+    LabelStatistics,
+    label_statistics,
+    statistics_cache,
+    timepoint_statistics,
+)
+
+
+@pytest.mark.parametrize("offset", [0, -3, 10**12])
+def test_label_statistics_matches_numpy(offset):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 6, (3, 5, 7, 9)) + offset
+    stats = label_statistics(image)
+
+    labels, counts = np.unique(image, return_counts=True)
+    np.testing.assert_array_equal(stats.labels, labels)
+    np.testing.assert_array_equal(stats.counts, counts)
+    for label in labels:
+        coordinates = np.argwhere(image == label)
+        np.testing.assert_allclose(
+            stats.centroid(label), coordinates.mean(axis=0)
+        )
+        bbox = stats.bbox(label)
+        assert [s.start for s in bbox] == list(coordinates.min(axis=0))
+        assert [s.stop for s in bbox] == list(coordinates.max(axis=0) + 1)
+    assert stats.count(labels.max() + 1) == 0
+
+
+def test_merged_timepoints_match_whole_movie():
+    rng = np.random.default_rng(1)
+    image = rng.integers(0, 10, (4, 6, 6, 6)).astype(np.uint16)
+    merged = LabelStatistics.merge(timepoint_statistics(image))
+    whole = label_statistics(image)
+    np.testing.assert_array_equal(merged.labels, whole.labels)
+    np.testing.assert_array_equal(merged.counts, whole.counts)
+    np.testing.assert_allclose(merged.centroids, whole.centroids[:, 1:])
+
+
+def test_updated_matches_recomputation():
+    rng = np.random.default_rng(2)
+    image = rng.integers(0, 4, (6, 7, 8))
+    stats = label_statistics(image)
+    coordinates = (
+        np.array([0, 1, 5]),
+        np.array([2, 2, 6]),
+        np.array([0, 3, 7]),
+    )
+    old_values = image[coordinates]
+    image[coordinates] = [9, 1, 9]
+
+    updated = stats.updated(coordinates, old_values, [9, 1, 9])
+    expected = label_statistics(image)
+    np.testing.assert_array_equal(updated.labels, expected.labels)
+    np.testing.assert_array_equal(updated.counts, expected.counts)
+    np.testing.assert_allclose(updated.centroids, expected.centroids)
+    assert updated.bbox(9) == expected.bbox(9)
+
+
+def test_cache_follows_paint_and_data_events():
+    from napari.layers import Labels
+
+    layer = Labels(np.zeros((2, 5, 5, 5), dtype=np.uint16))
+    cache = statistics_cache(layer)
+    assert statistics_cache(layer) is cache
+    assert cache.movie().count(0) == 250
+
+    layer.data_setitem((np.array([1]),) + (np.array([2]),) * 3, 4)
+    assert cache.frame(1).count(4) == 1
+    assert cache.frame(0).count(4) == 0
+    assert cache.movie().count(0) == 249
+
+    layer.data = np.ones((3, 2, 2, 2), dtype=np.uint8)
+    np.testing.assert_array_equal(cache.movie().labels, [1])
+
+
+def test_cache_compute_discards_outdated_statistics(monkeypatch):
+    from napari.layers import Labels
+
+    from image_manipulation_plugin import label_statistics as module
+
+    layer = Labels(np.zeros((2, 4, 4, 4), dtype=np.uint16))
+    cache = statistics_cache(layer)
+
+    def edited_while_computing(image):
+        # simulates a paint event while a background worker computes
+        statistics = label_statistics(image)
+        layer.data_setitem((np.array([1]),) + (np.array([1]),) * 3, 6)
+        return statistics
+
+    monkeypatch.setattr(module, "label_statistics", edited_while_computing)
+    list(cache.compute([1]))
+    monkeypatch.undo()
+    assert 1 not in cache._frames
+    assert cache.frame(1).count(6) == 1
+
+
+def test_volume_matrix_of_parallel_timepoints():
+    from image_manipulation_plugin.label_statistics import volume_matrix
+
+    rng = np.random.default_rng(1)
+    movie = rng.integers(0, 6, (5, 4, 8, 8), dtype=np.uint16)
+    movie[2][movie[2] == 3] = 0
+    labels, volumes = volume_matrix(timepoint_statistics(movie, max_workers=3))
+    np.testing.assert_array_equal(labels, [1, 2, 3, 4, 5])
+    expected = [
+        [np.count_nonzero(frame == label) for frame in movie]
+        for label in labels
+    ]
+    np.testing.assert_array_equal(volumes, expected)
+    assert volumes[2, 2] == 0
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from qtpy.QtCore import Qt
+
+from image_manipulation_plugin.label_statistics import (
+    label_statistics,
+    label_table,
+)
+from image_manipulation_plugin.label_table import (
+    LabelTableModel,
+    label_table_view,
+    parse_search,
+)
+
+
+def test_label_table_timepoint_ranges():
+    movie = np.zeros((3, 2, 4, 4), dtype=np.uint64)
+    movie[0, 0, 0, :2] = 7
+    movie[2, 1, :, 0] = 7
+    movie[1:, 0, 3, 3] = 2**40
+    table = label_table([label_statistics(frame) for frame in movie], 0)
+    assert table["label"].dtype == np.uint64
+    np.testing.assert_array_equal(table["label"], [7, 2**40])
+    np.testing.assert_array_equal(table["count"], [6, 2])
+    np.testing.assert_array_equal(table["first"], [0, 1])
+    np.testing.assert_array_equal(table["last"], [2, 2])
+
+
+def test_parse_search():
+    assert parse_search(" ") == (None, None)
+    assert parse_search("12") == (12, 12)
+    assert parse_search("10-20") == (10, 20)
+    assert parse_search("-3--1") == (-3, -1)
+    with pytest.raises(ValueError):
+        parse_search("abc")
+
+
+def test_model_sorts_and_searches(qtbot):
+    table = {
+        "label": np.array([1, 2, 3, 4]),
+        "count": np.array([5, 9, 5, 1]),
+        "first": np.zeros(4, dtype=int),
+        "last": np.ones(4, dtype=int),
+    }
+    model = LabelTableModel(table)
+    view = label_table_view(model)
+    qtbot.addWidget(view)
+
+    def labels():
+        return [model.label(row) for row in range(model.rowCount())]
+
+    view.sortByColumn(1, Qt.DescendingOrder)
+    # rows with the same count stay sorted by label
+    assert labels() == [2, 1, 3, 4]
+    assert model.data(model.index(0, 1)) == "9"
+
+    model.search("2-3")
+    assert labels() == [2, 3]
+    model.set_table({key: column[:2] for key, column in table.items()})
+    assert labels() == [2]
@@ -1,7 +1,36 @@
-from image_manipulation_plugin import imagemanipulationplugin
+from napari.components import ViewerModel
+from qtpy.QtWidgets import QComboBox, QStackedWidget
 
+from image_manipulation_plugin import (
+    LabelCreationWidget,
+    LabelImageManipulationWidget,
+)
 
-def test_module():
-    """You should write tests here!"""
-    test_obj = imagemanipulationplugin(1)
-    assert test_obj.arg == 1
\ No newline at end of file
+
+def test_module(qtbot):
+    """Both plugin widgets list all the widgets of their module"""
+    viewer = ViewerModel()
+    for main_widget in (LabelImageManipulationWidget, LabelCreationWidget):
+        widget = main_widget(viewer)
+        qtbot.addWidget(widget)
+        (combobox,) = [
+            child
+            for child in widget.findChildren(QComboBox)
+            if getattr(child, "name", None) == "main_combobox"
+        ]
+        items = [combobox.itemText(i) for i in range(combobox.count())]
+        assert items == [w.name for w in main_widget.module.__all_widgets__]
+
+        # the widgets are created when they are first selected
+        (stack,) = widget.findChildren(QStackedWidget)
+        classes = main_widget.module.__all_widgets__
+
+        def created():
+            return [
+                type(stack.widget(i)) in classes for i in range(len(classes))
+            ]
+
+        assert created() == [True] + [False] * (len(classes) - 1)
+        combobox.setCurrentIndex(len(classes) - 1)
+        assert isinstance(stack.currentWidget(), classes[-1])
+        assert created()[-1] and stack.count() == len(classes)
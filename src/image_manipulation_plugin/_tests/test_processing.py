@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+from skimage.filters import threshold_otsu
+
+from image_manipulation_plugin.cli import main
+from image_manipulation_plugin.label_dtypes import compact_dtype
+from image_manipulation_plugin.processing import (
+    label_volumes,
+    segment,
+    threshold_value,
+    volume_table,
+    write_volume_table,
+)
+from image_manipulation_plugin.thresholding import frame_chunks
+
+
+def test_segment_matches_skimage():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 200, (4, 30, 40), dtype=np.uint8)
+    threshold, labels = segment(image, "Otsu")
+    assert threshold == threshold_otsu(image)
+    np.testing.assert_array_equal(labels, image > threshold)
+
+    assert threshold_value(image, value=50) == 199 * 0.5
+    _, labels = segment(image, value=50, below=True, min_size=1)
+    assert labels.dtype == compact_dtype(labels.max())
+
+
+def test_segment_per_timepoint_follows_drift():
+    rng = np.random.default_rng(1)
+    image = rng.integers(0, 50, (3, 4, 20, 30)).astype(np.float32)
+    image[:, :, 5:10, 5:10] += 150
+    # the illumination doubles at every timepoint
+    image *= np.array([1, 2, 4], dtype=np.float32)[:, None, None, None]
+
+    thresholds, labels = segment(image, "Otsu", per_timepoint=True)
+    for t in range(3):
+        assert thresholds[t] == threshold_value(image[t], "Otsu")
+        np.testing.assert_array_equal(labels[t], image[t] > thresholds[t])
+
+    thresholds, labels = segment(
+        image, "Otsu", per_timepoint=True, min_size=10
+    )
+    # one square per timepoint, the noise is below the thresholds
+    assert [len(np.unique(frame)) for frame in labels] == [2, 2, 2]
+    assert (labels[:, :, 5:10, 5:10] > 0).all()
+
+
+def test_segment_per_timepoint_to_zarr(tmp_path):
+    # small frames would fit several timepoints in one block
+    assert frame_chunks((8, 4, 20, 30)) == (1, 4, 20, 30)
+    pytest.importorskip("zarr")
+    rng = np.random.default_rng(2)
+    image = rng.integers(0, 200, (8, 4, 20, 30)).astype(np.uint8)
+    thresholds, expected = segment(image, "Otsu", per_timepoint=True)
+    _, labels = segment(
+        image, "Otsu", per_timepoint=True, path=tmp_path / "labels.zarr"
+    )
+    assert labels.chunks == (1, 4, 20, 30)
+    np.testing.assert_array_equal(labels[:], expected)
+
+
+def test_label_volumes_per_timepoint():
+    image = np.zeros((2, 3, 4, 4), dtype=np.uint16)
+    image[0, 0, :2] = 5
+    image[1, :, 0, 0] = 7
+    volumes = label_volumes(image)
+    np.testing.assert_array_equal(volumes["timepoint"], [0, 1])
+    np.testing.assert_array_equal(volumes["label"], [5, 7])
+    np.testing.assert_array_equal(volumes["volume"], [8, 3])
+
+
+def test_cli_processes_directory(tmp_path):
+    tifffile = pytest.importorskip("tifffile")
+    images = tmp_path / "images"
+    images.mkdir()
+    for i in range(3):
+        image = np.zeros((2, 8, 8), dtype=np.uint8)
+        image[:, : i + 2, :2] = 100
+        tifffile.imwrite(images / f"frame_{i}.tif", image)
+
+    assert (
+        main(
+            [
+                "threshold",
+                str(images),
+                str(tmp_path / "labels"),
+                "--value",
+                "50",
+                "--workers",
+                "2",
+            ]
+        )
+        == 0
+    )
+    labels = tifffile.imread(tmp_path / "labels" / "frame_1.tif")
+    assert labels.sum() == 2 * 3 * 2
+
+    mapping = tmp_path / "mapping.csv"
+    mapping.write_text("old,new\n1,4\n")
+    assert (
+        main(
+            [
+                "relabel",
+                str(tmp_path / "labels"),
+                str(tmp_path / "relabeled"),
+                "--mapping",
+                str(mapping),
+            ]
+        )
+        == 0
+    )
+    assert (
+        main(
+            ["measure", str(tmp_path / "relabeled"), str(tmp_path / "volumes")]
+        )
+        == 0
+    )
+    lines = (tmp_path / "volumes" / "volumes.csv").read_text().splitlines()
+    assert lines == [
+        "file,label,volume",
+        "frame_0.tif,4,8",
+        "frame_1.tif,4,12",
+        "frame_2.tif,4,16",
+    ]
+
+    # the images and the results are only replaced with --overwrite
+    before = (images / "frame_1.tif").read_bytes()
+    relabel = ["relabel", str(images), str(images), "--mapping", str(mapping)]
+    assert main(relabel) == 1
+    assert main(relabel[:2] + [str(tmp_path / "relabeled")] + relabel[3:]) == 1
+    assert (images / "frame_1.tif").read_bytes() == before
+    assert main(relabel + ["--overwrite"]) == 0
+
+
+def test_volume_table_export(tmp_path):
+    image = np.zeros((3, 2, 4, 4), dtype=np.uint8)
+    image[0, 0, 0] = 2
+    image[2, :, :2] = 9
+    labels, volumes = volume_table(image)
+    np.testing.assert_array_equal(labels, [2, 9])
+    np.testing.assert_array_equal(volumes, [[4, 0, 0], [0, 0, 16]])
+
+    write_volume_table(tmp_path / "volumes.csv", labels, volumes)
+    lines = (tmp_path / "volumes.csv").read_text().splitlines()
+    assert lines == ["label,t0,t1,t2", "2,4,0,0", "9,0,0,16"]
@@ -0,0 +1,82 @@
+import json
+
+import numpy as np
+import pytest
+from qtpy.QtWidgets import QPushButton
+
+from image_manipulation_plugin import profiling
+from image_manipulation_plugin.processing import segment
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    path = tmp_path / "profile.jsonl"
+    profiling.clear()
+    profiling.enable(path)
+    yield path
+    profiling.disable()
+    profiling.clear()
+
+
+def test_headless_functions_are_recorded(profiler):
+    image = np.zeros((4, 30, 40), dtype=np.uint8)
+    image[:, 10:20, 10:20] = 200
+    segment(image, "Otsu")
+
+    records = profiling.records()
+    assert [r["name"] for r in records] == ["threshold_value", "segment"]
+    record = records[-1]
+    assert record["status"] == "done" and record["wall_time"] > 0
+    assert record["arrays"][0] == {"shape": [4, 30, 40], "dtype": "uint8"}
+    # the labels image is allocated during the call
+    assert record["peak_memory"] >= image.size
+    lines = profiler.read_text().splitlines()
+    assert [json.loads(line) for line in lines] == records
+    assert profiling.summary()["segment"]["calls"] == 1
+
+
+def test_generators_and_errors_are_recorded(profiler):
+    @profiling.profiled
+    def steps():
+        yield
+        yield
+        return "done"
+
+    iterator = steps()
+    next(iterator)
+    iterator.close()
+    with pytest.raises(ZeroDivisionError):
+        profiling.profiled(lambda: 1 / 0)()
+    assert [r["status"] for r in profiling.records()] == ["cancelled", "error"]
+
+    profiling.disable()
+    assert list(steps()) == [None, None]
+    assert len(profiling.records()) == 2
+
+
+def test_handlers_ignore_signal_arguments(qtbot, profiler):
+    @profiling.profile_handlers
+    class Widget:
+        def __init__(self):
+            self.clicks = []
+
+        def _on_click(self):
+            self.clicks.append("click")
+
+        def _on_click_undo(self, redo=False):
+            self.clicks.append(redo)
+
+    widget = Widget()
+    button = QPushButton()
+    button.clicked.connect(widget._on_click)
+    button.clicked.connect(widget._on_click_undo)
+    button.click()
+    assert widget.clicks == ["click", False]
+    # handlers calling each other pass keyword arguments
+    widget._on_click_undo(redo=True)
+    assert widget.clicks[-1] is True
+    assert [r["name"] for r in profiling.records()] == [
+        "test_handlers_ignore_signal_arguments.<locals>.Widget._on_click",
+        "test_handlers_ignore_signal_arguments.<locals>.Widget._on_click_undo",
+        "test_handlers_ignore_signal_arguments.<locals>.Widget._on_click_undo",
+    ]
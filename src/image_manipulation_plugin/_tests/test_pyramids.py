@@ -0,0 +1,44 @@
+import numpy as np
+
+from image_manipulation_plugin.pyramids import (
+    downsample_mean,
+    downsample_mode,
+    iter_pyramid,
+    n_steps,
+    pyramid_shapes,
+)
+
+
+def test_pyramid_shapes_keep_time_and_small_axes():
+    shapes = pyramid_shapes((5, 20, 1000, 700), min_size=256)
+    assert shapes == [(5, 20, 1000, 700), (5, 20, 500, 350), (5, 20, 250, 175)]
+
+
+def test_downsampling():
+    image = np.array([[1, 1, 2, 2, 7], [1, 3, 2, 2, 7]], dtype=np.uint8)
+    np.testing.assert_array_equal(downsample_mode(image, (2, 2)), [[1, 2, 7]])
+    np.testing.assert_array_equal(downsample_mean(image, (2, 2)), [[2, 2, 7]])
+
+
+def test_pyramid_levels_are_computed_in_slabs():
+    rng = np.random.default_rng(0)
+    movie = rng.integers(0, 4, (2, 66, 130, 70), dtype=np.uint16)
+    iterator = iter_pyramid(movie, labels=True, min_size=64, chunk_size=10**4)
+    n = 0
+    while True:
+        try:
+            next(iterator)
+            n += 1
+        except StopIteration as stop:
+            levels = stop.value
+            break
+    assert n == n_steps(movie.shape, min_size=64, chunk_size=10**4)
+    assert [level.shape for level in levels] == pyramid_shapes(
+        movie.shape, min_size=64
+    )
+    assert levels[0] is movie
+    for t in range(2):
+        np.testing.assert_array_equal(
+            levels[1][t], downsample_mode(movie[t], (2, 2, 2))
+        )
+    assert levels[1].dtype == np.uint16
@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+from tifffile import imwrite, imread
+
+from image_manipulation_plugin.cli import main
+from image_manipulation_plugin.label_editing import relabel
+from image_manipulation_plugin.sequence_io import (
+    LazySequence,
+    convert_to_zarr,
+    find_zarr_store,
+    iter_write_sequence,
+    load_sequence,
+    open_sequence,
+    open_zarr,
+    raw_reader,
+)
+
+
+def test_load_sequence_keeps_native_dtype(tmp_path):
+    frames = [np.full((2, 3, 4), t, dtype=np.uint16) for t in range(5)]
+    list_of_files = []
+    for t, frame in enumerate(frames):
+        file = str(tmp_path / f"frame_{t:03d}.tif")
+        imwrite(file, frame)
+        list_of_files.append(file)
+
+    movie = load_sequence(list_of_files, imread, max_workers=3)
+    assert movie.shape == (5, 2, 3, 4)
+    assert movie.dtype == np.uint16
+    np.testing.assert_array_equal(movie, np.stack(frames))
+
+
+def test_lazy_sequence_reads_on_demand():
+    frames = {
+        f"frame_{t}": np.full((2, 3, 4), t, dtype=np.uint8) for t in range(6)
+    }
+    reads = []
+
+    def read_frame(file):
+        reads.append(file)
+        return frames[file]
+
+    movie = LazySequence(list(frames), read_frame, cache_size=2)
+    assert movie.shape == (6, 2, 3, 4)
+    assert reads == ["frame_0"]
+
+    assert movie[3, 1, 2, 3] == 3
+    assert movie[3].shape == (2, 3, 4)
+    assert reads == ["frame_0", "frame_3"]
+
+    np.testing.assert_array_equal(movie[..., 0][:, 0, 0], np.arange(6))
+    # only the two most recently used frames are kept
+    assert len(movie._cache) == 2
+    np.testing.assert_array_equal(
+        np.asarray(movie), np.stack(list(frames.values()))
+    )
+
+
+def test_lazy_sequence_never_wraps_labels():
+    frames = {
+        "frame_0": np.full((2, 3), 7, dtype=np.uint16),
+        "frame_1": np.full((2, 3), 300, dtype=np.uint16),
+    }
+    movie = LazySequence(list(frames), frames.get, dtype=np.uint8)
+    assert movie[0].dtype == np.uint8
+    with pytest.raises(ValueError, match="do not fit in uint8"):
+        movie[1]
+
+
+def test_open_sequence_raw_xyz(tmp_path):
+    # frames stored in (x, y, z) order, as medpy returns them
+    frames = [
+        np.arange(24, dtype=np.int16).reshape(4, 3, 2) + t for t in range(4)
+    ]
+    for t, frame in enumerate(frames):
+        frame.tofile(str(tmp_path / f"frame_{t}.raw"))
+    reader = raw_reader((4, 3, 2), np.int16, axes="xyz")
+    expected = np.stack([frame.transpose(2, 1, 0) for frame in frames])
+
+    # the sequence starts at the selected image
+    first = str(tmp_path / "frame_1.raw")
+    movie = open_sequence(first, reader=reader)
+    np.testing.assert_array_equal(movie, expected[1:])
+
+    lazy_movie = open_sequence(first, "frame_*.raw", reader=reader, lazy=True)
+    assert lazy_movie.shape == (3, 2, 3, 4)
+    np.testing.assert_array_equal(lazy_movie[2], expected[3])
+
+
+@pytest.mark.parametrize("file_format", ["tif", "mha"])
+def test_written_sequence_opens_back(tmp_path, file_format):
+    if file_format == "mha":
+        pytest.importorskip("medpy.io")
+    rng = np.random.default_rng(0)
+    movie = rng.integers(0, 300, (11, 3, 4, 5)).astype(np.uint16)
+    # streamed from a lazy sequence, one frame per thread
+    lazy_movie = LazySequence(list(movie), lambda frame: frame)
+
+    writer = iter_write_sequence(
+        lazy_movie, tmp_path, "labels_t", file_format, compress=True
+    )
+    assert sorted(writer) == list(range(11))
+    reopened = open_sequence(str(tmp_path / f"labels_t000.{file_format}"))
+    np.testing.assert_array_equal(reopened, movie)
+
+
+def test_find_zarr_store(tmp_path):
+    store = tmp_path / "movie.zarr"
+    assert find_zarr_store(store / "0" / ".zarray") == str(store)
+    assert find_zarr_store(tmp_path / "movie.n5") == str(tmp_path / "movie.n5")
+    assert find_zarr_store(tmp_path / "frame_000.tif") is None
+
+
+def test_converted_sequence_reads_chunks(tmp_path):
+    pytest.importorskip("zarr")
+    movie = np.arange(3 * 20 * 30 * 40, dtype=np.uint16).reshape(3, 20, 30, 40)
+    for t, frame in enumerate(movie):
+        imwrite(str(tmp_path / f"frame_{t:03d}.tif"), frame)
+
+    store = tmp_path / "movie.zarr"
+    converted = convert_to_zarr(
+        str(tmp_path / "frame_000.tif"), str(store), chunks=(1, 8, 16, 16)
+    )
+    assert converted.chunks == (1, 8, 16, 16)
+    reopened = open_zarr(store)
+    assert reopened.shape == movie.shape and reopened.dtype == movie.dtype
+    np.testing.assert_array_equal(reopened[1, 3:9, 5], movie[1, 3:9, 5])
+    np.testing.assert_array_equal(reopened[:], movie)
+
+    # labels opened writable are edited in the store, read-only ones never
+    labels = open_zarr(store, mode="r+")
+    assert relabel(labels, 0, 1, [(slice(0, 1),) * 4]) == 1
+    assert open_zarr(store)[0, 0, 0, 0] == 1
+    with pytest.raises(ValueError, match="read-only"):
+        relabel(open_zarr(store), 1, 0, [(slice(0, 1),) * 4])
+
+
+def test_convert_never_replaces_store(tmp_path):
+    imwrite(str(tmp_path / "frame_000.tif"), np.zeros((2, 4, 4), np.uint8))
+    store = tmp_path / "movie.zarr"
+    store.mkdir()
+    with pytest.raises(FileExistsError):
+        convert_to_zarr(str(tmp_path / "frame_000.tif"), str(store))
+    assert main(["convert", str(tmp_path / "frame_000.tif"), str(store)]) == 1
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from image_manipulation_plugin.thresholding import (
+    create_output,
+    iter_blocks,
+    threshold_image,
+)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1000, 7])
+def test_blocks_cover_the_image_once(chunk_size):
+    shape = (3, 7, 50, 60)
+    coverage = np.zeros(shape, dtype=int)
+    for block in iter_blocks(shape, chunk_size):
+        coverage[block] += 1
+    assert (coverage == 1).all()
+
+
+def test_chunked_threshold_matches_numpy(tmp_path):
+    rng = np.random.default_rng(0)
+    image = rng.random((3, 7, 50, 60)).astype(np.float32)
+    binary = threshold_image(image, 0.5, chunk_size=1000, max_workers=3)
+    assert binary.dtype == np.uint8
+    np.testing.assert_array_equal(binary, image > 0.5)
+
+    out = create_output(image.shape, tmp_path / "labels.npy")
+    threshold_image(image, 0.5, below=True, out=out, chunk_size=1000)
+    np.testing.assert_array_equal(
+        np.load(tmp_path / "labels.npy"), image < 0.5
+    )
+    with pytest.raises(ValueError):
+        create_output(image.shape, tmp_path / "labels.tif")
@@ -0,0 +1,39 @@
+import threading
+
+from magicgui import widgets
+
+from image_manipulation_plugin.workers import BackgroundTasks
+
+
+def test_background_tasks_return_and_cancel(qtbot):
+    tasks = BackgroundTasks(widgets.Label(value=""))
+    results = []
+
+    tasks.start(lambda x: x * 2, 21, returned=results.append)
+    assert tasks.busy and tasks.start(lambda: None) is None
+    qtbot.waitUntil(lambda: not tasks.busy)
+    assert results == [42] and not tasks.busy
+
+    # a generator stops at the next yield once cancelled
+    release = threading.Event()
+
+    def wait_for_release():
+        yield
+        release.wait(5)
+        yield
+        return "not cancelled"
+
+    tasks.start(
+        wait_for_release,
+        returned=results.append,
+        aborted=lambda: results.append("aborted"),
+    )
+    tasks.cancel()
+    release.set()
+    qtbot.waitUntil(lambda: not tasks.busy)
+    assert results == [42, "aborted"]
+    assert tasks.message.value == "Cancelled."
+
+    tasks.start(lambda: 1 / 0)
+    qtbot.waitUntil(lambda: not tasks.busy)
+    assert "division by zero" in tasks.message.value
@@ -36,14 +36,16 @@ class MainWidget(QWidget):
         main_stack = QStackedWidget()
         main_stack.native = main_stack
 
+        # the widgets are only created when they are first selected, an
+        # empty placeholder holds their place in the stack until then
         for im_info_class in self.module.__all_widgets__:
-            w_created = im_info_class(self.viewer)
-
-            main_combobox.addItem(w_created.name)
-
-            main_stack.addWidget(w_created)
+            main_combobox.addItem(im_info_class.name)
+            main_stack.addWidget(QWidget())
+        self.__created = {}
+        self.__main_stack = main_stack
+        self.__show_widget(0)
 
-        main_combobox.currentIndexChanged.connect(main_stack.setCurrentIndex)
+        main_combobox.currentIndexChanged.connect(self.__show_widget)
         main_combobox.name = "main_combobox"
         main_stack.name = "main_stack"
 
@@ -56,6 +58,20 @@ class MainWidget(QWidget):
         )
         return main_control
 
+    def __show_widget(self, index):
+        """Show the widget at `index`, creating it on first selection"""
+        if self.module is None or index < 0:
+            return
+        if index not in self.__created:
+            im_info_class = self.module.__all_widgets__[index]
+            w_created = im_info_class(self.viewer)
+            placeholder = self.__main_stack.widget(index)
+            self.__main_stack.insertWidget(index, w_created)
+            self.__main_stack.removeWidget(placeholder)
+            placeholder.deleteLater()
+            self.__created[index] = w_created
+        self.__main_stack.setCurrentIndex(index)
+
     def __init__(self, napari_viewer):
         super().__init__()
         self.viewer = napari_viewer
@@ -0,0 +1,310 @@
+"""
+Command line interface for batch processing without a GUI.
+
+Every image (TIF, MHA, ...) of a directory is processed in its own
+process of a pool, with the same functions as the widgets (processing.py,
+label_editing.py), and the results are written to an output directory:
+
+    image-manipulation threshold INPUT OUTPUT --method Otsu --min-size 10
+    image-manipulation relabel INPUT OUTPUT --mapping mapping.csv
+    image-manipulation measure INPUT OUTPUT
+
+Labels images keep the name and format of their input image, volumes are
+written to OUTPUT/volumes.csv. Existing results, and the input images when
+OUTPUT is INPUT, are only replaced with --overwrite. A whole sequence can also be converted once
+to a chunked Zarr store, which the openers then read chunk by chunk:
+
+    image-manipulation convert FIRST_IMAGE OUTPUT.zarr --pattern "*.tif"
+"""
+
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from image_manipulation_plugin.intensity_histograms import THRESHOLD_METHODS
+from image_manipulation_plugin.label_dtypes import compact_labels
+from image_manipulation_plugin.label_editing import (
+    parse_mapping,
+    remap_labels,
+)
+from image_manipulation_plugin.processing import label_volumes, segment
+from image_manipulation_plugin.sequence_io import (
+    READERS,
+    convert_to_zarr,
+    get_reader,
+)
+
+
+def find_images(folder, pattern=""):
+    """
+    Sorted images of `folder` in a format with a reader, or matching the
+    glob `pattern`
+    """
+    if pattern:
+        files = glob.glob(os.path.join(folder, pattern))
+    else:
+        extensions = tuple(
+            extension
+            for reader in READERS.values()
+            for extension in reader.extensions
+        )
+        files = [
+            file
+            for file in glob.glob(os.path.join(folder, "*"))
+            if file.lower().endswith(extensions)
+        ]
+    return sorted(files)
+
+
+def read_image(file):
+    """Read an image in (z, y, x) order"""
+    return np.asarray(get_reader(file)(file))
+
+
+def write_image(image, file):
+    """
+    Write a (z, y, x) image in the format given by the extension of `file`,
+    in the axis order of that format
+    """
+    get_reader(file).write_frame(image, file)
+
+
+def _output_file(file, output):
+    return os.path.join(output, os.path.basename(file))
+
+
+def _output_files(command, files, output):
+    """Files written by `command`"""
+    if command == "measure":
+        return [os.path.join(output, "volumes.csv")]
+    return [_output_file(file, output) for file in files]
+
+
+def _threshold(file, output, options):
+    image = read_image(file)
+    threshold, labels = segment(
+        image,
+        method=options["method"],
+        value=options["value"],
+        percentile=options["percentile"],
+        below=options["below"],
+        min_size=options["min_size"],
+    )
+    write_image(np.asarray(labels), _output_file(file, output))
+    return f"threshold {threshold:.2f}"
+
+
+def _relabel(file, output, options):
+    image = read_image(file)
+    labels = compact_labels(remap_labels(image, options["mapping"]))
+    write_image(labels, _output_file(file, output))
+    return f"{len(options['mapping'])} labels mapped"
+
+
+def _measure(file, output, options):
+    return label_volumes(read_image(file))
+
+
+COMMANDS = {
+    "threshold": _threshold,
+    "relabel": _relabel,
+    "measure": _measure,
+}
+
+
+def process_file(command, file, output, options):
+    """Run `command` on one file, in a process of the pool"""
+    return COMMANDS[command](file, output, options)
+
+
+def write_volumes(results, path):
+    """Write the volumes of all files to a CSV file"""
+    with open(path, "w") as csv_file:
+        csv_file.write("file,label,volume\n")
+        for file, volumes in results:
+            name = os.path.basename(file)
+            for label, volume in zip(volumes["label"], volumes["volume"]):
+                csv_file.write(f"{name},{label},{volume}\n")
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="image-manipulation",
+        description="Process a directory of images without the GUI.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("input", help="directory of the images")
+    common.add_argument("output", help="directory of the results")
+    common.add_argument(
+        "--pattern",
+        default="",
+        help="glob pattern of the images (all known formats by default)",
+    )
+    common.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace existing results, or the images if OUTPUT is INPUT",
+    )
+    common.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of processes (the number of CPUs by default)",
+    )
+
+    threshold = commands.add_parser(
+        "threshold", parents=[common], help="threshold intensity images"
+    )
+    threshold.add_argument(
+        "--method", default="Otsu", choices=sorted(THRESHOLD_METHODS)
+    )
+    threshold.add_argument(
+        "--value",
+        type=float,
+        default=None,
+        help="manual threshold in %% of the maximum intensity",
+    )
+    threshold.add_argument(
+        "--percentile",
+        action="store_true",
+        help="the manual threshold is a percentile",
+    )
+    threshold.add_argument(
+        "--below",
+        action="store_true",
+        help="keep the voxels below the threshold (electron microscopy)",
+    )
+    threshold.add_argument(
+        "--min-size",
+        type=int,
+        default=None,
+        help="label the connected components of at least this size",
+    )
+
+    relabel = commands.add_parser(
+        "relabel", parents=[common], help="apply a label mapping"
+    )
+    relabel.add_argument(
+        "--mapping",
+        required=True,
+        help="CSV file of old and new labels, one pair per line",
+    )
+
+    commands.add_parser(
+        "measure", parents=[common], help="measure label volumes"
+    )
+
+    convert = commands.add_parser(
+        "convert", help="convert a sequence to a chunked Zarr or N5 store"
+    )
+    convert.add_argument("input", help="first image of the sequence")
+    convert.add_argument("output", help="store to create (.zarr or .n5)")
+    convert.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace the output store if it exists",
+    )
+    convert.add_argument(
+        "--pattern",
+        default="",
+        help="glob pattern of the sequence files (same format by default)",
+    )
+    convert.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of threads (the number of CPUs by default)",
+    )
+    return parser
+
+
+def convert(args):
+    try:
+        movie = convert_to_zarr(
+            args.input,
+            args.output,
+            regex=args.pattern,
+            max_workers=args.workers,
+            overwrite=args.overwrite,
+        )
+    except FileExistsError as error:
+        print(f"{error}, use --overwrite to replace it", file=sys.stderr)
+        return 1
+    print(
+        f"{args.output}: {movie.shape[0]} time frames, "
+        f"chunks {movie.chunks}"
+    )
+    return 0
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    if args.command == "convert":
+        return convert(args)
+    files = find_images(args.input, args.pattern)
+    if not files:
+        print(f"No images found in {args.input}", file=sys.stderr)
+        return 1
+    if not args.overwrite:
+        # the images would be replaced by their results
+        if os.path.realpath(args.output) == os.path.realpath(args.input):
+            print(
+                f"{args.output} is the input directory, "
+                "use --overwrite to replace the images",
+                file=sys.stderr,
+            )
+            return 1
+        existing = [
+            file
+            for file in _output_files(args.command, files, args.output)
+            if os.path.exists(file)
+        ]
+        if existing:
+            print(
+                f"{existing[0]} already exists ({len(existing)} results), "
+                "use --overwrite to replace them",
+                file=sys.stderr,
+            )
+            return 1
+    os.makedirs(args.output, exist_ok=True)
+
+    options = vars(args).copy()
+    if args.command == "relabel":
+        with open(args.mapping) as mapping_file:
+            options["mapping"] = parse_mapping(mapping_file.read())
+
+    results, failed = [], 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(
+                process_file, args.command, file, args.output, options
+            ): file
+            for file in files
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            file = futures[future]
+            try:
+                result = future.result()
+            except Exception as error:
+                failed += 1
+                print(f"[{i}/{len(files)}] {file}: {error}", file=sys.stderr)
+                continue
+            if args.command == "measure":
+                results.append((file, result))
+                result = f"{len(result['label'])} labels"
+            print(f"[{i}/{len(files)}] {file}: {result}")
+
+    if args.command == "measure":
+        results.sort(key=lambda item: item[0])
+        write_volumes(results, os.path.join(args.output, "volumes.csv"))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""
+Connected-component labeling of large binary images.
+
+Every frame (timepoint of a 4D image, or the whole 2D/3D image) is split
+into slabs along its first axis, which are labeled in parallel threads
+with scipy.ndimage.label (it releases the GIL). Components touching
+across the boundary between two slabs are then merged with a union-find
+over the pairs of labels facing each other, small components are
+removed, and the final consecutive IDs are written with one lookup table
+per slab. Components never connect across timepoints.
+The functions do not depend on napari or Qt.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_manipulation_plugin.generators import exhaust
+from image_manipulation_plugin.label_dtypes import check_dtype, compact_dtype
+from image_manipulation_plugin.thresholding import create_output
+
+# number of voxels labeled at once by one thread
+CHUNK_SIZE = 2**24
+
+
+class UnionFind:
+    """
+    Disjoint sets of the integers 0..n-1, with path compression and
+    union by size.
+    """
+
+    def __init__(self, n):
+        self.parent = np.arange(n)
+        self.size = np.ones(n, dtype=np.int64)
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+
+    def roots(self):
+        """Root of every element"""
+        roots = self.parent.copy()
+        while True:
+            parents = roots[roots]
+            if np.array_equal(parents, roots):
+                return roots
+            roots = parents
+
+
+def iter_slabs(shape, time_axis=False, chunk_size=None):
+    """
+    Split an image into slabs of whole planes of at most `chunk_size`
+    voxels (or a single plane), along the first axis of every frame.
+
+    Yields
+    ------
+    slab : tuple
+        Key of the slab, `(t, slice)` for 4D images if `time_axis`.
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    frame_shape = shape[1:] if time_axis else shape
+    plane_size = int(np.prod(frame_shape[1:]))
+    step = max(1, chunk_size // max(plane_size, 1))
+    leads = [(t,) for t in range(shape[0])] if time_axis else [()]
+    for lead in leads:
+        for i0 in range(0, frame_shape[0], step):
+            yield lead + (slice(i0, min(i0 + step, frame_shape[0])),)
+
+
+def slab_chunks(shape, time_axis=False, chunk_size=None):
+    """
+    Zarr chunks holding exactly one slab of `iter_slabs`, so that the
+    threads writing different slabs never write to the same chunk
+    """
+    slab = next(iter_slabs(shape, time_axis, chunk_size))
+    lead = [1] if time_axis else []
+    frame_shape = shape[1:] if time_axis else shape
+    return tuple(
+        lead + [slab[-1].stop - slab[-1].start] + list(frame_shape[1:])
+    )
+
+
+def _facing_pairs(before, after, connectivity):
+    """
+    Pairs of labels of two adjacent planes touching each other, for the
+    given connectivity (1 to the number of dimensions of the frames)
+    """
+    pairs = []
+    ndim = before.ndim
+    # neighbours in the next plane: offsets within the plane, with at most
+    # connectivity - 1 non-zero components
+    for offset in np.ndindex(*(3,) * ndim):
+        offset = np.array(offset) - 1
+        if np.count_nonzero(offset) + 1 > connectivity:
+            continue
+        source = tuple(
+            slice(max(0, -o), n - max(0, o))
+            for o, n in zip(offset, before.shape)
+        )
+        target = tuple(
+            slice(max(0, o), n - max(0, -o))
+            for o, n in zip(offset, after.shape)
+        )
+        a, b = before[source], after[target]
+        touching = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[touching], b[touching]], axis=1))
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def iter_label_components(
+    image,
+    threshold=None,
+    below=False,
+    connectivity=1,
+    min_size=0,
+    out=None,
+    path=None,
+    chunk_size=None,
+    max_workers=None,
+    dtype=None,
+):
+    """
+    Label the connected components of a binary image (or of an image
+    thresholded on the fly), yielding after each slab is labeled and after
+    it is relabeled, and returning the labels image.
+
+    Parameters
+    ----------
+    image : array-like
+        Binary image (non-zero voxels are foreground), or intensity image
+        if `threshold` is given. 4D images are labeled per timepoint.
+    threshold : float or sequence of float, optional
+        Foreground voxels are those above (or `below`) the threshold. 4D
+        images can have one threshold per timepoint.
+    below : bool
+    connectivity : int
+        1 for face neighbours, up to the number of spatial dimensions for
+        edge and corner neighbours.
+    min_size : int
+        Components of fewer voxels are removed.
+    out : array-like, optional
+        Output labels image, see thresholding.create_output. A Zarr array
+        must have the chunks of `slab_chunks`.
+    path : str, optional
+        File of the output labels image (.npy or .zarr) if `out` is not
+        given, a Zarr array is chunked by slab.
+    chunk_size : int, optional
+        Number of voxels of each slab, CHUNK_SIZE by default.
+    max_workers : int, optional
+        Number of threads, the number of CPUs by default.
+    dtype : np.dtype, optional
+        dtype of an in-memory output, the smallest unsigned dtype holding
+        the number of components by default. Outputs given as `out` or
+        `path` hold the provisional labels and stay uint32.
+
+    Returns
+    -------
+    labels : array-like
+        Labels image, with consecutive IDs from 1.
+
+    Notes
+    -----
+    In memory, the provisional labels of every slab are kept in the
+    smallest dtype holding its own components (usually uint8 or uint16)
+    and dropped as soon as the slab is relabeled, so the peak memory is
+    about the size of the provisional labels plus the output, e.g. 2
+    bytes per voxel for a uint8 output, instead of a uint32 image.
+    """
+    # scipy is imported on first use, like the other heavy dependencies
+    from scipy import ndimage
+
+    in_memory = out is None and path is None
+    time_axis = image.ndim == 4
+    if out is None and not in_memory:
+        out = create_output(
+            image.shape,
+            path,
+            dtype=np.uint32,
+            chunks=slab_chunks(image.shape, time_axis, chunk_size),
+        )
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    n_spatial = image.ndim - 1 if time_axis else image.ndim
+    structure = ndimage.generate_binary_structure(n_spatial, connectivity)
+    slabs = list(iter_slabs(image.shape, time_axis, chunk_size))
+
+    def label_slab(slab):
+        data = np.asarray(image[slab])
+        # slabs never span two timepoints
+        value = threshold if np.ndim(threshold) == 0 else threshold[slab[0]]
+        if threshold is None:
+            foreground = data != 0
+        elif below:
+            foreground = data < value
+        else:
+            foreground = data > value
+        labels = np.empty(foreground.shape, dtype=np.uint32)
+        n = ndimage.label(foreground, structure, output=labels)
+        sizes = np.bincount(labels.reshape(-1), minlength=n + 1)
+        if in_memory:
+            # kept compact until the slab is relabeled, the boundary planes
+            # needed by the merge are views of it
+            labels = labels.astype(compact_dtype(n))
+            return n, sizes[1:], labels[0], labels[-1], labels
+        out[slab] = labels
+        # the boundary planes are kept for the merge
+        return n, sizes[1:], labels[0].copy(), labels[-1].copy(), None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = []
+        provisional_slabs = []
+        for result in executor.map(label_slab, slabs):
+            results.append(result[:4])
+            provisional_slabs.append(result[4])
+            yield
+
+        # provisional IDs: the labels of slab i are shifted by offsets[i]
+        counts = np.array([n for n, _, _, _ in results], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        sizes = np.concatenate(
+            [[0]] + [slab_sizes for _, slab_sizes, _, _ in results]
+        )
+        union_find = UnionFind(int(offsets[-1]) + 1)
+        for i in range(len(slabs) - 1):
+            if slabs[i][:-1] != slabs[i + 1][:-1]:
+                # next timepoint
+                continue
+            last_plane = results[i][3]
+            first_plane = results[i + 1][2]
+            pairs = _facing_pairs(last_plane, first_plane, connectivity)
+            for a, b in pairs:
+                union_find.union(int(a + offsets[i]), int(b + offsets[i + 1]))
+
+        # size of every merged component, small ones become background
+        roots = union_find.roots()
+        component_sizes = np.bincount(
+            roots, weights=sizes, minlength=len(roots)
+        )
+        kept = component_sizes >= max(min_size, 1)
+        kept[0] = False
+        final_ids = np.zeros(len(roots), dtype=np.uint32)
+        final_ids[kept] = np.arange(1, np.count_nonzero(kept) + 1)
+        lut = final_ids[roots]
+        # the boundary planes would keep the provisional slabs alive
+        del results
+
+        # in memory, the final labels go to a compact array and the
+        # provisional ones are dropped slab by slab
+        if in_memory:
+            n_kept = int(np.count_nonzero(kept))
+            if dtype is None:
+                dtype = compact_dtype(n_kept)
+            else:
+                check_dtype(dtype, n_kept)
+            out = np.empty(image.shape, dtype=dtype)
+
+        def relabel_slab(i):
+            slab_lut = lut[offsets[i] : offsets[i + 1] + 1].copy()
+            slab_lut[0] = 0
+            if in_memory:
+                provisional, provisional_slabs[i] = provisional_slabs[i], None
+            else:
+                provisional = np.asarray(out[slabs[i]])
+            out[slabs[i]] = slab_lut[provisional]
+
+        for _ in executor.map(relabel_slab, range(len(slabs))):
+            yield
+    return out
+
+
+def n_steps(shape, chunk_size=None):
+    """Number of values yielded by `iter_label_components`, for progress"""
+    return 2 * sum(1 for _ in iter_slabs(shape, len(shape) == 4, chunk_size))
+
+
+def label_components(image, **kwargs):
+    """
+    Label the connected components of a binary image, see
+    `iter_label_components` for the parameters.
+
+    Returns
+    -------
+    labels : array-like
+        Labels image, with consecutive IDs from 1.
+    """
+    return exhaust(iter_label_components(image, **kwargs))
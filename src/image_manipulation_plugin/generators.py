@@ -0,0 +1,18 @@
+"""
+Running the generator functions of the plugin to their end.
+
+Long computations are written as generators yielding after each step, so
+that the widgets can run them in background workers with a progress bar
+and cancellation (see workers.py). Their blocking versions, used from
+scripts and the command line, run them to the end with `exhaust`.
+The module does not depend on napari or Qt.
+"""
+
+
+def exhaust(iterator):
+    """Run a generator to the end and return its return value"""
+    while True:
+        try:
+            next(iterator)
+        except StopIteration as stop:
+            return stop.value
@@ -0,0 +1,664 @@
+"""
+Intensity histograms shared by the histogram-based threshold methods.
+
+An image is scanned once to build its histogram, then Otsu, Yen, Li,
+Isodata, Mean, Minimum and Triangle thresholds are all derived from it,
+instead of every skimage.filters function rebuilding the histogram from
+the full image. The histograms follow skimage.filters.histogram (one bin
+per value for integer images, 256 bins over the intensity range
+otherwise), so the thresholds are the ones skimage computes on the image.
+Li's threshold of float images, which is iterated on the intensities
+themselves, is refined with a few chunked passes over the image.
+The functions do not depend on napari or Qt; HistogramCache only relies on
+the events of the layer it is given.
+"""
+
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_manipulation_plugin.pyramids import full_resolution
+
+# number of voxels processed at once, bounds the size of the temporaries
+CHUNK_SIZE = 2**22
+
+# number of bins of float images (and of integers with a very large range)
+NBINS = 256
+
+# largest range of integer values counted exactly, one bin per value
+EXACT_LIMIT = 2**20
+
+# largest number of passes over a float image refining Li's threshold
+LI_MAX_PASSES = 50
+
+
+def _iter_chunks(image, chunk_size=None):
+    """Flat chunks of `image` along its first axis, loaded one at a time"""
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    if image.ndim == 0 or image.shape[0] == 0:
+        yield np.asarray(image).reshape(-1)
+        return
+    plane_size = int(np.prod(image.shape[1:]))
+    step = max(1, chunk_size // max(plane_size, 1))
+    for i0 in range(0, image.shape[0], step):
+        yield np.asarray(image[i0 : i0 + step]).reshape(-1)
+
+
+def _is_small_integer(dtype):
+    # the whole range of the dtype can be counted at once
+    return np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2
+
+
+def _is_exact(dtype, value_range):
+    return (
+        np.issubdtype(dtype, np.integer)
+        and value_range[1] - value_range[0] < EXACT_LIMIT
+    )
+
+
+def intensity_range(image):
+    """Minimum and maximum intensity of `image`, computed in chunks"""
+    low, high = None, None
+    for chunk in _iter_chunks(image):
+        if chunk.size == 0:
+            continue
+        chunk_low, chunk_high = chunk.min(), chunk.max()
+        low = chunk_low if low is None else min(low, chunk_low)
+        high = chunk_high if high is None else max(high, chunk_high)
+    return low, high
+
+
+class IntensityHistogram:
+    """
+    Histogram of the intensities of an image.
+
+    Attributes
+    ----------
+    counts : np.ndarray
+        Number of voxels in each bin.
+    bin_centers : np.ndarray
+        Intensity at the center of each bin. For integer images with one
+        bin per value, consecutive integers from the minimum to the maximum.
+    total : float
+        Sum of all intensities, for an exact mean.
+    exact : bool
+        Whether there is one bin per integer value.
+    """
+
+    def __init__(self, counts, bin_centers, total, exact):
+        self.counts = counts
+        self.bin_centers = bin_centers
+        self.total = total
+        self.exact = exact
+
+    def __repr__(self):
+        return f"{type(self).__name__}(nbins={len(self.counts)})"
+
+    @property
+    def size(self):
+        return int(self.counts.sum())
+
+    @property
+    def mean(self):
+        return self.total / self.size
+
+    @property
+    def range(self):
+        """Minimum and maximum intensity (bin centers of the non-empty bins)"""
+        occupied = np.flatnonzero(self.counts)
+        return (
+            self.bin_centers[occupied[0]],
+            self.bin_centers[occupied[-1]],
+        )
+
+    @property
+    def bin_width(self):
+        if len(self.bin_centers) < 2:
+            return 1.0
+        return float(self.bin_centers[1] - self.bin_centers[0])
+
+    def quantile(self, q):
+        """
+        Center of the first bin below which a fraction `q` (0 to 1) of the
+        voxels lie
+        """
+        cumulative = np.cumsum(self.counts)
+        target = max(1, int(np.ceil(q * cumulative[-1])))
+        return self.bin_centers[np.searchsorted(cumulative, target)]
+
+    def trimmed(self):
+        """Histogram without the empty bins at both ends"""
+        occupied = np.flatnonzero(self.counts)
+        if len(occupied) == 0:
+            return self
+        bins = slice(occupied[0], occupied[-1] + 1)
+        return type(self)(
+            self.counts[bins], self.bin_centers[bins], self.total, self.exact
+        )
+
+    @classmethod
+    def merge(cls, histograms):
+        """
+        Combine the histograms of several images (e.g. all timepoints of a
+        movie), which must share their bins unless they are all exact.
+        """
+        histograms = list(histograms)
+        total = sum(h.total for h in histograms)
+        if all(h.exact for h in histograms):
+            low = min(int(h.bin_centers[0]) for h in histograms)
+            high = max(int(h.bin_centers[-1]) for h in histograms)
+            counts = np.zeros(high - low + 1, dtype=np.int64)
+            for h in histograms:
+                start = int(h.bin_centers[0]) - low
+                counts[start : start + len(h.counts)] += h.counts
+            bin_centers = np.arange(low, high + 1)
+            return cls(counts, bin_centers, total, True)
+        counts = histograms[0].counts.copy()
+        for h in histograms[1:]:
+            if not np.array_equal(h.bin_centers, histograms[0].bin_centers):
+                raise ValueError("Histograms do not share their bins")
+            counts += h.counts
+        return cls(counts, histograms[0].bin_centers, total, False)
+
+
+def intensity_histogram(image, value_range=None, nbins=None):
+    """
+    Compute the intensity histogram of an image in a single pass (two if
+    the intensity range must be found first).
+
+    Parameters
+    ----------
+    image : array-like
+        Intensity image (np.ndarray, memmap or LazySequence).
+    value_range : tuple, optional
+        Minimum and maximum intensity covered by the bins, by default the
+        range of the image. Give the same range to histograms to merge.
+    nbins : int, optional
+        Number of bins for float images, NBINS by default.
+
+    Returns
+    -------
+    histogram : IntensityHistogram
+    """
+    if nbins is None:
+        nbins = NBINS
+    dtype = np.dtype(image.dtype)
+    total = 0.0
+
+    if value_range is None and _is_small_integer(dtype):
+        # count the whole range of the dtype, no need to find the range
+        offset = int(np.iinfo(dtype).min)
+        counts = np.zeros(2 ** (8 * dtype.itemsize), dtype=np.int64)
+        for chunk in _iter_chunks(image):
+            work = chunk.astype(np.int32) - offset if offset else chunk
+            counts += np.bincount(work, minlength=len(counts))
+            total += float(chunk.sum(dtype=np.float64))
+        bin_centers = np.arange(len(counts)) + offset
+        return IntensityHistogram(counts, bin_centers, total, True).trimmed()
+
+    if value_range is None:
+        value_range = intensity_range(image)
+    low, high = value_range
+    if low is None:
+        return IntensityHistogram(
+            np.zeros(0, dtype=np.int64), np.zeros(0), 0.0, True
+        )
+
+    if _is_exact(dtype, value_range):
+        low, high = int(low), int(high)
+        counts = np.zeros(high - low + 1, dtype=np.int64)
+        for chunk in _iter_chunks(image):
+            counts += np.bincount(
+                chunk.astype(np.int64) - low, minlength=len(counts)
+            )
+            total += float(chunk.sum(dtype=np.float64))
+        return IntensityHistogram(
+            counts, np.arange(low, high + 1), total, True
+        )
+
+    # same bins as np.histogram on the whole image
+    value_range = (float(low), float(high))
+    counts = np.zeros(nbins, dtype=np.int64)
+    for chunk in _iter_chunks(image):
+        counts += np.histogram(chunk, bins=nbins, range=value_range)[0]
+        total += float(chunk.sum(dtype=np.float64))
+    edges = np.histogram_bin_edges(np.zeros(0), bins=nbins, range=value_range)
+    bin_centers = (edges[:-1] + edges[1:]) / 2
+    return IntensityHistogram(counts, bin_centers, total, False)
+
+
+def _threshold_li(histogram):
+    """Li's minimum cross entropy threshold, iterated on the histogram"""
+    histogram = histogram.trimmed()
+    counts = histogram.counts.astype(np.float64)
+    # Li's algorithm requires positive intensities (because of log(mean))
+    low = histogram.bin_centers[0]
+    bin_centers = histogram.bin_centers - low
+    if len(counts) == 1:
+        return low
+    tolerance = 0.5 if histogram.exact else histogram.bin_width / 2
+    t_next = histogram.mean - low
+    t_curr = -2 * tolerance
+    while abs(t_next - t_curr) > tolerance:
+        t_curr = t_next
+        foreground = bin_centers > t_curr
+        background = ~foreground
+        mean_fore = np.average(
+            bin_centers[foreground], weights=counts[foreground]
+        )
+        mean_back = np.average(
+            bin_centers[background], weights=counts[background]
+        )
+        if mean_back == 0:
+            break
+        t_next = (mean_back - mean_fore) / (
+            np.log(mean_back) - np.log(mean_fore)
+        )
+    return t_next + low
+
+
+def _foreground_sums(image, threshold):
+    """
+    Number and sum of the intensities above `threshold`, and the minimum
+    intensity, computed in chunks
+    """
+    n_fore, sum_fore, low = 0, 0.0, None
+    for chunk in _iter_chunks(image):
+        if chunk.size == 0:
+            continue
+        foreground = chunk[chunk > threshold]
+        n_fore += len(foreground)
+        sum_fore += float(foreground.sum(dtype=np.float64))
+        chunk_low = float(chunk.min())
+        low = chunk_low if low is None else min(low, chunk_low)
+    return n_fore, sum_fore, low
+
+
+def threshold_li(image, histogram=None):
+    """
+    Li's minimum cross entropy threshold of an image, as computed by
+    skimage.filters.threshold_li.
+
+    The iterations start from the threshold of the histogram, which is
+    already exact for integer images. For float images, they go on with
+    the exact means of the intensities on both sides of the threshold, one
+    chunked pass over the image per iteration (usually two or three),
+    until the voxels above the threshold no longer change.
+
+    Parameters
+    ----------
+    image : array-like
+        Intensity image (np.ndarray, memmap or LazySequence).
+    histogram : IntensityHistogram, optional
+        Histogram of `image`, computed if not given.
+
+    Returns
+    -------
+    threshold : float
+    """
+    if histogram is None:
+        histogram = intensity_histogram(image)
+    t_next = _threshold_li(histogram)
+    if histogram.exact:
+        return t_next
+    size, total = histogram.size, histogram.total
+    previous = None
+    for _ in range(LI_MAX_PASSES):
+        n_fore, sum_fore, low = _foreground_sums(image, t_next)
+        if n_fore == previous or n_fore in (0, size):
+            # same voxels on both sides, the next threshold is the same
+            break
+        previous = n_fore
+        # Li's algorithm requires positive intensities (because of log(mean))
+        mean_fore = sum_fore / n_fore - low
+        mean_back = (total - sum_fore) / (size - n_fore) - low
+        if mean_back <= 0:
+            break
+        t_next = (mean_back - mean_fore) / (
+            np.log(mean_back) - np.log(mean_fore)
+        ) + low
+    return t_next
+
+
+def _threshold_triangle(histogram):
+    """Triangle threshold, computed as in skimage.filters"""
+    histogram = histogram.trimmed()
+    counts, bin_centers = histogram.counts, histogram.bin_centers
+    nbins = len(counts)
+    arg_peak_height = np.argmax(counts)
+    peak_height = float(counts[arg_peak_height])
+    arg_low_level, arg_high_level = np.flatnonzero(counts)[[0, -1]]
+    if arg_low_level == arg_high_level:
+        # Image has constant intensity.
+        return bin_centers[arg_low_level]
+
+    # Flip is True if left tail is shorter.
+    flip = arg_peak_height - arg_low_level < arg_high_level - arg_peak_height
+    if flip:
+        counts = counts[::-1]
+        arg_low_level = nbins - arg_high_level - 1
+        arg_peak_height = nbins - arg_peak_height - 1
+
+    width = float(arg_peak_height - arg_low_level)
+    x1 = np.arange(arg_peak_height - arg_low_level)
+    y1 = counts[x1 + arg_low_level]
+    norm = np.sqrt(peak_height**2 + width**2)
+    length = peak_height / norm * x1 - width / norm * y1
+    arg_level = np.argmax(length) + arg_low_level
+    if flip:
+        arg_level = nbins - arg_level - 1
+    return bin_centers[arg_level]
+
+
+def _skimage_method(name):
+    def threshold(histogram):
+        # scikit-image is slow to import, it is loaded on first use
+        from skimage import filters
+
+        histogram = histogram.trimmed()
+        function = getattr(filters, name)
+        return function(hist=(histogram.counts, histogram.bin_centers))
+
+    return threshold
+
+
+# threshold methods computed from an IntensityHistogram
+THRESHOLD_METHODS = {
+    "Otsu": _skimage_method("threshold_otsu"),
+    "Yen": _skimage_method("threshold_yen"),
+    "Li": _threshold_li,
+    "Isodata": _skimage_method("threshold_isodata"),
+    "Mean": lambda histogram: histogram.mean,
+    "Minimum": _skimage_method("threshold_minimum"),
+    "Triangle": _threshold_triangle,
+}
+
+
+def threshold_from_histogram(histogram, method, image=None):
+    """
+    Threshold of an image with one of THRESHOLD_METHODS, from its histogram
+
+    Parameters
+    ----------
+    histogram : IntensityHistogram
+    method : str
+        "Otsu", "Yen", "Li", "Isodata", "Mean", "Minimum" or "Triangle".
+    image : array-like, optional
+        Image of the histogram. Li's threshold of a float image is then
+        refined on the image (see `threshold_li`), otherwise it is only
+        iterated on the histogram, up to half a bin.
+
+    Returns
+    -------
+    threshold : float
+    """
+    if method == "Li" and image is not None:
+        return threshold_li(image, histogram)
+    return THRESHOLD_METHODS[method](histogram)
+
+
+def _try_threshold(histogram, method, image=None):
+    try:
+        return threshold_from_histogram(histogram, method, image)
+    except (RuntimeError, ValueError):
+        # e.g. the minimum method on a histogram with a single peak
+        return None
+
+
+def all_thresholds(histogram, methods=None, max_workers=None, image=None):
+    """
+    Thresholds of one histogram with several methods, computed
+    concurrently.
+
+    Parameters
+    ----------
+    histogram : IntensityHistogram
+    methods : list of str, optional
+        Keys of THRESHOLD_METHODS, all of them by default.
+    max_workers : int, optional
+        Number of threads, defaults to the ThreadPoolExecutor default.
+    image : array-like, optional
+        Image of the histogram, see `threshold_from_histogram`.
+
+    Returns
+    -------
+    thresholds : dict
+        {method: threshold}, None for the methods that failed.
+    """
+    if methods is None:
+        methods = sorted(THRESHOLD_METHODS)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        values = executor.map(
+            lambda method: _try_threshold(histogram, method, image), methods
+        )
+        return dict(zip(methods, values))
+
+
+class HistogramCache:
+    """
+    Intensity histograms and thresholds of a napari image layer.
+
+    Histograms are computed once per timepoint (4D layers) or once for the
+    whole image and reused by every threshold method, so that switching
+    methods does not scan the image again. The histogram of a whole movie
+    is merged from the ones of its timepoints. Replacing the layer data
+    drops the cache.
+
+    Use `histogram_cache` to get the cache of a layer.
+    """
+
+    def __init__(self, layer):
+        # the layer owns its cache, not the other way around
+        self._layer = weakref.ref(layer)
+        self._ranges = {}
+        self._histograms = {}
+        self._movie = None
+        self._thresholds = {}
+        # bumped when the data is replaced, so that histograms computed in
+        # the background from the old data are not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+        layer.events.data.connect(self._on_data)
+
+    @property
+    def layer(self):
+        return self._layer()
+
+    @property
+    def data(self):
+        """Full resolution data of the layer (first level if multiscale)"""
+        return full_resolution(self.layer)
+
+    @property
+    def per_timepoint(self):
+        return self.data.ndim == 4
+
+    @property
+    def n_frames(self):
+        """Number of frames with their own histogram (timepoints if 4D)"""
+        return self.data.shape[0] if self.per_timepoint else 1
+
+    def _keys(self, t=None):
+        if not self.per_timepoint:
+            return [None]
+        if t is None:
+            return list(range(self.data.shape[0]))
+        return [t]
+
+    def _frame_data(self, key):
+        data = self.data
+        return data if key is None else data[key]
+
+    def _threshold_data(self, t=None):
+        # image of `histogram(t)`, on which Li's threshold is refined
+        return self._frame_data(t if self.per_timepoint else None)
+
+    def _store(self, cache, key, value, generation):
+        with self._lock:
+            if generation == self._generation:
+                cache[key] = value
+
+    def _two_passes(self):
+        return self.per_timepoint and not _is_small_integer(self.data.dtype)
+
+    def n_steps(self, t=None, ranges_only=False):
+        """
+        Number of values yielded by `compute(t, ranges_only)`, for
+        progress bars
+        """
+        n_keys = len(self._keys(t))
+        if ranges_only or not (t is None and self._two_passes()):
+            return n_keys
+        return 2 * n_keys
+
+    def compute(self, t=None, ranges_only=False):
+        """
+        Compute the histograms needed for the thresholds of timepoint `t`
+        (of the whole layer by default), or only its intensity range,
+        yielding after each pass over a timepoint so that it can run in a
+        background worker.
+        """
+        generation = self._generation
+        keys = self._keys(t)
+        if ranges_only or (t is None and self._two_passes()):
+            for key in keys:
+                if key not in self._ranges:
+                    self._store(
+                        self._ranges,
+                        key,
+                        intensity_range(self._frame_data(key)),
+                        generation,
+                    )
+                yield
+            if ranges_only:
+                return
+        value_range = self._histogram_range(t)
+        for key in keys:
+            self._histogram(key, value_range, generation)
+            yield
+
+    def _histogram_range(self, t=None):
+        # bins of the histograms of the timepoints
+        if t is None and self._two_passes():
+            return self.range()
+        return None
+
+    def ready(self, t=None, ranges_only=False):
+        """
+        Whether `compute(t, ranges_only)` has nothing left to compute, so
+        that the statistics can be read in the GUI thread
+        """
+        keys = self._keys(t)
+        if ranges_only or (t is None and self._two_passes()):
+            if not all(key in self._ranges for key in keys):
+                return False
+            if ranges_only:
+                return True
+        value_range = self._histogram_range(t)
+        return all((key, value_range) in self._histograms for key in keys)
+
+    def _histogram(self, key, value_range=None, generation=None):
+        if generation is None:
+            generation = self._generation
+        if (key, value_range) not in self._histograms:
+            histogram = intensity_histogram(self._frame_data(key), value_range)
+            self._store(
+                self._histograms, (key, value_range), histogram, generation
+            )
+            if value_range is None and histogram.exact and histogram.size:
+                self._store(self._ranges, key, histogram.range, generation)
+            return histogram
+        return self._histograms[(key, value_range)]
+
+    def range(self, t=None):
+        """
+        Minimum and maximum intensity of timepoint `t` (of the whole layer
+        by default)
+        """
+        ranges = []
+        for key in self._keys(t):
+            if key not in self._ranges:
+                self._ranges[key] = intensity_range(self._frame_data(key))
+            ranges.append(self._ranges[key])
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+    def histogram(self, t=None):
+        """
+        Histogram of timepoint `t` of a 4D layer, or of the whole layer
+        (all timepoints merged) by default
+        """
+        if not self.per_timepoint:
+            return self._histogram(None)
+        if t is not None:
+            return self._histogram(t)
+        if self._movie is None:
+            value_range = self._histogram_range()
+            self._movie = IntensityHistogram.merge(
+                self._histogram(key, value_range) for key in self._keys()
+            )
+        return self._movie
+
+    def threshold(self, method, t=None):
+        """
+        Threshold of timepoint `t` (of the whole layer by default) with
+        one of THRESHOLD_METHODS
+        """
+        if (method, t) not in self._thresholds:
+            self._thresholds[(method, t)] = threshold_from_histogram(
+                self.histogram(t), method, self._threshold_data(t)
+            )
+        return self._thresholds[(method, t)]
+
+    def thresholds(self, t=None, methods=None):
+        """
+        Thresholds of timepoint `t` (of the whole layer by default) with
+        several methods (all by default), the missing ones being computed
+        concurrently from the same histogram. None for failed methods.
+        """
+        if methods is None:
+            methods = sorted(THRESHOLD_METHODS)
+        missing = [m for m in methods if (m, t) not in self._thresholds]
+        if missing:
+            computed = all_thresholds(
+                self.histogram(t), missing, image=self._threshold_data(t)
+            )
+            for method, value in computed.items():
+                if value is not None:
+                    self._thresholds[(method, t)] = value
+        return {
+            method: self._thresholds.get((method, t)) for method in methods
+        }
+
+    def quantile(self, q, t=None):
+        """
+        Intensity below which a fraction `q` (0 to 1) of the voxels of
+        timepoint `t` (of the whole layer by default) lie, up to a bin
+        """
+        return self.histogram(t).quantile(q)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._ranges.clear()
+            self._histograms.clear()
+            self._movie = None
+            self._thresholds.clear()
+
+    def _on_data(self, event=None):
+        self.invalidate()
+
+
+_caches = weakref.WeakKeyDictionary()
+
+
+def histogram_cache(layer):
+    """
+    Return the HistogramCache of a napari image layer, creating it and
+    connecting it to the layer events on first use.
+    """
+    if layer not in _caches:
+        _caches[layer] = HistogramCache(layer)
+    return _caches[layer]
@@ -1,3 +1,4 @@
+from qtpy.QtCore import QTimer
 from qtpy.QtWidgets import (
     QWidget,
     QPushButton,
@@ -5,31 +6,249 @@ from qtpy.QtWidgets import (
     QComboBox
 )
 from image_manipulation_plugin.utils import (
+    _get_dims_displayed,
+    _get_full_resolution,
     error_image_selection,
     error_tif_selection,
     error_mha_selection
 )
-from matplotlib import pyplot as plt
 from magicgui import widgets
 import numpy as np
 from napari import layers
-from tifffile import imread
-import glob
-from scipy.ndimage import sum_labels
-from medpy.io import load
-from skimage.filters import (
-threshold_otsu,
-threshold_yen,
-threshold_li,
-threshold_isodata,
-threshold_mean,
-try_all_threshold,
+from image_manipulation_plugin.intensity_histograms import histogram_cache
+from image_manipulation_plugin.label_dtypes import DTYPE_CHOICES, parse_dtype
+from image_manipulation_plugin.processing import (
+    iter_segment,
+    iter_segment_timepoints,
+    n_segment_steps,
+    n_segment_timepoints_steps,
 )
+from image_manipulation_plugin.pyramids import iter_pyramid
+from image_manipulation_plugin.pyramids import n_steps as n_pyramid_steps
+from image_manipulation_plugin.profiling import profile_handlers
+from image_manipulation_plugin.workers import BackgroundTasks
 
 
+def _output_path(file_edit):
+    """
+    Path of the file to write the labels to (.npy or .zarr), None to keep
+    them in memory
+    """
+    path = str(file_edit.value)
+    if path.endswith((".npy", ".zarr")):
+        return path
+    return None
+
+
+def _min_size(check, spin_box):
+    """Minimum size of the components if they are requested, else None"""
+    return spin_box.value if check.value else None
+
+
+def _iter_with_pyramid(labels, multiscale=False):
+    """
+    Multiscale pyramid of a labels image (list of levels) if `multiscale`,
+    else the image itself
+    """
+    if not multiscale:
+        return labels
+    levels = yield from iter_pyramid(labels, labels=True)
+    return levels
+
+
+def _n_steps(shape, min_size=None, multiscale=False, per_timepoint=False):
+    """Number of values yielded after the statistics, for progress bars"""
+    if per_timepoint:
+        n = n_segment_timepoints_steps(shape, min_size)
+    else:
+        n = n_segment_steps(shape, min_size)
+    if multiscale:
+        n += n_pyramid_steps(shape)
+    return n
+
+
+def _add_labels_layer(viewer, data, name):
+    """Add a labels layer, multiscale if `data` is a list of levels"""
+    viewer.add_labels(data, name=name, multiscale=isinstance(data, list))
+
+
+def _iter_threshold_image(
+    cache,
+    method,
+    below=False,
+    path=None,
+    min_size=None,
+    dtype=None,
+    multiscale=False,
+):
+    """
+    Threshold of the layer of a HistogramCache with `method` and the
+    resulting binary (or components) image, in the smallest dtype or in
+    `dtype`, with its multiscale pyramid if requested. The histogram is
+    only computed once per layer.
+    """
+    yield from cache.compute()
+    thresh = cache.threshold(method)
+    yield
+    image = cache.data
+    binary = yield from iter_segment(
+        image, thresh, below, min_size, path, dtype
+    )
+    binary = yield from _iter_with_pyramid(binary, multiscale)
+    return thresh, binary
+
+
+def _iter_threshold_timepoints(
+    image,
+    method,
+    below=False,
+    path=None,
+    min_size=None,
+    dtype=None,
+    multiscale=False,
+):
+    """
+    Thresholds of every timepoint of a 4D image with `method`, computed
+    frame by frame in parallel, and the resulting binary (or components)
+    image, with its multiscale pyramid if requested
+    """
+    thresholds, binary = yield from iter_segment_timepoints(
+        image, method, below=below, min_size=min_size, path=path, dtype=dtype
+    )
+    binary = yield from _iter_with_pyramid(binary, multiscale)
+    return thresholds, binary
+
+
+def _threshold_value(cache, percentile, value):
+    """
+    Intensity at `value` % of the maximum intensity of the layer of a
+    HistogramCache, or at its `value`th percentile
+    """
+    if percentile:
+        return cache.quantile(value / 100)
+    return cache.range()[1] * (value / 100)
+
+
+def _iter_manual_threshold(
+    cache,
+    percentile,
+    value,
+    below=False,
+    path=None,
+    min_size=None,
+    dtype=None,
+    multiscale=False,
+):
+    """
+    Threshold the layer of a HistogramCache at a percentage of its maximum
+    intensity or at a percentile, returns the absolute threshold and the
+    binary (or components) image. The statistics are only computed once
+    per layer.
+    """
+    yield from cache.compute(ranges_only=not percentile)
+    threshold_abs = _threshold_value(cache, percentile, value)
+    binary = yield from iter_segment(
+        cache.data, threshold_abs, below, min_size, path, dtype
+    )
+    binary = yield from _iter_with_pyramid(binary, multiscale)
+    return threshold_abs, binary
+
+
+# largest number of voxels of the live preview of ManualThresholding,
+# larger slices are downsampled
+PREVIEW_SIZE = 2**21
+
+# time (ms) without slider motion before the preview is updated
+PREVIEW_DELAY = 150
+
+
+def _displayed_region(viewer, layer):
+    """
+    Region of `layer` displayed in the viewer (see _preview_region), with
+    the scale and translation placing a preview of it onto the layer
+
+    Returns
+    -------
+    key : tuple of slices
+    scale, translate : np.ndarray
+    """
+    displayed = _get_dims_displayed(layer)
+    indices = np.round(layer.world_to_data(viewer.dims.point))
+    key, step = _preview_region(
+        _get_full_resolution(layer).shape, indices, displayed
+    )
+    scale = np.array(layer.scale)
+    scale[list(displayed)] *= step
+    translate = np.array(layer.translate) + np.array(
+        [k.start for k in key]
+    ) * np.array(layer.scale)
+    return key, scale, translate
+
+
+def _show_preview(viewer, preview, data, name, scale, translate, **kwargs):
+    """
+    Update the preview labels layer `preview`, or add it to the viewer if
+    it is None or was removed. Returns the preview layer.
+    """
+    if preview is None or preview not in viewer.layers:
+        return viewer.add_labels(
+            data,
+            name=name,
+            scale=scale,
+            translate=translate,
+            opacity=0.5,
+            **kwargs,
+        )
+    preview.data = data
+    preview.scale = scale
+    preview.translate = translate
+    for attribute, value in kwargs.items():
+        setattr(preview, attribute, value)
+    return preview
+
+
+def _preview_region(shape, indices, displayed, max_size=None):
+    """
+    Region of an image shown in the viewer: the `displayed` axes, with a
+    common step so that it has at most `max_size` voxels, at `indices`
+    along the other axes.
+
+    Returns
+    -------
+    key : tuple of slices
+    step : int
+    """
+    if max_size is None:
+        max_size = PREVIEW_SIZE
+    size = np.prod([shape[axis] for axis in displayed])
+    step = int(np.ceil((size / max_size) ** (1 / len(displayed))))
+    step = max(step, 1)
+    key = []
+    for axis, length in enumerate(shape):
+        if axis in displayed:
+            key.append(slice(0, length, step))
+        else:
+            index = int(np.clip(indices[axis], 0, length - 1))
+            key.append(slice(index, index + 1))
+    return tuple(key), step
+
+
+def _iter_all_thresholds(cache, t=None):
+    """
+    Thresholds of timepoint `t` (of the whole layer by default) of the
+    layer of a HistogramCache with all methods (None if a method fails),
+    computed concurrently from the same histogram
+    """
+    yield from cache.compute(t)
+    return cache.thresholds(t)
+
+
+@profile_handlers
 class ThresholdLabels(QWidget):
     """
-    This class creates labels using a chosen thresholding method given an intensity image
+    This class compares all thresholding methods on an intensity image. The thresholds are computed from one
+    histogram (of the selected time frame for 4D images), listed in a table and shown as one preview labels
+    layer per method on the displayed slice.
     """
 
     # Name that will be displayed
@@ -43,21 +262,62 @@ class ThresholdLabels(QWidget):
             return
         # only run function if the selected layer is an intensity image
         if isinstance(self.viewer.layers.selection.active, layers.Image):
-            import matplotlib.pyplot as plt
-            image = image.data
-            fig, _ = try_all_threshold(image, figsize=(10, 8), verbose=False)
-            try:
-                plt.show()
-            except Exception:
-                # If a backend issue occurs, close the figure to avoid a resource leak
-                plt.close(fig)
+            cache = histogram_cache(image)
+            # the previews are computed on the slice displayed at the click
+            key, scale, translate = _displayed_region(self.viewer, image)
+            t = key[0].start if cache.per_timepoint else None
+            # thresholds are computed in the background, the previews are
+            # added in the GUI thread
+            self.tasks.start(
+                _iter_all_thresholds,
+                cache,
+                t,
+                returned=lambda thresholds: self._show_thresholds(
+                    image, t, key, scale, translate, thresholds
+                ),
+                desc="Testing all thresholds",
+                total=cache.n_steps(t),
+            )
         else:
             self.count.value = "Careful, this is not an intensty image."
 
+    def _show_thresholds(self, layer, t, key, scale, translate, thresholds):
+        region = np.asarray(_get_full_resolution(layer)[key])
+        for i, (method, thresh) in enumerate(thresholds.items()):
+            if thresh is None:
+                preview = np.zeros(region.shape, dtype=np.uint8)
+            else:
+                preview = (region > thresh).astype(np.uint8)
+            # only the first preview is visible, toggle the others to compare
+            self.previews[method] = _show_preview(
+                self.viewer,
+                self.previews.get(method),
+                preview,
+                f"{method} threshold",
+                scale,
+                translate,
+                visible=i == 0,
+            )
+        if self.viewer.layers.selection.active in self.previews.values():
+            self.viewer.layers.selection.active = layer
+
+        self.table.value = {
+            "data": [
+                ["failed" if thresh is None else f"{thresh:.4g}"]
+                for thresh in thresholds.values()
+            ],
+            "index": list(thresholds),
+            "columns": ["Threshold"],
+        }
+        where = "the image" if t is None else f"time frame {t}"
+        self.count.value = f"Thresholds of {where},\ntoggle the preview layers to compare them"
+
     def __init__(self, napari_viewer):
         super().__init__()
 
         self.viewer = napari_viewer
+        # preview layer of each method, reused by the next comparison
+        self.previews = {}
 
         btn = QPushButton("Test all thresholds")
         btn.native = btn
@@ -66,13 +326,21 @@ class ThresholdLabels(QWidget):
         self.setLayout(QHBoxLayout())
         self.layout().addWidget(btn)
         self.count = widgets.Label(value="")
+        self.table = widgets.Table(
+            value={"data": [], "index": [], "columns": ["Threshold"]}
+        )
+        self.table.read_only = True
+        self.tasks = BackgroundTasks(self.count)
 
-        container = widgets.Container(widgets=[self.count], labels=False)
+        container = widgets.Container(
+            widgets=[self.count, self.table, self.tasks.btn_cancel], labels=False
+        )
 
         self.setLayout(QHBoxLayout())
         self.layout().addWidget(container.native)
 
 
+@profile_handlers
 class ApplyThresholdOfChoice(QWidget):
     """
     This class allows selection of thresholding method to create labels from an intensity image
@@ -89,27 +357,65 @@ class ApplyThresholdOfChoice(QWidget):
             return
         # only run function if the selected layer is an intensity image
         if isinstance(self.viewer.layers.selection.active, layers.Image):
-            image = image.data
+            # the histogram is computed once, changing the method only
+            # costs the thresholding itself
+            cache = histogram_cache(image)
             method = str(self.threshold.value)
-            if method == "Otsu":
-                thresh = threshold_otsu(image)
-            elif method == "Yen":
-                thresh = threshold_yen(image)
-            elif method == "Li":
-                thresh = threshold_li(image)
-            elif method == "Isodata":
-                thresh = threshold_isodata(image)
-            elif method == "Mean":
-                thresh = threshold_mean(image)
-            if self.image_type.value == "electron micriscopy":
-                binary = image < thresh
-            if self.image_type.value == "light microscopy":
-                binary = image > thresh
-            self.viewer.add_labels(binary.astype(int), name="Labels")
-            self.output_str.value = f"Labels created using {method} threshold at {thresh:.2f}"
+            below = self.image_type.value == "electron micriscopy"
+            min_size = _min_size(self.components, self.min_size)
+            if self.per_timepoint.value and cache.per_timepoint:
+                # every frame gets its own threshold, which follows
+                # illumination drifts
+                self.tasks.start(
+                    _iter_threshold_timepoints,
+                    cache.data,
+                    method,
+                    below,
+                    _output_path(self.output_file),
+                    min_size,
+                    parse_dtype(self.dtype.value),
+                    self.multiscale.value,
+                    returned=lambda result: self._add_labels_timepoints(
+                        method, *result
+                    ),
+                    desc=f"Thresholding every time frame with {method}",
+                    total=_n_steps(
+                        cache.data.shape,
+                        min_size,
+                        self.multiscale.value,
+                        per_timepoint=True,
+                    ),
+                )
+                return
+            self.tasks.start(
+                _iter_threshold_image,
+                cache,
+                method,
+                below,
+                _output_path(self.output_file),
+                min_size,
+                parse_dtype(self.dtype.value),
+                self.multiscale.value,
+                returned=lambda result: self._add_labels(method, *result),
+                desc=f"Thresholding with {method}",
+                total=cache.n_steps()
+                + 1
+                + _n_steps(cache.data.shape, min_size, self.multiscale.value),
+            )
         else:
             self.output_str.value = "Careful, the selected image is not an intensity image."
 
+    def _add_labels(self, method, thresh, binary):
+        _add_labels_layer(self.viewer, binary, "Labels")
+        self.output_str.value = f"Labels created using {method} threshold at {thresh:.2f}"
+
+    def _add_labels_timepoints(self, method, thresholds, binary):
+        _add_labels_layer(self.viewer, binary, "Labels")
+        self.output_str.value = (
+            f"Labels created using {method} thresholds of each time frame,\n"
+            f"from {thresholds.min():.2f} to {thresholds.max():.2f}"
+        )
+
     def __init__(self, napari_viewer):
         super().__init__()
 
@@ -126,68 +432,222 @@ class ApplyThresholdOfChoice(QWidget):
         btn1.name = "Create labels image"
         btn1.clicked.connect(self._on_click_threshold_image)
         self.output_str = widgets.Label(value="")
+        self.tasks = BackgroundTasks(self.output_str)
+        self.output_file_label = widgets.Label(value="")
+        self.output_file_label.value = "write labels to file (optional, .npy or .zarr)"
+        self.output_file = widgets.FileEdit(mode="w", filter="*.npy *.zarr")
+        self.components = widgets.CheckBox(value=False, text="split into connected components")
+        self.min_size_label = widgets.Label(value="")
+        self.min_size_label.value = "minimum component size (voxels)"
+        self.min_size = widgets.SpinBox(min=0, max=2**31 - 1, value=0)
+        self.dtype_label = widgets.Label(value="")
+        self.dtype_label.value = "labels dtype (auto: smallest that fits)"
+        self.dtype = widgets.ComboBox(choices=DTYPE_CHOICES)
+        self.multiscale = widgets.CheckBox(value=False, text="multiscale pyramid (faster rendering)")
+        self.per_timepoint = widgets.CheckBox(value=False, text="threshold each time frame separately")
 
         container = widgets.Container(widgets=[self.threshold_label,
                                                self.threshold,
                                                self.image_type_label,
                                                self.image_type,
+                                               self.per_timepoint,
+                                               self.components,
+                                               self.min_size_label,
+                                               self.min_size,
+                                               self.dtype_label,
+                                               self.dtype,
+                                               self.multiscale,
+                                               self.output_file_label,
+                                               self.output_file,
                                                self.output_str,
-                                               btn1   
+                                               btn1,
+                                               self.tasks.btn_cancel,
                                                ], labels=False)
 
         self.setLayout(QHBoxLayout())
         self.layout().addWidget(container.native)
 
 
+@profile_handlers
 class ManualThresholding(QWidget):
     """
     This class creates a labels image by thresholding an intensity image according to a manually provided intensity value.
-    Each time the user moves the slider, the labels image is updated.
+    With live preview, a single preview layer is updated as the user moves the slider, showing the thresholded
+    displayed slice (downsampled if large). The full image is only thresholded when clicking the button.
     """
 
     # Name that will be displayed on the combobox
     name = "Manual thresholding"
 
+    def _source_layer(self):
+        """Intensity layer to threshold, kept while the preview is selected"""
+        layer = self.viewer.layers.selection.active
+        if isinstance(layer, layers.Image):
+            self._source = layer
+        elif self._source is not None and self._source not in self.viewer.layers:
+            self._source = None
+        return self._source
+
+    def _statistics_ready(self, cache, percentile):
+        """
+        Start computing the intensity statistics of the whole layer in the
+        background if they are not cached yet, return whether they are
+        """
+        if cache.ready(ranges_only=not percentile):
+            return True
+        self.tasks.start(
+            cache.compute,
+            ranges_only=not percentile,
+            returned=lambda _: self._update_preview(),
+            desc="Computing intensity statistics",
+            total=cache.n_steps(ranges_only=not percentile),
+        )
+        return False
+
+    def _schedule_preview(self, event=None):
+        # the preview is only computed once the slider stops moving
+        if self.live.value:
+            self._timer.start()
+        else:
+            self._remove_preview()
+
+    def _update_preview(self):
+        layer = self._source_layer()
+        if layer is None or not self.live.value:
+            return
+        cache = histogram_cache(layer)
+        percentile = self.mode.value == "percentile"
+        if not self._statistics_ready(cache, percentile):
+            return
+        threshold_abs = _threshold_value(cache, percentile, self.btn.value)
+
+        # the preview is placed on the slice it was computed from
+        key, scale, translate = _displayed_region(self.viewer, layer)
+        compare = np.less if self.check.value else np.greater
+        preview = compare(
+            np.asarray(_get_full_resolution(layer)[key]), threshold_abs
+        )
+        self._preview = _show_preview(
+            self.viewer,
+            self._preview,
+            preview.astype(np.uint8),
+            "Threshold preview",
+            scale,
+            translate,
+        )
+        # adding the preview selected it
+        if self.viewer.layers.selection.active is self._preview:
+            self.viewer.layers.selection.active = layer
+        self.message.value = f"Preview at {threshold_abs:.2f}"
+
+    def _remove_preview(self):
+        if self._preview is not None and self._preview in self.viewer.layers:
+            self.viewer.layers.remove(self._preview)
+        self._preview = None
+
     def _on_click_threshold(self):
         # Get the selected image (make sure that it isn't none)
         image = self.viewer.layers.selection.active
+        if image is not None and image is self._preview:
+            image = self._source
         if image is None:
             error_image_selection()
             return
-        if isinstance(self.viewer.layers.selection.active, layers.Image):
-            image = image.data
+        if isinstance(image, layers.Image):
+            cache = histogram_cache(image)
             threshold_perc = self.btn.value
-            threshold_abs = np.max(image) * (threshold_perc / 100)
-            self.message.value = f"Thresholding at {threshold_abs:.2f} ({threshold_perc} % of max intensity)"
-            if self.check.value == False:
-                binary = image > threshold_abs
-                self.viewer.add_labels(binary.astype(int), name=f"Labels_{threshold_perc}%")
-            else:
-                binary = image < threshold_abs            
-                self.viewer.add_labels(binary.astype(int), name=f"Labels_{threshold_perc}%_inverted")
+            percentile = self.mode.value == "percentile"
+            inverted = self.check.value
+            min_size = _min_size(self.components, self.min_size)
+            self.tasks.start(
+                _iter_manual_threshold,
+                cache,
+                percentile,
+                threshold_perc,
+                inverted,
+                _output_path(self.output_file),
+                min_size,
+                parse_dtype(self.dtype.value),
+                self.multiscale.value,
+                returned=lambda result: self._add_labels(
+                    threshold_perc, percentile, inverted, *result
+                ),
+                desc=f"Thresholding at {threshold_perc} {self.mode.value}",
+                total=cache.n_steps(ranges_only=not percentile)
+                + _n_steps(cache.data.shape, min_size, self.multiscale.value),
+            )
 
         else:
             self.message.value = "Careful, this is not an intensity image."
 
+    def _add_labels(self, threshold_perc, percentile, inverted, threshold_abs, binary):
+        if percentile:
+            self.message.value = f"Thresholding at {threshold_abs:.2f} ({threshold_perc}th percentile)"
+            name = f"Labels_p{threshold_perc}"
+        else:
+            self.message.value = f"Thresholding at {threshold_abs:.2f} ({threshold_perc} % of max intensity)"
+            name = f"Labels_{threshold_perc}%"
+        if inverted:
+            _add_labels_layer(self.viewer, binary, f"{name}_inverted")
+        else:
+            _add_labels_layer(self.viewer, binary, name)
+
     def __init__(self, napari_viewer):
         super().__init__()
         self.viewer = napari_viewer
+        self._source = None
+        self._preview = None
 
         self.btn = widgets.Slider(min=0, max=100, step=1, value=50)
-        self.btn.name = "Threshold value (in % of max intensity)"
+        self.btn.name = "Threshold value (in % of max intensity or percentile)"
+        self.mode = widgets.ComboBox(choices=["% of max intensity", "percentile"])
         self.message = widgets.Label(value="")
         btn1 = QPushButton("threshold image")
         btn1.native = btn1
         btn1.name = "Create labels image"
         btn1.clicked.connect(self._on_click_threshold)
         self.check = widgets.CheckBox(value=False, text='invert thresholding (EM)')
+        self.live = widgets.CheckBox(value=False, text="live preview")
+        self.output_file_label = widgets.Label(value="")
+        self.output_file_label.value = "write labels to file (optional, .npy or .zarr)"
+        self.output_file = widgets.FileEdit(mode="w", filter="*.npy *.zarr")
+        self.components = widgets.CheckBox(value=False, text="split into connected components")
+        self.min_size_label = widgets.Label(value="")
+        self.min_size_label.value = "minimum component size (voxels)"
+        self.min_size = widgets.SpinBox(min=0, max=2**31 - 1, value=0)
+        self.dtype_label = widgets.Label(value="")
+        self.dtype_label.value = "labels dtype (auto: smallest that fits)"
+        self.dtype = widgets.ComboBox(choices=DTYPE_CHOICES)
+        self.multiscale = widgets.CheckBox(value=False, text="multiscale pyramid (faster rendering)")
+        self.tasks = BackgroundTasks(self.message)
+
+        # debounce the preview while the slider or the slice changes
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(PREVIEW_DELAY)
+        self._timer.timeout.connect(self._update_preview)
+        for control in [self.btn, self.mode, self.check, self.live]:
+            control.changed.connect(self._schedule_preview)
+        self.viewer.dims.events.current_step.connect(self._schedule_preview)
+        self.viewer.dims.events.ndisplay.connect(self._schedule_preview)
 
         container = widgets.Container(
             widgets=[
                 self.btn,
+                self.mode,
                 btn1,
                 self.check,
-                self.message
+                self.live,
+                self.components,
+                self.min_size_label,
+                self.min_size,
+                self.dtype_label,
+                self.dtype,
+                self.multiscale,
+                self.output_file_label,
+                self.output_file,
+                self.message,
+                self.tasks.btn_cancel,
             ],
             labels=False,
         )
@@ -0,0 +1,100 @@
+"""
+Data types of the labels images created by the plugin.
+
+New labels images get the smallest unsigned integer type holding their
+largest ID (uint8, uint16 or uint32) instead of int64, which divides
+their memory and the size of the textures napari uploads to the GPU by
+up to 8. The widgets let the user override the automatic choice.
+The functions do not depend on napari or Qt.
+"""
+
+import numpy as np
+
+# automatic choice first, then the dtypes the user can force
+DTYPE_CHOICES = ("auto", "uint8", "uint16", "uint32")
+
+# unsigned dtypes tried for new labels images, smallest first
+UNSIGNED_DTYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+# signed dtypes, only used if there are negative IDs
+SIGNED_DTYPES = (np.int8, np.int16, np.int32, np.int64)
+
+
+def parse_dtype(choice):
+    """dtype chosen in a widget, None for the automatic choice"""
+    if choice is None or str(choice) == "auto":
+        return None
+    return np.dtype(str(choice))
+
+
+def compact_dtype(max_label, min_label=0):
+    """
+    Smallest unsigned integer dtype holding the IDs up to `max_label`
+    (the smallest signed one if `min_label` is negative)
+    """
+    candidates = SIGNED_DTYPES if min_label < 0 else UNSIGNED_DTYPES
+    for dtype in candidates:
+        info = np.iinfo(dtype)
+        if info.min <= min_label and max_label <= info.max:
+            return np.dtype(dtype)
+    raise ValueError(f"Labels {min_label}..{max_label} do not fit in 64 bits")
+
+
+def check_dtype(dtype, max_label, min_label=0):
+    """Raise a ValueError if the IDs do not fit in a dtype chosen by hand"""
+    info = np.iinfo(dtype)
+    if min_label < info.min or max_label > info.max:
+        raise ValueError(
+            f"Labels {min_label}..{max_label} do not fit in {np.dtype(dtype)}"
+        )
+
+
+def cast_labels(frame, dtype):
+    """
+    Cast an in-memory frame of labels to `dtype`, raising a ValueError
+    (see `check_dtype`) instead of wrapping the IDs that do not fit in an
+    integer dtype, e.g. for files decoded one at a time
+    """
+    frame = np.asarray(frame)
+    dtype = np.dtype(dtype)
+    if frame.dtype == dtype:
+        return frame
+    if (
+        np.issubdtype(dtype, np.integer)
+        and frame.size
+        and not np.can_cast(frame.dtype, dtype)
+    ):
+        check_dtype(dtype, int(frame.max()), int(frame.min()))
+    return frame.astype(dtype)
+
+
+def compact_labels(image, dtype=None):
+    """
+    Labels image in the smallest dtype holding its IDs, or in `dtype`.
+
+    Floating point images are truncated to integers. The image is returned
+    as it is if it already has the right dtype, and arrays backed by a file
+    (memory-mapped .npy, Zarr, LazySequence) are never copied to memory.
+
+    Parameters
+    ----------
+    image : array-like
+    dtype : np.dtype, optional
+        Forced dtype, the automatic choice by default.
+
+    Returns
+    -------
+    labels : array-like
+    """
+    if not isinstance(image, np.ndarray) or isinstance(image, np.memmap):
+        return image
+    if image.size == 0:
+        return image.astype(dtype or np.uint8)
+    min_label, max_label = int(image.min()), int(image.max())
+    if dtype is None:
+        dtype = compact_dtype(max_label, min_label)
+    else:
+        check_dtype(dtype, max_label, min_label)
+    if image.dtype == dtype:
+        return image
+    return image.astype(dtype)
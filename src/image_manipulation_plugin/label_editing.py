@@ -0,0 +1,442 @@
+"""
+In-place editing of label images.
+
+Edits are restricted to the bounding boxes of the labels involved (see
+image_manipulation_plugin.label_statistics), and large boxes are processed
+in blocks, so that no temporary array is as large as the image. Edits can
+be recorded in an EditHistory, which only keeps the changed voxels.
+The functions do not depend on napari or Qt. Their `iter_` variants
+yield after each bounding box, to report progress and allow cancellation
+when run in a background worker.
+"""
+
+import re
+
+import numpy as np
+
+from image_manipulation_plugin.generators import exhaust
+
+# number of voxels processed at once, bounds the size of the temporaries
+CHUNK_SIZE = 2**22
+
+
+def _iter_blocks(box, shape, chunk_size=None):
+    """
+    Split a bounding box (tuple of slices) into blocks of at most
+    `chunk_size` voxels (or a single plane) along its first long axis.
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    box = tuple(box) + (slice(None),) * (len(shape) - len(box))
+    ranges = [s.indices(length) for s, length in zip(box, shape)]
+    box = tuple(slice(start, max(start, stop)) for start, stop, _ in ranges)
+    lengths = [max(0, stop - start) for start, stop, _ in ranges]
+    long_axes = [axis for axis, length in enumerate(lengths) if length > 1]
+    if not long_axes:
+        yield box
+        return
+    axis = long_axes[0]
+    plane_size = int(np.prod(lengths[axis + 1 :]))
+    step = max(1, chunk_size // max(plane_size, 1))
+    start, stop, _ = ranges[axis]
+    for i0 in range(start, stop, step):
+        yield box[:axis] + (slice(i0, min(i0 + step, stop)),) + box[axis + 1 :]
+
+
+def check_writable(image):
+    """
+    Raise a ValueError if `image` cannot be edited in place, e.g. frames
+    read lazily from files or a Zarr array opened read-only
+    """
+    if isinstance(image, np.ndarray):
+        writable = image.flags.writeable
+    else:
+        writable = hasattr(type(image), "__setitem__") and not getattr(
+            image, "read_only", False
+        )
+    if not writable:
+        raise ValueError(
+            "These labels are read-only, they can only be changed in a copy."
+        )
+
+
+def _write_back(image, block, region):
+    """
+    Store an edited region. The regions of numpy arrays are views already
+    written in place, those of lazy or chunked arrays are copies.
+    """
+    if not isinstance(image, np.ndarray):
+        image[block] = region
+
+
+class EditRecord:
+    """
+    Changes made by one in-place edit, stored as the flat indices of the
+    changed voxels within each processed block and their old and new
+    values (a single number when all of them are equal, as in a relabel).
+    Its size is proportional to the number of changed voxels only.
+    """
+
+    def __init__(self, description=""):
+        self.description = description
+        self.atoms = []
+
+    def __len__(self):
+        return sum(len(indices) for _, indices, _, _ in self.atoms)
+
+    @property
+    def nbytes(self):
+        return sum(
+            indices.nbytes + np.asarray(old).nbytes + np.asarray(new).nbytes
+            for _, indices, old, new in self.atoms
+        )
+
+    def add(self, block, region, changed, new_values, old_values=None):
+        """
+        Record the voxels of `region` (the view of `image[block]`) selected
+        by the boolean mask `changed`, once `new_values` are written.
+        `region` must then hold the old values, unless `old_values` are
+        given (when they are all the same).
+        """
+        indices = np.flatnonzero(changed)
+        if len(indices) == 0:
+            return
+        indices = indices.astype(np.min_scalar_type(region.size))
+        if old_values is None:
+            old_values = np.ravel(region)[indices]
+        if np.ndim(new_values) > 0:
+            new_values = np.ravel(new_values)[indices]
+        self.atoms.append((block, indices, old_values, new_values))
+
+    def check(self, image, undo=True):
+        """
+        Raise a ValueError if the voxels of the record no longer hold the
+        values the edit wrote (undo) or found (redo), e.g. because they
+        were painted over since.
+        """
+        for block, indices, old_values, new_values in self.atoms:
+            current = np.ravel(image[block])[indices]
+            expected = new_values if undo else old_values
+            if not np.array_equal(
+                current, np.broadcast_to(expected, current.shape)
+            ):
+                action = "undone" if undo else "redone"
+                raise ValueError(
+                    f"The labels were changed since the {self.description},"
+                    f" it cannot be {action}."
+                )
+
+    def apply(self, image, undo=True):
+        """Write back the old (undo) or new (redo) values into `image`"""
+        atoms = reversed(self.atoms) if undo else self.atoms
+        for block, indices, old_values, new_values in atoms:
+            region = image[block]
+            region.flat[indices] = old_values if undo else new_values
+            _write_back(image, block, region)
+
+    def changes(self):
+        """
+        Coordinates (shape (ndim, n_voxels)), old and new values of all
+        changed voxels, e.g. to update label statistics
+        """
+        coordinates, old, new = [], [], []
+        for block, indices, old_values, new_values in self.atoms:
+            shape = [s.stop - s.start for s in block]
+            local = np.array(np.unravel_index(indices, shape))
+            offset = np.array([s.start for s in block])[:, None]
+            coordinates.append(local + offset)
+            old.append(np.broadcast_to(old_values, len(indices)))
+            new.append(np.broadcast_to(new_values, len(indices)))
+        if not coordinates:
+            return np.zeros((0, 0), dtype=np.int64), np.zeros(0), np.zeros(0)
+        return (
+            np.concatenate(coordinates, axis=1),
+            np.concatenate(old),
+            np.concatenate(new),
+        )
+
+
+class EditHistory:
+    """
+    Undo/redo stack of EditRecords for in-place edits of one image.
+
+    Parameters
+    ----------
+    max_records : int
+        Number of edits that can be undone, the oldest are dropped.
+    """
+
+    def __init__(self, max_records=20):
+        self.max_records = max_records
+        self._undo = []
+        self._redo = []
+
+    @property
+    def can_undo(self):
+        return len(self._undo) > 0
+
+    @property
+    def can_redo(self):
+        return len(self._redo) > 0
+
+    @property
+    def nbytes(self):
+        return sum(record.nbytes for record in self._undo + self._redo)
+
+    def push(self, record):
+        """Add the record of a new edit, which clears the redo stack"""
+        if not record.atoms:
+            return
+        self._undo.append(record)
+        self._redo.clear()
+        del self._undo[: -self.max_records]
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+
+    def undo(self, image):
+        """
+        Revert the last edit of `image`, returns its record (or None).
+        Raises a ValueError, keeping the history, if the edited voxels
+        were changed since (see `EditRecord.check`).
+        """
+        if not self._undo:
+            return None
+        self._undo[-1].check(image, undo=True)
+        record = self._undo.pop()
+        record.apply(image, undo=True)
+        self._redo.append(record)
+        return record
+
+    def redo(self, image):
+        """
+        Apply the last undone edit again, returns its record (or None),
+        see `undo`
+        """
+        if not self._redo:
+            return None
+        self._redo[-1].check(image, undo=False)
+        record = self._redo.pop()
+        record.apply(image, undo=False)
+        self._undo.append(record)
+        return record
+
+
+def relabel(image, label1, label2, boxes, record=None):
+    """
+    Change `label1` to `label2` in place, only looking inside `boxes`.
+
+    Parameters
+    ----------
+    image : array-like
+        Labels image, modified in place: an np.ndarray or any array
+        supporting item assignment, such as a writable Zarr array.
+    label1, label2 : int
+        Label to change and its new value.
+    boxes : iterable of tuple of slices
+        Regions of `image` containing all voxels of `label1` to change,
+        typically the bounding boxes of the label.
+    record : EditRecord, optional
+        Record the changed voxels to be able to undo the edit.
+
+    Returns
+    -------
+    n_changed : int
+        Number of voxels changed.
+
+    Raises
+    ------
+    ValueError
+        If `image` is read-only (see `check_writable`), or if `label2`
+        does not fit in its dtype.
+    """
+    return exhaust(iter_relabel(image, label1, label2, boxes, record))
+
+
+def iter_relabel(image, label1, label2, boxes, record=None):
+    """
+    Generator version of `relabel`, yielding after each box and returning
+    the number of voxels changed.
+    """
+    check_writable(image)
+    # raise before touching the image, numpy would wrap or overflow
+    _check_values_fit(image.dtype, [label2])
+    n_changed = 0
+    for box in boxes:
+        for block in _iter_blocks(box, image.shape):
+            region = image[block]
+            mask = region == label1
+            if not mask.any():
+                continue
+            region[mask] = label2
+            _write_back(image, block, region)
+            # only recorded once written, a failed write leaves no trace
+            if record is not None:
+                record.add(block, region, mask, label2, old_values=label1)
+            n_changed += int(np.count_nonzero(mask))
+        yield
+    return n_changed
+
+
+# largest label ID remapped with a dense lookup table, beyond it the
+# mapping is applied with a binary search over its keys
+LUT_LIMIT = 2**24
+
+
+def parse_mapping(text):
+    """
+    Parse a label mapping pasted as a table or read from a CSV file.
+
+    Every line holds an old and a new label, separated by a comma,
+    semicolon, tab, spaces or "->". Empty lines, lines starting with "#"
+    and a header line are ignored.
+
+    Returns
+    -------
+    mapping : dict
+        {old_label: new_label}
+    """
+    mapping = {}
+    for line_number, line in enumerate(text.splitlines()):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = re.split(r"\s*(?:->|[,;\t]|\s)\s*", line)
+        try:
+            old, new = (int(field) for field in fields if field)
+        except ValueError:
+            if line_number == 0:
+                # header
+                continue
+            raise ValueError(f"Cannot read line {line_number + 1}: {line!r}")
+        mapping[old] = new
+    return mapping
+
+
+def sequential_mapping(labels, background=0):
+    """
+    Mapping giving the labels consecutive IDs 1, 2, ... (in increasing
+    order), the background keeps its value.
+    """
+    labels = [label for label in np.unique(labels) if label != background]
+    return {int(label): i for i, label in enumerate(labels, start=1)}
+
+
+def compose_mappings(first, second, labels):
+    """
+    Mapping equivalent to applying `first` then `second` to `labels`
+    """
+    composed = {}
+    for label in np.asarray(labels).tolist():
+        intermediate = first.get(label, label)
+        composed[label] = second.get(intermediate, intermediate)
+    return composed
+
+
+def _check_values_fit(dtype, values):
+    if not np.issubdtype(dtype, np.integer) or len(values) == 0:
+        return
+    info = np.iinfo(dtype)
+    if min(values) < info.min or max(values) > info.max:
+        raise ValueError(
+            f"New labels {min(values)}..{max(values)} do not fit in {dtype}"
+        )
+
+
+def remap_labels(image, mapping, boxes=None, out=None, record=None):
+    """
+    Apply a label mapping in a single pass over the image.
+
+    Labels missing from the mapping are kept. The mapping is applied
+    simultaneously, so swaps such as {1: 2, 2: 1} work. IDs up to
+    LUT_LIMIT are remapped with a lookup table (`lut[image]`), larger or
+    negative IDs with a binary search over the mapping keys.
+
+    Parameters
+    ----------
+    image : array-like
+        Labels image.
+    mapping : dict
+        {old_label: new_label}
+    boxes : iterable of tuple of slices, optional
+        Restrict the remapping to these regions (e.g. one timepoint).
+    out : array-like, optional
+        Output array, may be `image` itself to remap in place (see
+        `check_writable`). By default a new np.ndarray is created, with a
+        dtype large enough for the new labels.
+    record : EditRecord, optional
+        Record the changed voxels of `out` to be able to undo the edit.
+
+    Returns
+    -------
+    out : np.ndarray
+    """
+    return exhaust(iter_remap_labels(image, mapping, boxes, out, record))
+
+
+def iter_remap_labels(image, mapping, boxes=None, out=None, record=None):
+    """
+    Generator version of `remap_labels`, yielding after each box and
+    returning the output array.
+    """
+    keys = np.array(sorted(mapping), dtype=np.int64)
+    values = np.array([mapping[key] for key in keys], dtype=np.int64)
+    if out is None:
+        dtype = image.dtype
+        if len(values):
+            dtype = np.result_type(dtype, np.min_scalar_type(values.min()))
+            dtype = np.result_type(dtype, np.min_scalar_type(values.max()))
+        # lazy or chunked images are read once, into the copy
+        loaded = np.asarray(image)
+        out = loaded.astype(dtype, copy=loaded is image)
+    else:
+        check_writable(out)
+        if out is not image:
+            out[...] = image
+    _check_values_fit(out.dtype, values.tolist())
+    if np.issubdtype(out.dtype, np.integer):
+        # labels that cannot be stored in the image cannot be in it
+        info = np.iinfo(out.dtype)
+        fits = (keys >= info.min) & (keys <= info.max)
+        keys, values = keys[fits], values[fits]
+    if len(keys) == 0:
+        return out
+
+    use_lut = keys[0] >= 0 and keys[-1] < LUT_LIMIT
+    if use_lut:
+        lut = np.arange(keys[-1] + 1, dtype=out.dtype)
+        lut[keys] = values
+    else:
+        values = values.astype(out.dtype)
+
+    if boxes is None:
+        boxes = [tuple(slice(None) for _ in out.shape)]
+    for box in boxes:
+        for block in _iter_blocks(box, out.shape):
+            region = out[block]
+            if use_lut:
+                # labels above the table are not in the mapping
+                inside = region <= keys[-1]
+                if np.issubdtype(region.dtype, np.signedinteger):
+                    inside &= region >= 0
+                if inside.all():
+                    new_region = lut[region]
+                else:
+                    new_region = region.copy()
+                    new_region[inside] = lut[region[inside]]
+            else:
+                index = np.clip(
+                    np.searchsorted(keys, region), 0, len(keys) - 1
+                )
+                found = keys[index] == region
+                new_region = region.copy()
+                new_region[found] = values[index[found]]
+            # the old values are kept until the write succeeded
+            previous = region.copy() if record is not None else None
+            region[...] = new_region
+            _write_back(out, block, region)
+            if record is not None:
+                record.add(block, previous, new_region != previous, new_region)
+        yield
+    return out
@@ -4,20 +4,62 @@ from qtpy.QtWidgets import (
     QHBoxLayout,
 )
 from image_manipulation_plugin.utils import (
+    _get_full_resolution,
     error_image_selection,
     error_tif_selection,
     error_mha_selection
 )
-from matplotlib import pyplot as plt
 from magicgui import widgets
 import numpy as np
+import os
+from functools import partial
+import weakref
 from napari import layers
-from tifffile import imread
-import glob
-from scipy.ndimage import sum_labels
-from medpy.io import load
+from image_manipulation_plugin.label_editing import (
+    EditHistory,
+    EditRecord,
+    check_writable,
+    compose_mappings,
+    iter_relabel,
+    iter_remap_labels,
+    parse_mapping,
+    sequential_mapping,
+)
+from image_manipulation_plugin.label_dtypes import (
+    DTYPE_CHOICES,
+    check_dtype,
+    compact_dtype,
+    compact_labels,
+    parse_dtype,
+)
+from image_manipulation_plugin.label_table import (
+    LabelTableModel,
+    label_table_view,
+)
+from image_manipulation_plugin.label_statistics import statistics_cache
+from image_manipulation_plugin.processing import (
+    iter_volume_table,
+    write_volume_table,
+)
+from image_manipulation_plugin.pyramids import iter_pyramid
+from image_manipulation_plugin.pyramids import n_steps as n_pyramid_steps
+from image_manipulation_plugin.sequence_io import (
+    LazySequence,
+    find_sequence_files,
+    find_zarr_store,
+    get_reader,
+    iter_convert_to_zarr,
+    iter_load_sequence,
+    iter_write_sequence,
+    iter_write_zarr,
+    open_zarr,
+)
+from image_manipulation_plugin.thresholding import n_blocks
+from image_manipulation_plugin.profiling import profile_handlers
+from image_manipulation_plugin.workers import BackgroundTasks
 
 
+@profile_handlers
 class CountLabels(QWidget):
     """
     This class counts the number of labels in an image
@@ -34,14 +76,23 @@ class CountLabels(QWidget):
             return
         # only run function if the selected layer is a labels layer
         if isinstance(self.viewer.layers.selection.active, layers.Labels):
-            image = image.data
-            count = len(np.unique(image))
-            self.count.value = (
-                f"There are {count} labels\nin your image (incl. background)"
+            # statistics are computed in the background, then read here
+            statistics = statistics_cache(image)
+            self.tasks.start(
+                statistics.compute,
+                returned=lambda _: self._show_count(statistics),
+                desc="Counting labels",
+                total=statistics.n_frames,
             )
         else:
             self.count.value = "Careful, this is not a labels layer."
 
+    def _show_count(self, statistics):
+        count = len(statistics.movie())
+        self.count.value = (
+            f"There are {count} labels\nin your image (incl. background)"
+        )
+
     def __init__(self, napari_viewer):
         super().__init__()
 
@@ -54,16 +105,21 @@ class CountLabels(QWidget):
         self.setLayout(QHBoxLayout())
         self.layout().addWidget(btn)
         self.count = widgets.Label(value="")
+        self.tasks = BackgroundTasks(self.count)
 
-        container = widgets.Container(widgets=[self.count], labels=False)
+        container = widgets.Container(
+            widgets=[self.count, self.tasks.btn_cancel], labels=False
+        )
 
         self.setLayout(QHBoxLayout())
         self.layout().addWidget(container.native)
 
 
+@profile_handlers
 class ListLabels(QWidget):
     """
-    This class lists all labels in an image
+    This class lists all labels in an image with their voxel count and the time frames they are present in,
+    in a table that can be sorted by any column and searched by label. Double clicking a row selects its label.
     """
 
     # Name that will be displayed on the combobox
@@ -77,25 +133,37 @@ class ListLabels(QWidget):
             return
         # only run function if the selected layer is a labels layer
         if isinstance(self.viewer.layers.selection.active, layers.Labels):
-            image = image.data
-            labels = np.sort((np.unique(image)))
-            output_str = self.format_output_list(labels)
-            self.output_str.value = f"Labels: {output_str}"
+            statistics = statistics_cache(image)
+            self.tasks.start(
+                statistics.compute,
+                returned=lambda _: self._show_labels(statistics),
+                desc="Listing labels",
+                total=statistics.n_frames,
+            )
         else:
             self.output_str.value = "Careful, this is not a labels layer."
 
-    def format_output_list(self, output):
-        output_str = "Labels: "
-        for i, element in enumerate(output):
-            if i == 0:
-                output_str += f"\n {str(element)},"
-            elif i + 1 == len(output):
-                output_str += f" {str(element)}"
-            elif (i + 1) % 10 == 0:
-                output_str += f" {str(element)},\n"
-            else:
-                output_str += f" {str(element)},"
-        return output_str
+    def _show_labels(self, statistics):
+        self.model.set_table(statistics.table())
+        n_labels = len(statistics.movie())
+        self.output_str.value = f"{n_labels} labels"
+        # the search typed before the refresh still filters the new labels
+        if str(self.search.value):
+            self._on_search(self.search.value)
+
+    def _on_search(self, text):
+        try:
+            self.model.search(str(text))
+        except ValueError:
+            self.output_str.value = "Search a label (e.g. 12) or a range (e.g. 10-20)."
+            return
+        self.output_str.value = f"{self.model.rowCount()} labels shown"
+
+    def _on_double_click(self, index):
+        # select the label in the layer, e.g. to paint with it
+        layer = self.viewer.layers.selection.active
+        if isinstance(layer, layers.Labels):
+            layer.selected_label = int(self.model.label(index.row()))
 
     def __init__(self, napari_viewer):
         super().__init__()
@@ -109,23 +177,62 @@ class ListLabels(QWidget):
         self.setLayout(QHBoxLayout())
         self.layout().addWidget(btn)
         self.output_str = widgets.Label(value="")
+        self.tasks = BackgroundTasks(self.output_str)
+
+        # only the rows on screen are rendered, whatever the number of labels
+        self.search = widgets.LineEdit()
+        self.search.tooltip = "Search a label (e.g. 12) or a range (e.g. 10-20)"
+        self.search.changed.connect(self._on_search)
+        self.model = LabelTableModel()
+        self.table = label_table_view(self.model)
+        self.table.native = self.table
+        self.table.name = "Labels table"
+        self.table.doubleClicked.connect(self._on_double_click)
 
-        container = widgets.Container(widgets=[self.output_str], labels=False)
+        container = widgets.Container(
+            widgets=[
+                self.output_str,
+                self.search,
+                self.table,
+                self.tasks.btn_cancel,
+            ],
+            labels=False,
+        )
 
         self.setLayout(QHBoxLayout())
         self.layout().addWidget(container.native)
 
 
+@profile_handlers
 class MeasureLabelVolume(QWidget):
     """
     This class counts the number of voxel of a given (or all) label(s) in a 3D image. 
     If the provided image is 4D it will measure volumes at the selected timepoint.
     Outputs are displayed as histogram (all labels) or printed (single label).
+    The volume table lists the volume of every label at every timepoint (label x time), the timepoints being
+    measured in parallel; it can be exported to a CSV or Parquet file.
     """
 
     # Name that will be displayed on the combobox
     name = "Measure label volume"
 
+    def _current_frame(self, statistics, show):
+        """
+        Compute the statistics of the selected timepoint in the background,
+        then call `show` with them and the timepoint
+        """
+        if len(self.viewer.dims.current_step) == 4:  # means data is 4 dimensional
+            t_position = self.viewer.dims.current_step[0]
+        else:
+            t_position = 0
+        self.tasks.start(
+            statistics.compute,
+            [t_position],
+            returned=lambda _: show(statistics.frame(t_position), t_position),
+            desc="Measuring label volumes",
+            total=1,
+        )
+
     def _on_click_single(self):
         # Get the selected image (make sure that it isn't none)
         image = self.viewer.layers.selection.active
@@ -133,24 +240,19 @@ class MeasureLabelVolume(QWidget):
             error_image_selection()
             return
         if isinstance(self.viewer.layers.selection.active, layers.Labels):
-            image = image.data
-            label = self.btn_input.value
-            if (
-                len(self.viewer.dims.current_step) == 4
-            ):  # means data is 4 dimensional
-                t_position = self.viewer.dims.current_step[0]
-                volume = np.sum(image[t_position, :, :, :] == label)
-            else:
-                volume = np.sum(image == label)
-            if volume > 0:
-                self.volume.value = f"Label {label} has {volume} voxels"
-            else:
-                self.volume.value = (
-                    f"Label {label} is not present in this image"
-                )
+            self._current_frame(statistics_cache(image), self._show_single)
         else:
             self.message.value = "Careful, this is not a labels layer."
 
+    def _show_single(self, statistics, t_position):
+        label = self.btn_input.value
+        volume = statistics.count(label)
+        self.message.value = ""
+        if volume > 0:
+            self.volume.value = f"Label {label} has {volume} voxels"
+        else:
+            self.volume.value = f"Label {label} is not present in this image"
+
     def _on_click_all(self):
         # Get the selected image (make sure that it isn't none)
         image = self.viewer.layers.selection.active
@@ -159,35 +261,79 @@ class MeasureLabelVolume(QWidget):
             return
         # only run function if the selected layer is a labels layer
         if isinstance(self.viewer.layers.selection.active, layers.Labels):
-            image = image.data
-            if (
-                len(self.viewer.dims.current_step) == 4
-            ):  # means data is 4 dimensional
-                t_position = self.viewer.dims.current_step[0]
-                labels = np.unique(image[t_position, :, :, :])
-                input_ones = np.ones_like(image[t_position, :, :, :])
-                volumes = sum_labels(
-                    input_ones, image[t_position, :, :, :], labels
-                )
-            else:
-                labels = np.unique(image)
-                input_ones = np.ones_like(image)
-                volumes = sum_labels(input_ones, image, labels)
-            print(volumes)
-            fig, ax = plt.subplots()
-            ax.hist(volumes)
-            ax.set_xlabel("amount")
-            ax.set_ylabel("volumes in voxels")
-            ax.set_title(f"Volumes at time {t_position} in voxels")
-            fig.tight_layout()
-            plt.show()
-            self.message.value = "Volume histogram in pop-up window"
+            self._current_frame(statistics_cache(image), self._show_all)
         else:
             self.message.value = "Careful, this is not a labels layer."
 
+    def _show_all(self, statistics, t_position):
+        # matplotlib is slow to import, only load it for the plot
+        from matplotlib import pyplot as plt
+
+        volumes = statistics.counts
+        fig, ax = plt.subplots()
+        ax.hist(volumes)
+        ax.set_xlabel("amount")
+        ax.set_ylabel("volumes in voxels")
+        ax.set_title(f"Volumes at time {t_position} in voxels")
+        fig.tight_layout()
+        plt.show()
+        self.message.value = "Volume histogram in pop-up window"
+
+    def _on_click_table(self):
+        # Get the selected image (make sure that it isn't none)
+        image = self.viewer.layers.selection.active
+        if image is None:
+            error_image_selection()
+            return
+        if isinstance(image, layers.Labels):
+            # the frames and the matrix are computed in the background,
+            # a 4D layer could otherwise freeze napari
+            data = _get_full_resolution(image)
+            self.tasks.start(
+                iter_volume_table,
+                data,
+                returned=lambda result: self._show_table(image, *result),
+                desc="Measuring label volumes of all timepoints",
+                total=data.shape[0] if data.ndim == 4 else 1,
+            )
+        else:
+            self.message.value = "Careful, this is not a labels layer."
+
+    def _show_table(self, layer, labels, volumes):
+        self._volume_table = (layer.name, labels, volumes)
+        self.table.value = {
+            "data": volumes.tolist(),
+            "index": labels.tolist(),
+            "columns": [f"t{t}" for t in range(volumes.shape[1])],
+        }
+        self.message.value = (
+            f"Volumes of {len(labels)} labels at {volumes.shape[1]} timepoints in {layer.name}"
+        )
+
+    def _on_click_export(self):
+        if self._volume_table is None:
+            self.message.value = "Please compute the volume table first."
+            return
+        path = str(self.export_file.value)
+        if not path.endswith((".csv", ".parquet")):
+            self.message.value = "Please choose a .csv or .parquet file."
+            return
+        name, labels, volumes = self._volume_table
+        self.tasks.start(
+            write_volume_table,
+            path,
+            labels,
+            volumes,
+            returned=lambda _: setattr(
+                self.message, "value", f"Volumes of {name} written to {path}"
+            ),
+            desc="Exporting the volume table",
+        )
+
     def __init__(self, napari_viewer):
         super().__init__()
         self.viewer = napari_viewer
+        self._volume_table = None
 
         self.btn_input = widgets.SpinBox()
         self.btn_input.name = "Enter a label"
@@ -202,7 +348,22 @@ class MeasureLabelVolume(QWidget):
         btn_histo.native = btn_histo
         btn_histo.name = "Show all volumes"
         btn_histo.clicked.connect(self._on_click_all)
+
+        btn_table = QPushButton("Volume table (all timepoints)")
+        btn_table.native = btn_table
+        btn_table.name = "Volume table (all timepoints)"
+        btn_table.clicked.connect(self._on_click_table)
+        self.table = widgets.Table(
+            value={"data": [], "index": [], "columns": []}
+        )
+        self.table.read_only = True
+        self.export_file = widgets.FileEdit(mode="w", filter="*.csv *.parquet")
+        btn_export = QPushButton("Export volume table")
+        btn_export.native = btn_export
+        btn_export.name = "Export volume table"
+        btn_export.clicked.connect(self._on_click_export)
         self.message = widgets.Label(value="")
+        self.tasks = BackgroundTasks(self.message)
 
         container = widgets.Container(
             widgets=[
@@ -210,7 +371,12 @@ class MeasureLabelVolume(QWidget):
                 btn_calc,
                 self.volume,
                 btn_histo,
+                btn_table,
+                self.table,
+                self.export_file,
+                btn_export,
                 self.message,
+                self.tasks.btn_cancel,
             ],
             labels=False,
         )
@@ -219,6 +385,33 @@ class MeasureLabelVolume(QWidget):
         self.layout().addWidget(container.native)
 
 
+def _relabel_copy(image, label1, label2, boxes):
+    """
+    Copy of `image` where `label1` is changed to `label2` in `boxes`, in
+    the smallest dtype holding its labels
+    """
+    # lazy or chunked images are read once, into the copy
+    loaded = np.asarray(image)
+    low, high = int(loaded.min()), int(loaded.max())
+    new_image = loaded.astype(
+        compact_dtype(max(high, label2), min(low, label2)),
+        copy=loaded is image,
+    )
+    yield
+    yield from iter_relabel(new_image, label1, label2, boxes)
+    return new_image
+
+
+def _remap_copy(image, mapping, boxes):
+    """
+    Copy of `image` with the label mapping applied in `boxes`, in the
+    smallest dtype holding its labels
+    """
+    new_image = yield from iter_remap_labels(image, mapping, boxes)
+    return compact_labels(new_image)
+
+
+@profile_handlers
 class ChangeLabel(QWidget):
     "This class changes a desired label ID to a new ID"
 
@@ -232,96 +425,278 @@ class ChangeLabel(QWidget):
             error_image_selection()
             return
         # only run function if the selected layer is a labels layer
-        if isinstance(self.viewer.layers.selection.active, layers.Labels):
-            image = image.data
-            label1 = self.btn_input.value
-            label2 = self.btn_new.value
-            all_labels = np.unique(image)
-            if label1 in all_labels:
-                if label2 not in all_labels:
-                    if self.btn_copy.value == "No":
-                        if self.btn_time.value == "Yes":  # if all t
-                            image[image == label1] = label2
-                            self.message.value = f"Label {label1} has been changed to {label2} in all time frames."
-                        else:
-                            if (
-                                len(self.viewer.dims.current_step) == 4
-                            ):  # means data is 4 dimensional
-                                t_position = self.viewer.dims.current_step[0]
-                                image[t_position, :, :, :][
-                                    image[t_position, :, :, :] == label1
-                                ] = label2
-                            else:
-                                image[image == label1] = label2
-                                t_position = 0
-                            self.message.value = f"Label {label1} has been changed to {label2} in time frame {t_position}."
-                    else:
-                        # now we create a copy of the image and change the label in the copy only
-                        new_image = image.copy()
-                        if self.btn_time.value == "Yes":
-                            new_image[new_image == label1] = label2
-                            self.message.value = f"Label {label1} has been changed to {label2} \nin a copy of your image in all times frames."
-                        else:
-                            if (
-                                len(self.viewer.dims.current_step) == 4
-                            ):  # means data is 4 dimensional
-                                t_position = self.viewer.dims.current_step[0]
-                                new_image[t_position, :, :, :][
-                                    new_image[t_position, :, :, :] == label1
-                                ] = label2
-                            else:
-                                new_image[new_image == label1] = label2
-                                t_position = 0
-                            self.message.value = f"Label {label1} has been changed to {label2} in a copy\nof your image exclusively in time frame {t_position}."
-                else:
-                    if self.btn_force.value is not False:
-                        if self.btn_copy.value == "No":
-                            if self.btn_time.value == "Yes":  # if yes, then change label in all t
-                                image[image == label1] = label2
-                                self.message.value = f"Label {label1} has been changed to {label2} in all time frames."
-                            else:
-                                if (
-                                    len(self.viewer.dims.current_step) == 4
-                                ):  # means data is 4 dimensional
-                                    t_position = self.viewer.dims.current_step[0]
-                                    image[t_position, :, :, :][
-                                        image[t_position, :, :, :] == label1
-                                    ] = label2
-                                else:
-                                    image[image == label1] = label2
-                                    t_position = 0
-                                self.message.value = f"Label {label1} has been changed to {label2} in time frame {t_position}."
-                        else:
-                            new_image = image.copy()
-                            if self.btn_time.value == "Yes":
-                                new_image[image == label1] = label2
-                                self.message.value = f"Label {label1} has been changed to {label2} \nin a copy of your image in all times frames."
-                            else:
-                                if (
-                                    len(self.viewer.dims.current_step) == 4
-                                ):  # means data is 4 dimensional
-                                    t_position = self.viewer.dims.current_step[0]
-                                    new_image[t_position, :, :, :][
-                                        new_image[t_position, :, :, :] == label1
-                                    ] = label2
-                                    self.message.value = f"Label {label1} has been changed to {label2} in a copy\nof your image exclusively in time frame {t_position}."
-                                else:
-                                    new_image[new_image == label1] = label2
-                                    t_position = 0
-                                self.message.value = f"Label {label1} has been changed to {label2} in a copy\nof your image exclusively in time frame {t_position}."
-                        # always retrieve the image scale to remain flexible to all sorts of images
-                            scale = self.viewer.layers.selection.active.scale
-                            self.viewer.add_labels(
-                                new_image, name="new_labels", scale=scale
-                            )
-                    else: self.message.value = (f"Label {label2} already exists, if you want to change \nLabel {label1} to Label {label2}, you need to force it (checkbox).")
-            else:
+        if not isinstance(self.viewer.layers.selection.active, layers.Labels):
+            self.message.value = "Careful, this is not a labels layer."
+            return
+        if image.multiscale and self.btn_copy.value == "No":
+            # the lower resolution levels would not follow the change
+            self.message.value = "Multiscale layers can only be changed in a copy."
+            return
+        if self.btn_copy.value == "No":
+            try:
+                # frames read lazily from files cannot be written
+                check_writable(image.data)
+            except ValueError as error:
+                self.message.value = str(error)
+                return
+        # the labels and their bounding boxes are needed first
+        statistics = statistics_cache(image)
+        self.tasks.start(
+            statistics.compute,
+            returned=lambda _: self._change_label(image),
+            desc="Computing label statistics",
+            total=statistics.n_frames,
+        )
+
+    def _change_label(self, layer):
+        statistics = statistics_cache(layer)
+        image = statistics.data
+        label1 = self.btn_input.value
+        label2 = self.btn_new.value
+        all_labels = statistics.movie()
+        if label1 not in all_labels:
+            self.message.value = (
+                f"Label {label1} does not exits in the input image."
+            )
+            return
+        if label2 in all_labels and self.btn_force.value is False:
+            self.message.value = (f"Label {label2} already exists, if you want to change \nLabel {label1} to Label {label2}, you need to force it (checkbox).")
+            return
+
+        timepoints, t_position = self._timepoints(statistics)
+        # only the bounding boxes of label1 are scanned and written
+        boxes = statistics.boxes(label1, timepoints)
+
+        if self.btn_copy.value == "No":
+            try:
+                # the dtype of the layer cannot change in place
+                check_dtype(image.dtype, label2, min(label2, 0))
+            except ValueError:
                 self.message.value = (
-                    f"Label {label1} does not exits in the input image."
+                    f"Label {label2} does not fit in the {image.dtype} labels,\n"
+                    "change it in a copy, which gets a wider dtype."
                 )
+                return
+            # the changed voxels are recorded so that the edit can be undone,
+            # or rolled back if it is cancelled
+            record = EditRecord(f"change of label {label1} to {label2}")
+            if self.btn_time.value == "Yes":
+                message = f"Label {label1} has been changed to {label2} in all time frames."
+            else:
+                message = f"Label {label1} has been changed to {label2} in time frame {t_position}."
+
+            def done(_):
+                self._history(layer).push(record)
+                statistics.relabel(label1, label2, timepoints)
+                layer.refresh()
+                self.message.value = message
+
+            self.tasks.start(
+                iter_relabel,
+                image,
+                label1,
+                label2,
+                boxes,
+                record,
+                returned=done,
+                aborted=lambda: self._roll_back(layer, record),
+                desc=f"Changing label {label1} to {label2}",
+                total=len(boxes),
+            )
+        else:
+            # now we create a copy of the image and change the label in the copy only
+            if self.btn_time.value == "Yes":
+                message = f"Label {label1} has been changed to {label2} \nin a copy of your image in all times frames."
+            else:
+                message = f"Label {label1} has been changed to {label2} in a copy\nof your image exclusively in time frame {t_position}."
+            self.tasks.start(
+                _relabel_copy,
+                image,
+                label1,
+                label2,
+                boxes,
+                returned=lambda new_image: self._add_copy(
+                    layer, new_image, message
+                ),
+                desc=f"Changing label {label1} to {label2}",
+                total=len(boxes) + 1,
+            )
+
+    def _add_copy(self, layer, new_image, message):
+        self.message.value = message
+        # always retrieve the image scale to remain flexible to all sorts of images
+        scale = layer.scale
+        self.viewer.add_labels(new_image, name="new_labels", scale=scale)
+
+    def _roll_back(self, layer, record):
+        """Revert the part of a cancelled in-place edit already applied"""
+        record.apply(layer.data, undo=True)
+        layer.refresh()
+        self.message.value = "Cancelled, the labels were left unchanged."
+
+    def _history(self, layer):
+        """Undo history of the in-place changes made to `layer`"""
+        if layer not in self.histories:
+            history = EditHistory()
+            # the recorded voxels are meaningless once the data is replaced
+            # or painted over
+            layer.events.data.connect(lambda event: history.clear())
+            layer.events.paint.connect(lambda event: history.clear())
+            self.histories[layer] = history
+        return self.histories[layer]
+
+    def _on_click_undo(self, redo=False):
+        layer = self.viewer.layers.selection.active
+        if layer is None:
+            error_image_selection()
+            return
+        if not isinstance(layer, layers.Labels):
+            self.message.value = "Careful, this is not a labels layer."
+            return
+        history = self._history(layer)
+        action = "redo" if redo else "undo"
+        if not (history.can_redo if redo else history.can_undo):
+            self.message.value = f"There is no change to {action}."
+            return
+        self.tasks.start(
+            history.redo if redo else history.undo,
+            layer.data,
+            returned=lambda record: self._show_undo(layer, record, redo),
+            desc=f"{action.capitalize()}ing the last change",
+        )
 
+    def _show_undo(self, layer, record, redo):
+        coordinates, old_values, new_values = record.changes()
+        if redo:
+            statistics_cache(layer).update(coordinates, old_values, new_values)
         else:
+            statistics_cache(layer).update(coordinates, new_values, old_values)
+        layer.refresh()
+        action = "Redone" if redo else "Undone"
+        self.message.value = f"{action}: {record.description}\n({len(record)} voxels)."
+
+    def _on_click_redo(self):
+        self._on_click_undo(redo=True)
+
+    def _timepoints(self, statistics):
+        """
+        Timepoints to change (None for all) and the current timepoint
+        """
+        if self.btn_time.value == "Yes":  # if yes, then change label in all t
+            return None, None
+        if statistics.per_timepoint:  # means data is 4 dimensional
+            t_position = self.viewer.dims.current_step[0]
+            return [t_position], t_position
+        return None, 0
+
+    def _read_mapping(self):
+        mapping = parse_mapping(self.mapping_table.value)
+        mapping_file = str(self.mapping_file.value)
+        if os.path.isfile(mapping_file):
+            with open(mapping_file) as file:
+                mapping.update(parse_mapping(file.read()))
+        return mapping
+
+    def _on_click_batch(self):
+        # Get the selected image (make sure that it isn't none)
+        image = self.viewer.layers.selection.active
+        if image is None:
+            error_image_selection()
+            return
+        # only run function if the selected layer is a labels layer
+        if not isinstance(self.viewer.layers.selection.active, layers.Labels):
             self.message.value = "Careful, this is not a labels layer."
+            return
+        if image.multiscale and self.btn_copy.value == "No":
+            # the lower resolution levels would not follow the change
+            self.message.value = "Multiscale layers can only be changed in a copy."
+            return
+        if self.btn_copy.value == "No":
+            try:
+                # frames read lazily from files cannot be written
+                check_writable(image.data)
+            except ValueError as error:
+                self.message.value = str(error)
+                return
+        try:
+            mapping = self._read_mapping()
+        except ValueError as error:
+            self.message.value = str(error)
+            return
+        statistics = statistics_cache(image)
+        self.tasks.start(
+            statistics.compute,
+            returned=lambda _: self._apply_mapping(image, mapping),
+            desc="Computing label statistics",
+            total=statistics.n_frames,
+        )
+
+    def _apply_mapping(self, layer, mapping):
+        statistics = statistics_cache(layer)
+        image = statistics.data
+        timepoints, t_position = self._timepoints(statistics)
+        if timepoints is None:
+            labels = statistics.movie().labels
+        else:
+            labels = statistics.frame(t_position).labels
+        if self.btn_sequential.value:
+            # compact the IDs obtained after the mapping, still in one pass
+            new_labels = [mapping.get(label, label) for label in labels.tolist()]
+            mapping = compose_mappings(
+                mapping, sequential_mapping(new_labels), labels
+            )
+        # labels that are not in the image do not need to be looked for
+        mapping = {
+            old: new
+            for old, new in mapping.items()
+            if old != new and old in statistics.movie()
+        }
+        if not mapping:
+            self.message.value = "There are no labels to change."
+            return
+        # one box per timepoint, to report progress frame by frame
+        if timepoints is None:
+            frames = range(statistics.n_frames) if statistics.per_timepoint else [None]
+        else:
+            frames = timepoints
+        boxes = [() if t is None else (slice(t, t + 1),) for t in frames]
+
+        if self.btn_copy.value == "No":
+            record = EditRecord(f"change of {len(mapping)} labels")
+            where = "in all time frames" if t_position is None else f"in time frame {t_position}"
+
+            def done(_):
+                self._history(layer).push(record)
+                statistics.remap(mapping, timepoints)
+                layer.refresh()
+                self.message.value = f"{len(mapping)} labels have been changed\n{where}."
+
+            self.tasks.start(
+                iter_remap_labels,
+                image,
+                mapping,
+                boxes,
+                out=image,
+                record=record,
+                returned=done,
+                aborted=lambda: self._roll_back(layer, record),
+                desc=f"Changing {len(mapping)} labels",
+                total=len(boxes),
+            )
+        else:
+            where = "in all time frames" if t_position is None else f"exclusively in time frame {t_position}"
+            message = f"{len(mapping)} labels have been changed in a copy\nof your image {where}."
+            self.tasks.start(
+                _remap_copy,
+                image,
+                mapping,
+                boxes,
+                returned=lambda new_image: self._add_copy(
+                    layer, new_image, message
+                ),
+                desc=f"Changing {len(mapping)} labels",
+                total=len(boxes),
+            )
 
     def __init__(self, napari_viewer):
         super().__init__()
@@ -344,7 +719,6 @@ class ChangeLabel(QWidget):
         btn_calc.native = btn_calc
         btn_calc.name = "Change label"
         btn_calc.clicked.connect(self._on_click)
-        self.message = widgets.Label(value="")
 
         self.btn_copy = widgets.RadioButtons(choices=["No", "Yes"], value="No")
         self.btn_copy_label = widgets.Label(value="")
@@ -365,6 +739,40 @@ class ChangeLabel(QWidget):
             layout = "horizontal"
         )
 
+        btn_undo = QPushButton("Undo last change")
+        btn_undo.native = btn_undo
+        btn_undo.name = "Undo last change"
+        btn_undo.clicked.connect(self._on_click_undo)
+        btn_redo = QPushButton("Redo")
+        btn_redo.native = btn_redo
+        btn_redo.name = "Redo"
+        btn_redo.clicked.connect(self._on_click_redo)
+        # undo histories of the in-place changes, per layer
+        self.histories = weakref.WeakKeyDictionary()
+
+        container_undo = widgets.Container(
+            widgets=[btn_undo, btn_redo],
+            labels=False,
+            layout="horizontal",
+        )
+
+        self.mapping_label = widgets.Label(value="")
+        self.mapping_label.value = "Batch mapping (one 'old new' pair per line):"
+        self.mapping_table = widgets.TextEdit(value="")
+        self.mapping_file_label = widgets.Label(value="")
+        self.mapping_file_label.value = "or mapping CSV file (optional):"
+        self.mapping_file = widgets.FileEdit(mode="r", filter="*.csv *.txt")
+        self.btn_sequential = widgets.CheckBox(
+            value=False, text="Sequential relabel (compact IDs)"
+        )
+
+        btn_batch = QPushButton("Apply mapping")
+        btn_batch.native = btn_batch
+        btn_batch.name = "Apply mapping"
+        btn_batch.clicked.connect(self._on_click_batch)
+        self.message = widgets.Label(value="")
+        self.tasks = BackgroundTasks(self.message)
+
         container = widgets.Container(
             widgets=[
                 self.button1_label,
@@ -377,7 +785,15 @@ class ChangeLabel(QWidget):
                 self.btn_time_label,
                 self.btn_time,
                 btn_calc,
+                self.mapping_label,
+                self.mapping_table,
+                self.mapping_file_label,
+                self.mapping_file,
+                self.btn_sequential,
+                btn_batch,
+                container_undo,
                 self.message,
+                self.tasks.btn_cancel,
             ],
             labels=False,
         )
@@ -386,55 +802,156 @@ class ChangeLabel(QWidget):
         self.layout().addWidget(container.native)
 
 
-class OpenTIFSequence(QWidget):
+def _iter_load_labels(list_of_files, reader, first_image, dtype=None):
     """
-    This class opens a sequence of 3D images as a 4D time series
-    Currently it only works for tiff files
+    Load a labels sequence (see sequence_io.iter_load_sequence) in the
+    smallest dtype holding its labels, or in `dtype`
     """
+    movie = yield from iter_load_sequence(list_of_files, reader, first_image)
+    return compact_labels(movie, dtype)
 
-    # Name that will be displayed on the combobox
-    name = "Open TIF sequence"
+
+@profile_handlers
+class _OpenSequence(QWidget):
+    """
+    Base class of the widgets opening a sequence of 3D images as a 4D time series.
+    Subclasses only choose the file format, reading is done by the
+    shared engine of image_manipulation_plugin.sequence_io
+    """
+
+    # Format of the sequence, a key of sequence_io.READERS
+    reader = None
+
+    # Error box shown if the selected files are not of the right format
+    error_selection = None
 
     def _on_click(self):
         regex = str(self.regex.value)
         path = str(self.path_first_image.value)
-        folder = "/".join(path.split("/")[:-1])
-        list_of_files = sorted(glob.glob(f"{folder}/{regex}"))
+        if find_zarr_store(path) is not None:
+            self._open_zarr(path)
+            return
+        reader = get_reader(self.reader)
+        try:
+            list_of_files = find_sequence_files(path, regex, reader)
+        except ValueError:
+            self.error_selection()
+            return
+        first_image = reader(list_of_files[0])
 
-        # is there another way to test whether file is a tif?
-        if not ".tif" in path.lower():
-            error_tif_selection()
+        if self.to_zarr.value:
+            # converted once, the store is then opened chunk by chunk
+            output = os.path.splitext(list_of_files[0])[0] + ".zarr"
+            if os.path.exists(output):
+                # never replace a store silently, it may hold edited labels
+                self.message.value = (
+                    f"{os.path.basename(output)} already exists,\n"
+                    "open it directly or delete it to convert again."
+                )
+                return
+            self.tasks.start(
+                iter_convert_to_zarr,
+                path,
+                output,
+                regex,
+                reader,
+                dtype=self._lazy_dtype(first_image),
+                returned=self._add_movie,
+                desc=f"Converting {reader.name} sequence to Zarr",
+                total=len(list_of_files),
+            )
             return
-        else:
-            first_image = imread(path)
-        image_dim = first_image.shape
 
-        # initialize outpout and then load single images and append them to one array
-        output_array = np.zeros(
-            (len(list_of_files), image_dim[0], image_dim[1], image_dim[2])
+        if self.lazy.value:
+            # frames are read (memory-mapped if possible) when napari needs them
+            try:
+                movie = LazySequence(
+                    list_of_files,
+                    reader,
+                    first_image=first_image,
+                    dtype=self._lazy_dtype(first_image),
+                )
+            except ValueError as error:
+                # IDs of the first frame do not fit in the chosen dtype
+                self.message.value = str(error)
+                return
+            self._add_movie(movie)
+            return
+
+        # frames are read in a background thread so napari stays responsive,
+        # progress is reported in the napari activity dock
+        if str(self.type.value) == "Labels":
+            load = partial(_iter_load_labels, dtype=parse_dtype(self.dtype.value))
+        else:
+            load = iter_load_sequence
+        self.tasks.start(
+            load,
+            list_of_files,
+            reader,
+            first_image,
+            returned=self._add_movie,
+            desc=f"Loading {reader.name} sequence",
+            total=len(list_of_files),
         )
-        for i, file in enumerate(list_of_files):
-            if i == 0:
-                output_array[i, :] = first_image
 
-            else:
-                if not ".tif" in file:
-                    error_tif_selection()
-                    return
-                im = imread(file)
-                output_array[i, :] = im
+    def _open_zarr(self, path):
+        # napari only reads the chunks of the displayed slices. Labels
+        # are opened writable, so that in-place edits reach the store
+        mode = "r+" if str(self.type.value) == "Labels" else "r"
+        try:
+            data = open_zarr(path, mode=mode)
+        except (ImportError, ValueError) as error:
+            self.message.value = str(error)
+            return
+        if isinstance(data, list):
+            self._add_layer(data)
+        else:
+            self._add_movie(data)
+
+    def _lazy_dtype(self, first_image):
+        # labels layers need integers, the cast then happens frame by frame.
+        # The largest ID is unknown until all frames are read, so the dtype
+        # is only compacted if the user chooses it
+        if str(self.type.value) != "Labels":
+            return None
+        dtype = parse_dtype(self.dtype.value)
+        if dtype is None and not np.issubdtype(first_image.dtype, np.integer):
+            return np.uint32
+        return dtype
+
+    def _add_movie(self, output_array):
+        if self.multiscale.value:
+            # the lower resolutions are built in the background, a lazy
+            # movie stays lazy as the full resolution level
+            self.tasks.start(
+                iter_pyramid,
+                output_array,
+                labels=str(self.type.value) == "Labels",
+                returned=self._add_layer,
+                desc="Building the multiscale pyramid",
+                total=n_pyramid_steps(output_array.shape),
+            )
+        else:
+            self._add_layer(output_array)
+
+    def _add_layer(self, data):
+        multiscale = isinstance(data, list)
+        n_frames = (data[0] if multiscale else data).shape[0]
+        self.message.value = f"Opened {n_frames} time frames."
         scale = self.scale.value
         if str(self.type.value) == "Labels":
             self.viewer.add_labels(
-                output_array.astype(int),
+                data,
                 name="Movie",
                 scale=(scale[0], scale[1], scale[2]),
+                multiscale=multiscale,
             )
         else:
             self.viewer.add_image(
-                output_array,
+                data,
                 name="Movie",
                 scale=(scale[0], scale[1], scale[2]),
+                multiscale=multiscale,
             )
 
     def __init__(self, napari_viewer):
@@ -442,7 +959,7 @@ class OpenTIFSequence(QWidget):
         self.viewer = napari_viewer
 
         self.label_path_first_image = widgets.Label(value="")
-        self.label_path_first_image.value = "Path to first image"
+        self.label_path_first_image.value = "Path to first image (or to a .zarr/.n5 store)"
         self.path_first_image = widgets.FileEdit()
 
         self.regex_label = widgets.Label(value="")
@@ -459,6 +976,23 @@ class OpenTIFSequence(QWidget):
             value=[1.0001, 1.0001, 1.0001], label={"max": 10000}
         )
 
+        self.lazy = widgets.CheckBox(
+            value=False, text="Lazy loading (read frames on demand)"
+        )
+
+        self.dtype_label = widgets.Label(value="")
+        self.dtype_label.value = "Labels dtype (auto: smallest that fits)"
+        self.dtype = widgets.ComboBox(choices=DTYPE_CHOICES)
+
+        self.multiscale = widgets.CheckBox(
+            value=False, text="Multiscale pyramid (faster rendering)"
+        )
+
+        self.to_zarr = widgets.CheckBox(
+            value=False,
+            text="Convert to a chunked Zarr store (opened chunk by chunk)",
+        )
+
         # do I want to add a range for t?
         # Do I want to ask for the background label so I can change it to 0?
 
@@ -466,6 +1000,8 @@ class OpenTIFSequence(QWidget):
         btn_calc.native = btn_calc
         btn_calc.name = "Open sequence"
         btn_calc.clicked.connect(self._on_click)
+        self.message = widgets.Label(value="")
+        self.tasks = BackgroundTasks(self.message)
 
         container = widgets.Container(
             widgets=[
@@ -477,7 +1013,14 @@ class OpenTIFSequence(QWidget):
                 self.type,
                 self.scale_label,
                 self.scale,
+                self.lazy,
+                self.dtype_label,
+                self.dtype,
+                self.multiscale,
+                self.to_zarr,
                 btn_calc,
+                self.message,
+                self.tasks.btn_cancel,
             ],
             labels=False,
         )
@@ -487,104 +1030,119 @@ class OpenTIFSequence(QWidget):
         self.layout().addStretch(1)
 
 
-class OpenMHASequence(QWidget):
+class OpenTIFSequence(_OpenSequence):
     """
-    This class opens a sequence of 3D images as a 4D time series
-    Currently it only works for tiff files
+    This class opens a sequence of 3D TIF images as a 4D time series
+    """
+
+    # Name that will be displayed on the combobox
+    name = "Open TIF sequence"
+
+    reader = "tif"
+    error_selection = staticmethod(error_tif_selection)
+
+
+class OpenMHASequence(_OpenSequence):
+    """
+    This class opens a sequence of 3D .mha images as a 4D time series
     """
 
     # Name that will be displayed on the combobox
     name = "Open .mha sequence"
 
-    def _on_click(self):
-        regex = str(self.regex.value)
-        path = str(self.path_first_image.value)
-        folder = "/".join(path.split("/")[:-1])
-        list_of_files = sorted(glob.glob(f"{folder}/{regex}"))
+    reader = "mha"
+    error_selection = staticmethod(error_mha_selection)
+
+
+@profile_handlers
+class SaveSequence(QWidget):
+    """
+    This class saves the selected image or labels layer as a sequence of 3D files (one per time frame) that
+    the opener widgets read back, or as one chunked Zarr array. Frames are written in parallel threads and
+    read from the layer one at a time, so lazy movies are never loaded as a whole.
+    """
 
-        # is there another way to test whether file is a tif?
-        if not ".mha" in path.lower():
-            error_mha_selection()
+    # Name that will be displayed on the combobox
+    name = "Save sequence"
+
+    def _on_click(self):
+        layer = self.viewer.layers.selection.active
+        if not isinstance(layer, (layers.Image, layers.Labels)):
+            error_image_selection()
             return
-        else:
-            first_image, header = load(path)
-            #transpose to regular order --> how do I make sure that this always goes in the right direction?
-            #should I add a button that asks for the order of axes?
-            first_image = np.transpose(first_image, (2, 1, 0))
-        image_dim = first_image.shape
-
-        # initialize outpout and then load single images and append them to one array
-        output_array = np.zeros(
-            (len(list_of_files), image_dim[0], image_dim[1], image_dim[2])
+        folder = str(self.folder.value)
+        prefix = str(self.prefix.value) or f"{layer.name}_t"
+        file_format = str(self.format.value)
+        data = _get_full_resolution(layer)
+
+        if file_format == "zarr":
+            path = os.path.join(folder, f"{layer.name}.zarr")
+            self.tasks.start(
+                iter_write_zarr,
+                data,
+                path,
+                returned=lambda out: self._saved(f"Saved to {path}."),
+                desc="Writing Zarr array",
+                total=n_blocks(data.shape),
+            )
+            return
+        n_frames = data.shape[0] if data.ndim == 4 else 1
+        self.tasks.start(
+            iter_write_sequence,
+            data,
+            folder,
+            prefix,
+            file_format,
+            self.compress.value,
+            returned=lambda files: self._saved(
+                f"Saved {len(files)} time frames to {folder}."
+            ),
+            desc=f"Writing {file_format} sequence",
+            total=n_frames,
         )
-        for i, file in enumerate(list_of_files):
-            if i == 0:
-                output_array[i, :] = first_image
 
-            else:
-                if not ".mha" in file:
-                    error_mha_selection()
-                    return
-                im, header = load(file)
-                #transpose to regular order --> how do I make sure that this always goes in the right direction?
-                #should I add a button that asks for the order of axes?
-                im = np.transpose(im, (2, 1, 0))
-                output_array[i, :] = im
-        scale = self.scale.value
-        if str(self.type.value) == "Labels":
-            self.viewer.add_labels(
-                output_array.astype(int),
-                name="Movie",
-                scale=(scale[0], scale[1], scale[2]),
-            )
-        else:
-            self.viewer.add_image(
-                output_array,
-                name="Movie",
-                scale=(scale[0], scale[1], scale[2]),
-            )
+    def _saved(self, text):
+        self.message.value = text
 
     def __init__(self, napari_viewer):
         super().__init__()
         self.viewer = napari_viewer
 
-        self.label_path_first_image = widgets.Label(value="")
-        self.label_path_first_image.value = "Path to first image"
-        self.path_first_image = widgets.FileEdit()
+        self.folder_label = widgets.Label(value="")
+        self.folder_label.value = "Output folder"
+        self.folder = widgets.FileEdit(mode="d")
 
-        self.regex_label = widgets.Label(value="")
-        self.regex_label.value = "Regex (optional)"
-        self.regex = widgets.LineEdit()
+        self.prefix_label = widgets.Label(value="")
+        self.prefix_label.value = "File name prefix (default: layer name)"
+        self.prefix = widgets.LineEdit()
 
-        self.type_label = widgets.Label(value="")
-        self.type_label.value = "Image type"
-        self.type = widgets.ComboBox(choices=["Labels", "Intensity"])
+        self.format_label = widgets.Label(value="")
+        self.format_label.value = "Format"
+        self.format = widgets.ComboBox(choices=["tif", "mha", "zarr"])
 
-        self.scale_label = widgets.Label(value="")
-        self.scale_label.value = "Scale"
-        self.scale = widgets.TupleEdit(
-            value=[1.0001, 1.0001, 1.0001], label={"max": 10000}
+        self.compress = widgets.CheckBox(
+            value=False, text="Compress files (smaller, slower)"
         )
 
-        # do I want to add a range for t?
-        # Do I want to ask for the background label so I can change it to 0?
-
-        btn_calc = QPushButton("Open sequence")
-        btn_calc.native = btn_calc
-        btn_calc.name = "Open sequence"
-        btn_calc.clicked.connect(self._on_click)
+        btn_save = QPushButton("Save sequence")
+        btn_save.native = btn_save
+        btn_save.name = "Save sequence"
+        btn_save.clicked.connect(self._on_click)
+        self.message = widgets.Label(value="")
+        self.tasks = BackgroundTasks(self.message)
 
         container = widgets.Container(
             widgets=[
-                self.label_path_first_image,
-                self.path_first_image,
-                self.regex_label,
-                self.regex,
-                self.type_label,
-                self.type,
-                self.scale_label,
-                self.scale,
-                btn_calc,
+                self.folder_label,
+                self.folder,
+                self.prefix_label,
+                self.prefix,
+                self.format_label,
+                self.format,
+                self.compress,
+                btn_save,
+                self.message,
+                self.tasks.btn_cancel,
             ],
             labels=False,
         )
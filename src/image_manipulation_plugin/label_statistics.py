@@ -0,0 +1,862 @@
+"""
+Label statistics computed in linear time.
+
+IDs, voxel counts, bounding boxes and centroids of every label are
+obtained with bincount / find_objects passes instead of sorting the
+image with np.unique. The functions do not depend on napari or Qt;
+LabelStatisticsCache only relies on the events of the layer it is given.
+"""
+
+import os
+import threading
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from image_manipulation_plugin.pyramids import full_resolution
+
+# number of voxels processed at once, bounds the size of the temporaries
+CHUNK_SIZE = 2**20
+
+# largest label ID counted directly, larger IDs are compacted first
+DENSE_LIMIT = 2**22
+
+# maximum size of the label x coordinate histograms, beyond which bounding
+# boxes are found with scipy.ndimage.find_objects
+HISTOGRAM_LIMIT = 2**22
+
+
+class LabelStatistics:
+    """
+    Statistics of the labels present in an image.
+
+    Attributes
+    ----------
+    labels : np.ndarray
+        Sorted IDs of the labels present in the image (including background).
+    counts : np.ndarray
+        Number of voxels of each label.
+    bboxes : np.ndarray
+        Array of shape (n_labels, 2, ndim) with the start (inclusive) and
+        stop (exclusive) coordinates of the bounding box of each label.
+    centroids : np.ndarray
+        Array of shape (n_labels, ndim) with the centroid of each label.
+    """
+
+    def __init__(self, labels, counts, bboxes, centroids):
+        self.labels = labels
+        self.counts = counts
+        self.bboxes = bboxes
+        self.centroids = centroids
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return self.index(label) is not None
+
+    def __repr__(self):
+        return f"{type(self).__name__}(n_labels={len(self)})"
+
+    def index(self, label):
+        """Position of `label` in the arrays, None if it is not present"""
+        i = np.searchsorted(self.labels, label)
+        if i < len(self.labels) and self.labels[i] == label:
+            return int(i)
+        return None
+
+    def count(self, label):
+        """Number of voxels of `label` (0 if it is not present)"""
+        i = self.index(label)
+        return 0 if i is None else int(self.counts[i])
+
+    def bbox(self, label):
+        """Bounding box of `label` as a tuple of slices, None if absent"""
+        i = self.index(label)
+        if i is None:
+            return None
+        return tuple(
+            slice(int(start), int(stop)) for start, stop in self.bboxes[i].T
+        )
+
+    def centroid(self, label):
+        """Centroid of `label`, None if absent"""
+        i = self.index(label)
+        return None if i is None else self.centroids[i]
+
+    @classmethod
+    def merge(cls, statistics):
+        """
+        Combine the statistics of several images of the same
+        dimensionality (e.g. all timepoints of a movie).
+        """
+        statistics = list(statistics)
+        labels = np.unique(np.concatenate([s.labels for s in statistics]))
+        ndim = statistics[0].bboxes.shape[-1]
+        counts = np.zeros(len(labels), dtype=np.int64)
+        sums = np.zeros((len(labels), ndim))
+        starts = np.full((len(labels), ndim), np.iinfo(np.int64).max)
+        stops = np.zeros((len(labels), ndim), dtype=np.int64)
+        for s in statistics:
+            i = np.searchsorted(labels, s.labels)
+            counts[i] += s.counts
+            sums[i] += s.centroids * s.counts[:, None]
+            starts[i] = np.minimum(starts[i], s.bboxes[:, 0])
+            stops[i] = np.maximum(stops[i], s.bboxes[:, 1])
+        return cls(
+            labels,
+            counts,
+            np.stack([starts, stops], axis=1),
+            sums / counts[:, None],
+        )
+
+    def relabeled(self, label1, label2):
+        """
+        Statistics after all voxels of `label1` were changed to `label2`
+        """
+        i = self.index(label1)
+        if i is None or label1 == label2:
+            return self
+        count, centroid, bbox = (
+            self.counts[i],
+            self.centroids[i],
+            self.bboxes[i],
+        )
+        keep = np.ones(len(self), dtype=bool)
+        keep[i] = False
+        j = self.index(label2)
+        if j is not None:
+            keep[j] = False
+            total = count + self.counts[j]
+            centroid = (
+                centroid * count + self.centroids[j] * self.counts[j]
+            ) / total
+            bbox = np.stack(
+                [
+                    np.minimum(bbox[0], self.bboxes[j, 0]),
+                    np.maximum(bbox[1], self.bboxes[j, 1]),
+                ]
+            )
+            count = total
+        labels = np.append(self.labels[keep], label2).astype(self.labels.dtype)
+        order = np.argsort(labels, kind="stable")
+        return LabelStatistics(
+            labels[order],
+            np.append(self.counts[keep], count)[order],
+            np.concatenate([self.bboxes[keep], bbox[None]])[order],
+            np.concatenate([self.centroids[keep], centroid[None]])[order],
+        )
+
+    def remapped(self, mapping):
+        """
+        Statistics after the labels were changed according to `mapping`
+        ({old_label: new_label}, missing labels are kept)
+        """
+        new_labels = np.array(
+            [mapping.get(label, label) for label in self.labels.tolist()],
+            dtype=np.int64,
+        )
+        labels, inverse = np.unique(new_labels, return_inverse=True)
+        inverse = inverse.ravel()
+        ndim = self.bboxes.shape[-1]
+        counts = np.bincount(inverse, weights=self.counts).astype(np.int64)
+        sums = np.zeros((len(labels), ndim))
+        np.add.at(sums, inverse, self.centroids * self.counts[:, None])
+        starts = np.full((len(labels), ndim), np.iinfo(np.int64).max)
+        stops = np.zeros((len(labels), ndim), dtype=np.int64)
+        np.minimum.at(starts, inverse, self.bboxes[:, 0])
+        np.maximum.at(stops, inverse, self.bboxes[:, 1])
+        dtype = self.labels.dtype
+        if len(labels) and np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            if labels[0] < info.min or labels[-1] > info.max:
+                dtype = labels.dtype
+        return LabelStatistics(
+            labels.astype(dtype),
+            counts,
+            np.stack([starts, stops], axis=1),
+            sums / counts[:, None],
+        )
+
+    def updated(self, coordinates, old_values, new_values):
+        """
+        Statistics after the voxels at `coordinates` changed from
+        `old_values` to `new_values`, in time proportional to the number
+        of changed voxels. Bounding boxes can only grow: the box of a label
+        that lost voxels is kept, which is still a valid (loose) box.
+
+        Parameters
+        ----------
+        coordinates : array-like
+            Array of shape (ndim, n_voxels) or tuple of index arrays.
+        old_values, new_values : array-like or int
+            Values before and after the change, broadcast to n_voxels.
+
+        Raises
+        ------
+        ValueError
+            If a removed value is not a label of these statistics, i.e. the
+            statistics do not describe the image that was changed.
+        """
+        ndim = self.bboxes.shape[-1]
+        coordinates = np.asarray(coordinates, dtype=np.int64).reshape(ndim, -1)
+        n_voxels = coordinates.shape[1]
+        old_values = np.broadcast_to(old_values, n_voxels).ravel()
+        new_values = np.broadcast_to(new_values, n_voxels).ravel()
+        changed = old_values != new_values
+        if not changed.any():
+            return self
+        coordinates = coordinates[:, changed]
+        removed = _point_statistics(coordinates, old_values[changed])
+        added = _point_statistics(coordinates, new_values[changed])
+        if not np.isin(removed[0], self.labels).all():
+            raise ValueError("The statistics do not match the changed image")
+
+        labels = np.union1d(self.labels, added[0])
+        counts = np.zeros(len(labels), dtype=np.int64)
+        sums = np.zeros((len(labels), ndim))
+        starts = np.full((len(labels), ndim), np.iinfo(np.int64).max)
+        stops = np.zeros((len(labels), ndim), dtype=np.int64)
+
+        i = np.searchsorted(labels, self.labels)
+        counts[i] = self.counts
+        sums[i] = self.centroids * self.counts[:, None]
+        starts[i] = self.bboxes[:, 0]
+        stops[i] = self.bboxes[:, 1]
+        i = np.searchsorted(labels, removed[0])
+        counts[i] -= removed[1]
+        sums[i] -= removed[2]
+        i = np.searchsorted(labels, added[0])
+        counts[i] += added[1]
+        sums[i] += added[2]
+        starts[i] = np.minimum(starts[i], added[3])
+        stops[i] = np.maximum(stops[i], added[4])
+
+        keep = counts > 0
+        counts = counts[keep]
+        return LabelStatistics(
+            labels[keep],
+            counts,
+            np.stack([starts[keep], stops[keep]], axis=1),
+            sums[keep] / counts[:, None],
+        )
+
+
+def _point_statistics(coordinates, values):
+    """
+    Labels, counts, coordinate sums and bounding boxes of a set of voxels
+    """
+    labels, inverse = np.unique(values, return_inverse=True)
+    inverse = inverse.ravel()
+    n = len(labels)
+    counts = np.bincount(inverse, minlength=n)
+    sums = np.stack(
+        [np.bincount(inverse, weights=c, minlength=n) for c in coordinates],
+        axis=1,
+    )
+    starts = np.full((n, len(coordinates)), np.iinfo(np.int64).max)
+    stops = np.zeros((n, len(coordinates)), dtype=np.int64)
+    for axis, c in enumerate(coordinates):
+        np.minimum.at(starts[:, axis], inverse, c)
+        np.maximum.at(stops[:, axis], inverse, c + 1)
+    return labels, counts, sums, starts, stops
+
+
+def _iter_chunks(work, chunk_size):
+    """
+    Iterate over `work` in chunks made of whole trailing blocks, so that
+    the coordinates are tiled from a precomputed grid instead of being
+    unraveled voxel by voxel.
+
+    Yields the flattened chunk (as intp) and, for every axis, either the
+    constant coordinate of the chunk along that axis or a flat array with
+    the coordinate of every voxel of the chunk.
+    """
+    shape = work.shape
+    ndim = work.ndim
+
+    # the trailing block is the largest set of last axes fitting in a chunk
+    block_axis = ndim
+    while block_axis > 0 and np.prod(shape[block_axis - 1 :]) <= chunk_size:
+        block_axis -= 1
+    block_shape = shape[block_axis:]
+    block_size = int(np.prod(block_shape))
+    grids = [grid.reshape(-1) for grid in np.indices(block_shape)]
+
+    if block_axis == 0:
+        yield work.reshape(-1).astype(np.intp, copy=False), grids
+        return
+
+    step_axis = block_axis - 1
+    step = max(1, chunk_size // block_size)
+    for lead in np.ndindex(*shape[:step_axis]):
+        for i0 in range(0, shape[step_axis], step):
+            i1 = min(i0 + step, shape[step_axis])
+            chunk = work[lead + (slice(i0, i1),)]
+            coordinates = list(lead)
+            if i1 - i0 == 1:
+                coordinates.append(i0)
+                coordinates.extend(grids)
+            else:
+                coordinates.append(np.repeat(np.arange(i0, i1), block_size))
+                coordinates.extend(np.tile(grid, i1 - i0) for grid in grids)
+            yield chunk.reshape(-1).astype(np.intp, copy=False), coordinates
+
+
+def _marginal_histograms(work, n, chunk_size):
+    """
+    For every axis, the number of voxels of each label at each coordinate
+    along that axis, as an (n, shape[axis]) array. Counts, bounding boxes
+    and centroids all follow from these histograms.
+    """
+    histograms = [
+        np.zeros((n, length), dtype=np.int64) for length in work.shape
+    ]
+    for chunk, coordinates in _iter_chunks(work, chunk_size):
+        index = np.empty_like(chunk)
+        chunk_counts = None
+        for axis, coordinate in enumerate(coordinates):
+            if isinstance(coordinate, np.ndarray):
+                length = work.shape[axis]
+                np.multiply(chunk, length, out=index)
+                index += coordinate
+                chunk_histogram = np.bincount(
+                    index, minlength=n * length
+                ).reshape(n, length)
+                histograms[axis] += chunk_histogram
+                if chunk_counts is None:
+                    chunk_counts = chunk_histogram.sum(axis=1)
+        for axis, coordinate in enumerate(coordinates):
+            if not isinstance(coordinate, np.ndarray):
+                if chunk_counts is None:
+                    chunk_counts = np.bincount(chunk, minlength=n)
+                histograms[axis][:, coordinate] += chunk_counts
+    return histograms
+
+
+def _statistics_from_histograms(histograms):
+    counts = histograms[0].sum(axis=1)
+    present = np.flatnonzero(counts)
+    counts = counts[present]
+    ndim = len(histograms)
+    bboxes = np.zeros((len(present), 2, ndim), dtype=np.int64)
+    centroids = np.zeros((len(present), ndim))
+    for axis, histogram in enumerate(histograms):
+        histogram = histogram[present]
+        length = histogram.shape[1]
+        occupied = histogram > 0
+        bboxes[:, 0, axis] = occupied.argmax(axis=1)
+        bboxes[:, 1, axis] = length - occupied[:, ::-1].argmax(axis=1)
+        centroids[:, axis] = histogram @ np.arange(length) / counts
+    return present, counts, bboxes, centroids
+
+
+def _statistics_from_objects(work, n, chunk_size):
+    """
+    Fallback for label sets too large for the marginal histograms: weighted
+    bincounts for the centroids and find_objects for the bounding boxes.
+    """
+    counts = np.zeros(n, dtype=np.int64)
+    sums = np.zeros((n, work.ndim))
+    for chunk, coordinates in _iter_chunks(work, chunk_size):
+        chunk_counts = np.bincount(chunk, minlength=n)
+        counts += chunk_counts
+        for axis, coordinate in enumerate(coordinates):
+            if isinstance(coordinate, np.ndarray):
+                sums[:, axis] += np.bincount(
+                    chunk, weights=coordinate, minlength=n
+                )
+            else:
+                sums[:, axis] += coordinate * chunk_counts
+
+    from scipy.ndimage import find_objects
+
+    present = np.flatnonzero(counts)
+    objects = find_objects(work, max_label=n - 1)
+    bboxes = np.zeros((len(present), 2, work.ndim), dtype=np.int64)
+    for j, i in enumerate(present):
+        if i == 0:
+            # find_objects ignores 0, whose box is the whole image
+            bboxes[j, 1] = work.shape
+        else:
+            bboxes[j, 0] = [s.start for s in objects[i - 1]]
+            bboxes[j, 1] = [s.stop for s in objects[i - 1]]
+    counts = counts[present]
+    return present, counts, bboxes, sums[present] / counts[:, None]
+
+
+def label_statistics(image):
+    """
+    Compute the statistics of all labels of an integer image.
+
+    Labels are counted with bincount, so the cost is linear in the number
+    of voxels. If the IDs are negative or very large, they are first
+    compacted with np.unique.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Labels image of any dimensionality.
+
+    Returns
+    -------
+    statistics : LabelStatistics
+    """
+    image = np.asarray(image)
+    ndim = image.ndim
+    if image.size == 0:
+        return LabelStatistics(
+            np.zeros(0, dtype=image.dtype),
+            np.zeros(0, dtype=np.int64),
+            np.zeros((0, 2, ndim), dtype=np.int64),
+            np.zeros((0, ndim)),
+        )
+
+    if image.dtype == bool:
+        image = image.view(np.uint8)
+    min_label, max_label = image.min(), image.max()
+    if min_label < 0 or max_label >= min(DENSE_LIMIT, max(image.size, 2**16)):
+        # sparse IDs: work on their rank, shifted by one so that no label
+        # takes the place of the background in find_objects
+        keys, work = np.unique(image, return_inverse=True)
+        keys = np.concatenate([keys[:1], keys])
+        work = work.reshape(image.shape)
+        work += 1
+    else:
+        keys = np.arange(int(max_label) + 1, dtype=image.dtype)
+        work = image
+    n = len(keys)
+
+    # chunks at least as large as the bincount output keep the pass linear
+    histogram_size = n * max(image.shape)
+    if histogram_size <= HISTOGRAM_LIMIT:
+        present, counts, bboxes, centroids = _statistics_from_histograms(
+            _marginal_histograms(work, n, max(CHUNK_SIZE, histogram_size))
+        )
+    else:
+        present, counts, bboxes, centroids = _statistics_from_objects(
+            work, n, max(CHUNK_SIZE, n)
+        )
+    return LabelStatistics(keys[present], counts, bboxes, centroids)
+
+
+def iter_frame_statistics(image, timepoints=None, max_workers=None):
+    """
+    Compute the label statistics of several timepoints of a movie in
+    parallel threads, a few frames being loaded at a time.
+
+    Parameters
+    ----------
+    image : array-like
+        Labels image whose first axis is time (np.ndarray or LazySequence).
+    timepoints : iterable of int, optional
+        All timepoints by default.
+    max_workers : int, optional
+        Number of threads, the number of CPUs by default.
+
+    Yields
+    ------
+    t : int
+    statistics : LabelStatistics
+        In the order in which the frames are done.
+    """
+    if timepoints is None:
+        timepoints = range(image.shape[0])
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    def frame_statistics(t):
+        return t, label_statistics(image[t])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        try:
+            for t in timepoints:
+                pending.add(executor.submit(frame_statistics, t))
+                while len(pending) >= 2 * max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            # do not load more frames if we failed or were cancelled
+            for future in pending:
+                future.cancel()
+
+
+def timepoint_statistics(image, max_workers=None):
+    """
+    Compute the label statistics of every timepoint of a movie, the frames
+    in parallel.
+
+    Parameters
+    ----------
+    image : array-like
+        Labels image whose first axis is time (np.ndarray or LazySequence).
+    max_workers : int, optional
+        Number of threads, the number of CPUs by default.
+
+    Returns
+    -------
+    statistics : list of LabelStatistics
+        One entry per timepoint.
+    """
+    statistics = [None] * image.shape[0]
+    for t, frame in iter_frame_statistics(image, max_workers=max_workers):
+        statistics[t] = frame
+    return statistics
+
+
+def volume_matrix(statistics, background=0):
+    """
+    Label x time volume matrix of a movie.
+
+    Parameters
+    ----------
+    statistics : list of LabelStatistics
+        Statistics of every timepoint, e.g. from `timepoint_statistics`.
+    background : int
+        Label left out of the matrix.
+
+    Returns
+    -------
+    labels : np.ndarray
+        Sorted IDs of the labels present in at least one timepoint.
+    volumes : np.ndarray
+        int64 array of shape (len(labels), len(statistics)), the number of
+        voxels of every label at every timepoint (0 where it is absent).
+    """
+    frame_labels = [s.labels[s.labels != background] for s in statistics]
+    frame_counts = [s.counts[s.labels != background] for s in statistics]
+    all_labels = np.concatenate([np.zeros(0, dtype=np.int64)] + frame_labels)
+    labels, rows = np.unique(all_labels, return_inverse=True)
+    columns = np.repeat(
+        np.arange(len(statistics)), [len(l) for l in frame_labels]
+    )
+    volumes = np.zeros((len(labels), len(statistics)), dtype=np.int64)
+    volumes[rows.reshape(-1), columns] = np.concatenate(
+        [np.zeros(0, dtype=np.int64)] + frame_counts
+    )
+    return labels, volumes
+
+
+def label_table(statistics, background=None):
+    """
+    Table of the labels of a movie: ID, voxel count over all timepoints and
+    first and last timepoint where the label is present. It is computed
+    with sorts of the per-timepoint labels, never with a label x time
+    matrix, so that it stays cheap for hundreds of thousands of labels.
+
+    Parameters
+    ----------
+    statistics : list of LabelStatistics
+        Statistics of every timepoint, a single one for 2D/3D images.
+    background : int, optional
+        Label left out of the table, all labels are kept by default.
+
+    Returns
+    -------
+    table : dict of np.ndarray
+        "label", "count", "first" and "last" columns, sorted by label.
+    """
+    # the labels keep their dtype (uint64 and int64 would mix into floats)
+    all_labels = np.concatenate(
+        [s.labels for s in statistics] or [np.zeros(0, dtype=np.int64)]
+    )
+    all_counts = np.concatenate(
+        [s.counts for s in statistics] or [np.zeros(0, dtype=np.int64)]
+    )
+    timepoints = np.repeat(
+        np.arange(len(statistics)), [len(s) for s in statistics]
+    )
+    if background is not None:
+        keep = all_labels != background
+        all_labels = all_labels[keep]
+        all_counts = all_counts[keep]
+        timepoints = timepoints[keep]
+    labels, first, inverse = np.unique(
+        all_labels, return_index=True, return_inverse=True
+    )
+    # timepoints are increasing, so the first occurrence of a label is its
+    # first timepoint and its first occurrence in reverse its last one
+    _, last = np.unique(all_labels[::-1], return_index=True)
+    counts = np.bincount(
+        inverse.reshape(-1), weights=all_counts, minlength=len(labels)
+    )
+    return {
+        "label": labels,
+        "count": counts.astype(np.int64),
+        "first": timepoints[first],
+        "last": timepoints[::-1][last],
+    }
+
+
+class LabelStatisticsCache:
+    """
+    Label statistics of a napari labels layer, kept in sync with it.
+
+    Statistics are computed once per timepoint (4D layers) or once for the
+    whole image, then updated incrementally from the painted voxels carried
+    by the layer's paint events, so that repeated queries on an unchanged
+    layer cost nothing. Replacing the layer data drops the cache, as does
+    an undo/redo, which napari applies without a paint event. Code writing
+    directly into `layer.data` must call `invalidate`.
+
+    Statistics can be computed in a background thread with `compute`,
+    while edits keep updating the cache from the GUI thread.
+
+    Use `statistics_cache` to get the cache of a layer.
+    """
+
+    def __init__(self, layer):
+        # the layer owns its cache, not the other way around
+        self._layer = weakref.ref(layer)
+        self._frames = {}
+        self._movie = None
+        # bumped by every edit, so that statistics computed in the
+        # background from older data are not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._history_length = self._get_history_length()
+        layer.events.data.connect(self._on_data)
+        layer.events.paint.connect(self._on_paint)
+        layer.events.set_data.connect(self._on_set_data)
+
+    @property
+    def layer(self):
+        return self._layer()
+
+    @property
+    def data(self):
+        """Full resolution data of the layer (first level if multiscale)"""
+        return full_resolution(self.layer)
+
+    @property
+    def per_timepoint(self):
+        return self.data.ndim == 4
+
+    @property
+    def n_frames(self):
+        """Number of frames with their own statistics (timepoints if 4D)"""
+        return self.data.shape[0] if self.per_timepoint else 1
+
+    def _get_history_length(self):
+        return (
+            len(getattr(self.layer, "_undo_history", ())),
+            len(getattr(self.layer, "_redo_history", ())),
+        )
+
+    def frame(self, t=None):
+        """
+        Statistics of timepoint `t` of a 4D layer, or of the whole image
+        of a 2D/3D layer (`t` is then ignored).
+        """
+        key = t if self.per_timepoint else None
+        if key not in self._frames:
+            data = self.data
+            self._frames[key] = label_statistics(
+                data if key is None else data[key]
+            )
+        return self._frames[key]
+
+    def compute(self, timepoints=None, max_workers=None):
+        """
+        Compute the missing statistics of the given timepoints (all by
+        default), several frames in parallel, yielding after each timepoint
+        so that it can run in a background worker with progress and
+        cancellation.
+        """
+        if not self.per_timepoint:
+            keys = [None]
+        elif timepoints is None:
+            keys = range(self.data.shape[0])
+        else:
+            keys = timepoints
+        generation = self._generation
+        data = self.data
+        missing = [key for key in keys if key not in self._frames]
+        for _ in range(len(keys) - len(missing)):
+            yield
+        if missing == [None]:
+            frames = [(None, label_statistics(data))]
+        else:
+            frames = iter_frame_statistics(data, missing, max_workers)
+        for key, statistics in frames:
+            with self._lock:
+                if generation == self._generation:
+                    self._frames[key] = statistics
+            yield
+
+    def movie(self):
+        """Statistics of the whole layer (all timepoints merged)"""
+        if not self.per_timepoint:
+            return self.frame()
+        if self._movie is None:
+            self._movie = LabelStatistics.merge(
+                self.frame(t) for t in range(self.data.shape[0])
+            )
+        return self._movie
+
+    def table(self, background=None):
+        """
+        ID, voxel count and timepoint range of every label of the layer,
+        see `label_table`
+        """
+        if not self.per_timepoint:
+            return label_table([self.frame()], background)
+        return label_table(
+            [self.frame(t) for t in range(self.data.shape[0])], background
+        )
+
+    def invalidate(self, timepoints=None):
+        """
+        Forget the statistics of the given timepoints (all by default)
+        """
+        with self._lock:
+            self._generation += 1
+            if timepoints is None or not self.per_timepoint:
+                self._frames.clear()
+            else:
+                for t in np.atleast_1d(timepoints):
+                    self._frames.pop(int(t), None)
+            self._movie = None
+
+    def boxes(self, label, timepoints=None):
+        """
+        Bounding boxes of `label` in layer coordinates, one per timepoint
+        containing it (a single one for 2D/3D layers).
+
+        Parameters
+        ----------
+        label : int
+        timepoints : iterable of int, optional
+            Timepoints to look at, all of them by default.
+        """
+        if not self.per_timepoint:
+            box = self.frame().bbox(label)
+            return [] if box is None else [box]
+        if timepoints is None:
+            timepoints = range(self.data.shape[0])
+        boxes = []
+        for t in timepoints:
+            box = self.frame(t).bbox(label)
+            if box is not None:
+                boxes.append((slice(t, t + 1),) + box)
+        return boxes
+
+    def relabel(self, label1, label2, timepoints=None):
+        """
+        Update the statistics after `label1` was changed to `label2` in
+        the given timepoints (all by default)
+        """
+        with self._lock:
+            self._generation += 1
+            for key in list(self._frames):
+                if timepoints is None or key is None or key in timepoints:
+                    self._frames[key] = self._frames[key].relabeled(
+                        label1, label2
+                    )
+            self._movie = None
+
+    def remap(self, mapping, timepoints=None):
+        """
+        Update the statistics after the labels of the given timepoints
+        (all by default) were changed according to `mapping`
+        """
+        with self._lock:
+            self._generation += 1
+            for key in list(self._frames):
+                if timepoints is None or key is None or key in timepoints:
+                    self._frames[key] = self._frames[key].remapped(mapping)
+            self._movie = None
+
+    def _on_data(self, event=None):
+        self.invalidate()
+        self._history_length = self._get_history_length()
+
+    def _on_set_data(self, event=None):
+        history_length = self._get_history_length()
+        if history_length != self._history_length:
+            # the history changed without a paint event: undo or redo
+            self.invalidate()
+            self._history_length = history_length
+
+    def _on_paint(self, event):
+        self._history_length = self._get_history_length()
+        try:
+            for atom in event.value:
+                self._apply_atom(atom)
+        except (TypeError, ValueError):
+            # unknown history format or out of sync statistics
+            self.invalidate()
+
+    def _apply_atom(self, atom):
+        if hasattr(atom, "slice_key"):
+            # mask based edit of a bounding box (fill, paint, polygon)
+            offset = [s.start or 0 for s in atom.slice_key]
+            if atom.mask is None:
+                shape = [s.stop - (s.start or 0) for s in atom.slice_key]
+                local = np.indices(shape).reshape(len(shape), -1)
+            else:
+                local = np.array(np.nonzero(atom.mask))
+            coordinates = local + np.array(offset)[:, None]
+            old_values, new_values = atom.old_values, atom.new_value
+        else:
+            indices, old_values, new_values = atom
+            coordinates = np.array([np.ravel(i) for i in indices])
+        old_values = np.ravel(old_values)
+        self._update(coordinates, old_values, new_values)
+
+    def update(self, coordinates, old_values, new_values):
+        """
+        Update the statistics after the voxels at `coordinates` (layer
+        coordinates, shape (ndim, n_voxels)) changed from `old_values` to
+        `new_values`. Falls back to invalidation if they are out of sync.
+        """
+        try:
+            self._update(coordinates, old_values, new_values)
+        except ValueError:
+            self.invalidate()
+
+    def _update(self, coordinates, old_values, new_values):
+        with self._lock:
+            self._generation += 1
+            self._update_frames(coordinates, old_values, new_values)
+
+    def _update_frames(self, coordinates, old_values, new_values):
+        coordinates = np.asarray(coordinates)
+        old_values = np.broadcast_to(old_values, coordinates.shape[1])
+        new_values = np.broadcast_to(new_values, coordinates.shape[1])
+        if not self.per_timepoint:
+            if None in self._frames:
+                self._frames[None] = self._frames[None].updated(
+                    coordinates, old_values, new_values
+                )
+            return
+        self._movie = None
+        for t in np.unique(coordinates[0]):
+            t = int(t)
+            if t in self._frames:
+                in_frame = coordinates[0] == t
+                self._frames[t] = self._frames[t].updated(
+                    coordinates[1:, in_frame],
+                    old_values[in_frame],
+                    new_values[in_frame],
+                )
+
+
+_caches = weakref.WeakKeyDictionary()
+
+
+def statistics_cache(layer):
+    """
+    Return the LabelStatisticsCache of a napari labels layer, creating it
+    and connecting it to the layer events on first use.
+    """
+    if layer not in _caches:
+        _caches[layer] = LabelStatisticsCache(layer)
+    return _caches[layer]
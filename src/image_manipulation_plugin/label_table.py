@@ -0,0 +1,162 @@
+"""
+Table view of the labels of a layer.
+
+The table is a Qt model over the columns returned by
+label_statistics.label_table, so that the view only asks for the cells of
+the rows on screen: listing hundreds of thousands of labels costs a few
+numpy arrays, not one widget or string per label. Sorting and searching
+are done on the arrays with numpy and only reorder the rows.
+"""
+
+import numpy as np
+from qtpy.QtCore import QAbstractTableModel, QModelIndex, Qt
+from qtpy.QtWidgets import QAbstractItemView, QHeaderView, QTableView
+
+# (header, column of label_statistics.label_table)
+COLUMNS = (
+    ("Label", "label"),
+    ("Voxels", "count"),
+    ("First t", "first"),
+    ("Last t", "last"),
+)
+
+
+def parse_search(text):
+    """
+    Range of labels searched for: "12" for one label, "10-20" for a range
+    (inclusive), empty for all labels
+
+    Returns
+    -------
+    low, high : int or None
+        None for no bound.
+
+    Raises
+    ------
+    ValueError
+        If the text is not a label or a range of labels.
+    """
+    text = text.strip()
+    if not text:
+        return None, None
+    if "-" in text[1:]:
+        # the first character may be the sign of a negative label
+        split = text.index("-", 1)
+        low, high = text[:split], text[split + 1 :]
+        return int(low), int(high)
+    return int(text), int(text)
+
+
+class LabelTableModel(QAbstractTableModel):
+    """
+    Qt table model of the labels of a layer.
+
+    Parameters
+    ----------
+    table : dict of np.ndarray, optional
+        Columns of label_statistics.label_table, empty by default.
+    """
+
+    def __init__(self, table=None, parent=None):
+        super().__init__(parent)
+        self._columns = [np.zeros(0, dtype=np.int64) for _ in COLUMNS]
+        # rows shown, as indices into the columns
+        self._rows = np.zeros(0, dtype=np.intp)
+        self._sort_column = 0
+        self._sort_order = Qt.AscendingOrder
+        self._search = (None, None)
+        if table is not None:
+            self.set_table(table)
+
+    def set_table(self, table):
+        """Show new columns, keeping the search and the sort order"""
+        self.beginResetModel()
+        self._columns = [np.asarray(table[key]) for _, key in COLUMNS]
+        self._update_rows()
+        self.endResetModel()
+
+    def search(self, text):
+        """
+        Only show the labels searched for, see `parse_search`
+
+        Raises
+        ------
+        ValueError
+            If the text is not a label or a range of labels.
+        """
+        search = parse_search(text)
+        self.beginResetModel()
+        self._search = search
+        self._update_rows()
+        self.endResetModel()
+
+    def _update_rows(self):
+        labels = self._columns[0]
+        low, high = self._search
+        keep = np.ones(len(labels), dtype=bool)
+        if low is not None:
+            keep &= labels >= low
+        if high is not None:
+            keep &= labels <= high
+        rows = np.flatnonzero(keep)
+        values = self._columns[self._sort_column][rows]
+        # stable, so that rows with the same value stay sorted by label
+        if self._sort_order == Qt.DescendingOrder:
+            order = np.argsort(values[::-1], kind="stable")
+            order = (len(values) - 1 - order)[::-1]
+        else:
+            order = np.argsort(values, kind="stable")
+        self._rows = rows[order]
+
+    def label(self, row):
+        """Label shown at `row`"""
+        return self._columns[0][self._rows[row]]
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(COLUMNS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            value = self._columns[index.column()][self._rows[index.row()]]
+            return str(value)
+        if role == Qt.TextAlignmentRole:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return COLUMNS[section][0]
+        return None
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        self._sort_column = column
+        self._sort_order = order
+        self._update_rows()
+        self.layoutChanged.emit()
+
+
+def label_table_view(model):
+    """
+    Read-only, sortable view of a LabelTableModel. Rows have a fixed
+    height so that Qt never measures the rows off screen.
+    """
+    view = QTableView()
+    view.setModel(model)
+    view.setSortingEnabled(True)
+    view.sortByColumn(0, Qt.AscendingOrder)
+    view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+    view.setSelectionBehavior(QAbstractItemView.SelectRows)
+    view.verticalHeader().hide()
+    view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+    view.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+    return view
@@ -0,0 +1,328 @@
+"""
+Headless versions of the operations of the widgets.
+
+The functions take numpy arrays (or memory-mapped files, LazySequence or
+Zarr arrays) and return numpy arrays. They do not depend on napari or Qt,
+so they can run in scripts, in the command line interface (cli.py) and
+on cluster nodes. The widgets call the same functions, the generator
+versions being run in background workers for progress and cancellation.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_manipulation_plugin.connected_components import (
+    iter_label_components,
+)
+from image_manipulation_plugin.connected_components import (
+    n_steps as n_component_steps,
+)
+from image_manipulation_plugin.generators import exhaust
+from image_manipulation_plugin.intensity_histograms import (
+    intensity_histogram,
+    intensity_range,
+    threshold_from_histogram,
+)
+from image_manipulation_plugin.label_statistics import (
+    iter_frame_statistics,
+    label_statistics,
+    volume_matrix,
+)
+from image_manipulation_plugin.profiling import profiled
+from image_manipulation_plugin.thresholding import (
+    create_output,
+    frame_chunks,
+    iter_threshold,
+    iter_threshold_frames,
+    n_blocks,
+)
+
+
+@profiled
+def threshold_value(image, method="Otsu", value=None, percentile=False):
+    """
+    Intensity threshold of an image, computed in chunks.
+
+    Parameters
+    ----------
+    image : array-like
+        Intensity image.
+    method : str
+        One of intensity_histograms.THRESHOLD_METHODS, used if `value` is
+        not given.
+    value : float, optional
+        Manual threshold, in % of the maximum intensity or as a percentile.
+    percentile : bool
+        Whether `value` is a percentile.
+
+    Returns
+    -------
+    threshold : float
+    """
+    if value is None:
+        return threshold_from_histogram(
+            intensity_histogram(image), method, image
+        )
+    if percentile:
+        return intensity_histogram(image).quantile(value / 100)
+    return intensity_range(image)[1] * (value / 100)
+
+
+def iter_segment(
+    image, threshold, below=False, min_size=None, path=None, dtype=None
+):
+    """
+    Labels image of the voxels above (or below) `threshold`, computed block
+    by block in parallel, in memory or in the file `path` (.npy or .zarr).
+    Yields for progress and returns the labels image.
+
+    Parameters
+    ----------
+    image : array-like
+        Intensity image.
+    threshold : float
+    below : bool
+        Select the voxels below the threshold (e.g. electron microscopy).
+    min_size : int, optional
+        If given, the connected components of at least `min_size` voxels
+        are labeled (per timepoint for 4D images) instead of a binary
+        uint8 image.
+    path : str, optional
+    dtype : np.dtype, optional
+        dtype of the labels, by default uint8 for binary images and the
+        smallest one holding the number of components otherwise.
+    """
+    if min_size is not None:
+        labels = yield from iter_label_components(
+            image, threshold, below, min_size=min_size, path=path, dtype=dtype
+        )
+        return labels
+    out = create_output(image.shape, path, dtype=dtype or np.uint8)
+    binary = yield from iter_threshold(image, threshold, below, out)
+    return binary
+
+
+def n_segment_steps(shape, min_size=None):
+    """Number of values yielded by `iter_segment`, for progress bars"""
+    if min_size is not None:
+        return n_component_steps(shape)
+    return n_blocks(shape)
+
+
+def iter_frame_thresholds(
+    image, method="Otsu", value=None, percentile=False, max_workers=None
+):
+    """
+    Threshold of every timepoint of a 4D image (see `threshold_value`),
+    one frame per thread. Yields after each frame and returns the
+    thresholds as an np.ndarray.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    def frame_threshold(t):
+        frame = np.asarray(image[t])
+        return threshold_value(frame, method, value, percentile)
+
+    thresholds = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for threshold in executor.map(frame_threshold, range(len(image))):
+            thresholds.append(threshold)
+            yield
+    return np.array(thresholds, dtype=np.float64)
+
+
+def iter_segment_timepoints(
+    image,
+    method="Otsu",
+    value=None,
+    percentile=False,
+    below=False,
+    min_size=None,
+    path=None,
+    dtype=None,
+    max_workers=None,
+):
+    """
+    Threshold every timepoint of a 4D image with its own threshold, which
+    follows intensity drifts over time, the frames being processed in
+    parallel threads. See `threshold_value` and `iter_segment` for the
+    parameters. Yields for progress and returns the thresholds and the
+    labels image.
+
+    Binary images are written frame by frame into the output, reading
+    every frame once. Connected components first need the thresholds of
+    all frames.
+
+    Returns
+    -------
+    thresholds : np.ndarray
+        Threshold of every timepoint.
+    labels : array-like
+    """
+    if min_size is not None:
+        thresholds = yield from iter_frame_thresholds(
+            image, method, value, percentile, max_workers
+        )
+        labels = yield from iter_label_components(
+            image,
+            thresholds,
+            below,
+            min_size=min_size,
+            path=path,
+            max_workers=max_workers,
+            dtype=dtype,
+        )
+        return thresholds, labels
+
+    def frame_threshold(frame):
+        return threshold_value(frame, method, value, percentile)
+
+    # every frame is written whole by one thread, Zarr chunks must not
+    # span two timepoints
+    out = create_output(
+        image.shape,
+        path,
+        dtype=dtype or np.uint8,
+        chunks=frame_chunks(image.shape),
+    )
+    result = yield from iter_threshold_frames(
+        image, frame_threshold, below, out, max_workers
+    )
+    return result
+
+
+def n_segment_timepoints_steps(shape, min_size=None):
+    """
+    Number of values yielded by `iter_segment_timepoints`, for progress
+    bars
+    """
+    if min_size is not None:
+        return shape[0] + n_component_steps(shape)
+    return shape[0]
+
+
+@profiled
+def segment(
+    image,
+    method="Otsu",
+    value=None,
+    percentile=False,
+    below=False,
+    min_size=None,
+    path=None,
+    dtype=None,
+    per_timepoint=False,
+):
+    """
+    Threshold an intensity image, see `threshold_value` and `iter_segment`
+    for the parameters. With `per_timepoint`, every timepoint of a 4D
+    image gets its own threshold (see `iter_segment_timepoints`).
+
+    Returns
+    -------
+    threshold : float, or np.ndarray for 4D images with `per_timepoint`
+    labels : array-like
+    """
+    if per_timepoint and image.ndim == 4:
+        return exhaust(
+            iter_segment_timepoints(
+                image, method, value, percentile, below, min_size, path, dtype
+            )
+        )
+    threshold = threshold_value(image, method, value, percentile)
+    labels = exhaust(
+        iter_segment(image, threshold, below, min_size, path, dtype)
+    )
+    return threshold, labels
+
+
+def iter_volume_table(image, max_workers=None):
+    """
+    Label x time volume matrix of a labels image, with one bincount-based
+    pass per frame and the frames in parallel threads. Yields after each
+    frame and returns the labels and the matrix (see
+    label_statistics.volume_matrix). 2D and 3D images have one timepoint.
+    """
+    if image.ndim != 4:
+        statistics = [label_statistics(image)]
+        yield
+    else:
+        statistics = [None] * image.shape[0]
+        for t, frame in iter_frame_statistics(image, max_workers=max_workers):
+            statistics[t] = frame
+            yield
+    return volume_matrix(statistics)
+
+
+@profiled
+def volume_table(image, max_workers=None):
+    """
+    Label x time volume matrix of a labels image, see `iter_volume_table`.
+
+    Returns
+    -------
+    labels : np.ndarray
+    volumes : np.ndarray
+        Array of shape (len(labels), number of timepoints).
+    """
+    return exhaust(iter_volume_table(image, max_workers))
+
+
+@profiled
+def label_volumes(image):
+    """
+    Number of voxels of every label, per timepoint for 4D images.
+
+    Parameters
+    ----------
+    image : array-like
+        Labels image.
+
+    Returns
+    -------
+    volumes : dict
+        "timepoint", "label" and "volume" arrays of the same length, sorted
+        by timepoint, the timepoint being 0 for 2D and 3D images. The
+        background is left out.
+    """
+    labels, volumes = volume_table(image)
+    timepoints, rows = np.nonzero(volumes.T)
+    return {
+        "timepoint": timepoints,
+        "label": labels[rows],
+        "volume": volumes[rows, timepoints],
+    }
+
+
+@profiled
+def write_volume_table(path, labels, volumes):
+    """
+    Write a label x time volume matrix to a CSV file, or to a Parquet file
+    if `path` ends with ".parquet" (pandas and pyarrow or fastparquet must
+    then be installed). There is one row per label and one column per
+    timepoint.
+    """
+    path = str(path)
+    columns = [f"t{t}" for t in range(volumes.shape[1])]
+    if path.endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError(
+                "Writing to a .parquet file requires the pandas package"
+            ) from None
+        table = pd.DataFrame(volumes, columns=columns)
+        table.insert(0, "label", labels)
+        table.to_parquet(path, index=False)
+        return
+    np.savetxt(
+        path,
+        np.column_stack([labels, volumes]),
+        fmt="%d",
+        delimiter=",",
+        header=",".join(["label"] + columns),
+        comments="",
+    )
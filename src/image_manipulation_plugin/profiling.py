@@ -0,0 +1,336 @@
+"""
+Timing and memory instrumentation of the widget actions.
+
+The `_on_click` handlers of the widgets, the computations they run in
+background workers and the headless functions of processing.py are
+wrapped by the profiler. While it is enabled, every call is recorded with
+its wall time, the peak memory allocated during the call (tracemalloc,
+which also sees the numpy allocations), the shape and dtype of the arrays
+or layers it works on, its thread and how it ended. Records are kept in
+memory and can be appended to a JSON lines file. When the profiler is
+disabled (the default), the wrappers only cost an attribute lookup.
+
+From the napari console or a script::
+
+    from image_manipulation_plugin import profiling
+    profiling.enable("actions.jsonl")
+    ...
+    profiling.summary()
+    profiling.disable()
+
+Setting the IMAGE_MANIPULATION_PROFILE environment variable to a file
+path enables the profiler at import time, e.g. for batch jobs.
+The module does not depend on napari or Qt.
+"""
+
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+# number of records kept in memory, the oldest ones are dropped
+MAX_RECORDS = 1000
+
+# environment variable enabling the profiler at import time
+ENVIRONMENT_VARIABLE = "IMAGE_MANIPULATION_PROFILE"
+
+
+def _array_info(data):
+    """Shape and dtype of an array-like, None if it is not one"""
+    if isinstance(data, (list, tuple)) and data and hasattr(data[0], "shape"):
+        # multiscale layer, the full resolution matters
+        data = data[0]
+    if hasattr(data, "shape") and hasattr(data, "dtype"):
+        return {"shape": list(data.shape), "dtype": str(data.dtype)}
+    return None
+
+
+def _describe(obj):
+    """
+    Arrays an argument works on: arrays, layers (with their name), the
+    layer of a cache and the selected layer of a widget
+    """
+    info = _array_info(obj)
+    if info is not None:
+        return info
+    if hasattr(obj, "data") and hasattr(obj, "name"):
+        info = _array_info(obj.data)
+        if info is not None:
+            info["layer"] = str(obj.name)
+        return info
+    layer = getattr(obj, "layer", None)
+    if layer is None and hasattr(obj, "viewer"):
+        layer = getattr(obj.viewer.layers.selection, "active", None)
+    if layer is not None and not callable(layer):
+        return _describe(layer)
+    return None
+
+
+def _arrays(function, args, kwargs):
+    objects = list(args) + list(kwargs.values())
+    owner = getattr(function, "__self__", None)
+    if owner is not None:
+        objects.insert(0, owner)
+    arrays = []
+    for obj in objects:
+        info = _describe(obj)
+        if info is not None:
+            arrays.append(info)
+    return arrays
+
+
+def _n_positional(function):
+    """
+    Number of positional arguments `function` accepts, None if unlimited
+    """
+    try:
+        parameters = inspect.signature(function).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    n = 0
+    for parameter in parameters:
+        if parameter.kind == parameter.VAR_POSITIONAL:
+            return None
+        if parameter.kind in (
+            parameter.POSITIONAL_ONLY,
+            parameter.POSITIONAL_OR_KEYWORD,
+        ):
+            n += 1
+    return n
+
+
+class Profiler:
+    """
+    Records the calls of the wrapped functions while it is enabled.
+
+    Parameters
+    ----------
+    max_records : int
+        Number of records kept in memory.
+    """
+
+    def __init__(self, max_records=MAX_RECORDS):
+        self.enabled = False
+        self.trace_memory = False
+        self.path = None
+        self.records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+        # number of calls being recorded, the peak is only reset when there
+        # is none so that nested calls do not hide the peak of the outer one
+        self._active = 0
+
+    def enable(self, path=None, trace_memory=True):
+        """
+        Start recording.
+
+        Parameters
+        ----------
+        path : str, optional
+            JSON lines file the records are appended to.
+        trace_memory : bool
+            Measure the peak memory of the calls with tracemalloc, which
+            slows down the allocations of Python objects.
+        """
+        self.path = None if path is None else str(path)
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording, the records are kept"""
+        self.enabled = False
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def clear(self):
+        self.records.clear()
+
+    def summary(self):
+        """
+        Statistics of the recorded calls of every function.
+
+        Returns
+        -------
+        summary : dict
+            {name: {"calls", "total_time", "max_time", "max_peak_memory"}}
+        """
+        summary = {}
+        for record in list(self.records):
+            entry = summary.setdefault(
+                record["name"],
+                {
+                    "calls": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                    "max_peak_memory": None,
+                },
+            )
+            entry["calls"] += 1
+            entry["total_time"] += record["wall_time"]
+            entry["max_time"] = max(entry["max_time"], record["wall_time"])
+            if record["peak_memory"] is not None:
+                entry["max_peak_memory"] = max(
+                    entry["max_peak_memory"] or 0, record["peak_memory"]
+                )
+        return summary
+
+    def _start(self):
+        with self._lock:
+            self._active += 1
+            if not (self.trace_memory and tracemalloc.is_tracing()):
+                return None
+            # the peak is global to the process: the peak of calls nested in
+            # or overlapping with others includes the allocations of those
+            if self._active == 1 and hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            return tracemalloc.get_traced_memory()[0]
+
+    def _add(self, name, arrays, start, wall_start, memory_start, status):
+        peak_memory = None
+        if memory_start is not None and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            peak_memory = max(peak - memory_start, 0)
+        record = {
+            "name": name,
+            "start": start,
+            "wall_time": time.perf_counter() - wall_start,
+            "peak_memory": peak_memory,
+            "arrays": arrays,
+            "thread": threading.current_thread().name,
+            "status": status,
+        }
+        with self._lock:
+            self._active -= 1
+            self.records.append(record)
+            if self.path is not None:
+                with open(self.path, "a") as sink:
+                    sink.write(json.dumps(record) + "\n")
+
+    def wrap(self, function, name=None):
+        """
+        Wrap a function or a generator function (which is timed from its
+        first to its last step) so that its calls are recorded.
+        """
+        if getattr(function, "__profiled__", False):
+            return function
+        if name is None:
+            name = getattr(function, "__qualname__", repr(function))
+        profiler = self
+
+        if inspect.isgeneratorfunction(function):
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not profiler.enabled:
+                    return (yield from function(*args, **kwargs))
+                arrays = _arrays(function, args, kwargs)
+                start, wall_start = time.time(), time.perf_counter()
+                memory_start = profiler._start()
+                status = "error"
+                try:
+                    result = yield from function(*args, **kwargs)
+                    status = "done"
+                    return result
+                except GeneratorExit:
+                    status = "cancelled"
+                    raise
+                finally:
+                    profiler._add(
+                        name, arrays, start, wall_start, memory_start, status
+                    )
+
+        else:
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not profiler.enabled:
+                    return function(*args, **kwargs)
+                arrays = _arrays(function, args, kwargs)
+                start, wall_start = time.time(), time.perf_counter()
+                memory_start = profiler._start()
+                status = "error"
+                try:
+                    result = function(*args, **kwargs)
+                    status = "done"
+                    return result
+                finally:
+                    profiler._add(
+                        name, arrays, start, wall_start, memory_start, status
+                    )
+
+        wrapper.__profiled__ = True
+        return wrapper
+
+    def wrap_handler(self, method):
+        """
+        Wrap a Qt slot. Qt passes the arguments of the signal (e.g. the
+        `checked` state of a button) to generic wrappers, so the extra ones
+        are dropped like Qt does for the method itself.
+        """
+        n_positional = _n_positional(method)
+        wrapped = self.wrap(method)
+
+        @functools.wraps(method)
+        def handler(*args, **kwargs):
+            if n_positional is not None:
+                args = args[:n_positional]
+            return wrapped(*args, **kwargs)
+
+        handler.__profiled__ = True
+        return handler
+
+
+# profiler of the plugin
+profiler = Profiler()
+
+
+def profiled(function):
+    """Decorator recording the calls of `function` with the profiler"""
+    return profiler.wrap(function)
+
+
+def profile_handlers(cls):
+    """
+    Class decorator recording the calls of all the `_on_click` handlers of
+    a widget class with the profiler
+    """
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_on_click") and callable(method):
+            setattr(cls, name, profiler.wrap_handler(method))
+    return cls
+
+
+def enable(path=None, trace_memory=True):
+    """Start recording the widget actions, see Profiler.enable"""
+    profiler.enable(path, trace_memory)
+
+
+def disable():
+    """Stop recording the widget actions"""
+    profiler.disable()
+
+
+def records():
+    """Recorded calls, oldest first, as a list of dicts"""
+    return list(profiler.records)
+
+
+def summary():
+    """Statistics of the recorded calls of every function"""
+    return profiler.summary()
+
+
+def clear():
+    profiler.clear()
+
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    enable(os.environ[ENVIRONMENT_VARIABLE])
@@ -0,0 +1,196 @@
+"""
+Multiscale pyramids of large images, for fluid rendering in napari.
+
+Every level halves the spatial axes that are still large (time, the first
+axis of 4D images, is never downsampled). Intensity images are averaged
+over 2x2(x2) blocks and labels images take the most frequent label of
+each block, so that no new label appears. The first level is computed
+slab by slab from the original image, which can stay lazy or
+memory-mapped, and the following ones from the previous level, in a pool
+of threads. The functions do not depend on napari or Qt.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# spatial size below which no further level is built
+MIN_SIZE = 256
+
+# axes shorter than this are not downsampled (e.g. few z slices)
+MIN_AXIS_SIZE = 32
+
+# number of voxels read at once by one thread
+CHUNK_SIZE = 2**24
+
+
+def full_resolution(layer):
+    """
+    Data of a napari layer, its first level if it is multiscale (the
+    level every computation of the plugin works on)
+    """
+    return layer.data[0] if layer.multiscale else layer.data
+
+
+def pyramid_shapes(shape, min_size=None):
+    """
+    Shapes of the levels of the pyramid of an image of the given shape,
+    the first one being the image itself
+    """
+    if min_size is None:
+        min_size = MIN_SIZE
+    first_spatial = 1 if len(shape) == 4 else 0
+    shapes = [tuple(shape)]
+    while max(shapes[-1][first_spatial:]) > min_size:
+        previous = shapes[-1]
+        factors = _factors(previous, first_spatial)
+        if all(f == 1 for f in factors):
+            break
+        shapes.append(tuple(-(-n // f) for n, f in zip(previous, factors)))
+    return shapes
+
+
+def _factors(shape, first_spatial):
+    return tuple(
+        2 if axis >= first_spatial and n >= 2 * MIN_AXIS_SIZE else 1
+        for axis, n in enumerate(shape)
+    )
+
+
+def _blocks(data, factors):
+    """
+    View of `data` (padded with its edge values to multiples of `factors`)
+    as an array of shape (*downsampled shape, voxels per block)
+    """
+    padding = [(0, -n % f) for n, f in zip(data.shape, factors)]
+    if any(after for _, after in padding):
+        data = np.pad(data, padding, mode="edge")
+    split = []
+    for n, f in zip(data.shape, factors):
+        split += [n // f, f]
+    data = data.reshape(split)
+    ndim = len(factors)
+    order = list(range(0, 2 * ndim, 2)) + list(range(1, 2 * ndim, 2))
+    data = data.transpose(order)
+    return data.reshape(data.shape[:ndim] + (-1,))
+
+
+def downsample_mean(data, factors):
+    """Average of the blocks of `data`, in the dtype of `data`"""
+    mean = _blocks(data, factors).mean(axis=-1)
+    if np.issubdtype(data.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(data.dtype)
+
+
+def downsample_mode(data, factors):
+    """
+    Most frequent label of the blocks of `data` (the first one in the
+    block in case of a tie)
+    """
+    blocks = _blocks(data, factors)
+    size = blocks.shape[-1]
+    if size == 1:
+        return blocks[..., 0].copy()
+    # blocks are tiny (at most 8 voxels): count the matches of every voxel
+    # with all the others instead of sorting
+    counts = np.zeros(blocks.shape, dtype=np.uint8)
+    for i in range(size):
+        counts += blocks == blocks[..., i : i + 1]
+    best = np.argmax(counts, axis=-1)
+    return np.take_along_axis(blocks, best[..., None], axis=-1)[..., 0]
+
+
+def _slabs(shape, factors, first_spatial, chunk_size):
+    """
+    Keys of the slabs of an image of the given shape that are downsampled
+    independently, with the matching keys in the downsampled image.
+    Slabs hold a multiple of the factor of the first spatial axis.
+    """
+    leads = [(t,) for t in range(shape[0])] if first_spatial == 1 else [()]
+    axis = first_spatial
+    plane_size = int(np.prod(shape[axis + 1 :]))
+    step = max(1, chunk_size // max(plane_size * factors[axis], 1))
+    step *= factors[axis]
+    for lead in leads:
+        for i0 in range(0, shape[axis], step):
+            i1 = min(i0 + step, shape[axis])
+            source = lead + (slice(i0, i1),)
+            target = lead + (
+                slice(i0 // factors[axis], -(-i1 // factors[axis])),
+            )
+            yield source, target
+
+
+def n_steps(shape, min_size=None, chunk_size=None):
+    """Number of values yielded by `iter_pyramid`, for progress bars"""
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    shapes = pyramid_shapes(shape, min_size)
+    first_spatial = 1 if len(shape) == 4 else 0
+    return sum(
+        sum(
+            1
+            for _ in _slabs(
+                previous,
+                _factors(previous, first_spatial),
+                first_spatial,
+                chunk_size,
+            )
+        )
+        for previous in shapes[:-1]
+    )
+
+
+def iter_pyramid(
+    image, labels=False, min_size=None, chunk_size=None, max_workers=None
+):
+    """
+    Build the multiscale pyramid of an image, yielding after each slab and
+    returning the list of levels.
+
+    Parameters
+    ----------
+    image : array-like
+        np.ndarray, memmap, LazySequence or Zarr array. It is the first
+        level of the pyramid and is not copied.
+    labels : bool
+        Downsample with the most frequent label instead of the mean.
+    min_size : int, optional
+        Largest spatial size of the smallest level, MIN_SIZE by default.
+    chunk_size : int, optional
+        Number of voxels read at once from a level, CHUNK_SIZE by default.
+    max_workers : int, optional
+        Number of threads, the number of CPUs by default.
+
+    Returns
+    -------
+    levels : list of array-like
+        The image, then in-memory arrays of decreasing size.
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    downsample = downsample_mode if labels else downsample_mean
+    first_spatial = 1 if image.ndim == 4 else 0
+    levels = [image]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for shape in pyramid_shapes(image.shape, min_size)[1:]:
+            source = levels[-1]
+            factors = _factors(source.shape, first_spatial)
+            level = np.empty(shape, dtype=source.dtype)
+
+            def downsample_slab(keys):
+                source_key, target_key = keys
+                data = np.asarray(source[source_key])
+                # the time axis is indexed away
+                level[target_key] = downsample(data, factors[first_spatial:])
+
+            slabs = _slabs(source.shape, factors, first_spatial, chunk_size)
+            for _ in executor.map(downsample_slab, slabs):
+                yield
+            levels.append(level)
+    return levels
@@ -0,0 +1,746 @@
+"""
+Loading of 3D image sequences as 4D (t, z, y, x) arrays, and writing of
+4D arrays back to sequences.
+
+Every file format is a `SequenceReader` backend plugged into the same
+engine: parallel eager loading (`load_sequence`), lazy loading with a
+frame cache (`LazySequence`), streaming export frame by frame
+(`iter_write_sequence`) and a single axis-order handling path.
+
+Sequences can be converted once to a chunked, compressed Zarr (or N5)
+store (`iter_convert_to_zarr`). Zarr arrays are opened lazily
+(`open_zarr`), so that napari and the processing functions only read the
+chunks of the displayed slice or of the processed region. The zarr package
+is optional, it is only imported when a store is used.
+
+The functions in this module do not depend on napari or Qt so that they can
+be used from the widgets as well as from plain Python scripts.
+"""
+
+import glob
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+
+import numpy as np
+
+from image_manipulation_plugin.generators import exhaust
+from image_manipulation_plugin.label_dtypes import cast_labels
+
+
+def _read_into(output_array, index, file, read_frame):
+    """Decode `file` and write it directly into its slot of `output_array`"""
+    output_array[index] = read_frame(file)
+    return index
+
+
+def iter_load_sequence(
+    list_of_files, read_frame, first_image=None, max_workers=None
+):
+    """
+    Load a sequence of 3D images into one preallocated 4D array.
+
+    Frames are decoded concurrently on a thread pool and written straight
+    into the output array, which keeps the native dtype of the first frame.
+    This is a generator: it yields the index of every frame once it has
+    been loaded (so it can drive a progress bar) and returns the array.
+
+    Parameters
+    ----------
+    list_of_files : list of str
+        Files of the sequence, in temporal order.
+    read_frame : callable
+        Function that takes a file name and returns a 3D numpy array.
+    first_image : np.ndarray, optional
+        Already decoded first frame. It is used as timepoint 0 and defines
+        the shape and dtype of the output.
+    max_workers : int, optional
+        Number of reading threads, defaults to the ThreadPoolExecutor default.
+
+    Returns
+    -------
+    output_array : np.ndarray
+        Array of shape (len(list_of_files), *first_image.shape).
+    """
+    if first_image is None:
+        first_image = read_frame(list_of_files[0])
+    first_image = np.asarray(first_image)
+
+    # a single allocation in the native dtype, no float64 intermediate
+    output_array = np.empty(
+        (len(list_of_files),) + first_image.shape, dtype=first_image.dtype
+    )
+    output_array[0] = first_image
+    yield 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_read_into, output_array, i, file, read_frame)
+            for i, file in enumerate(list_of_files[1:], start=1)
+        ]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # do not keep decoding frames if we failed or were cancelled
+            for future in futures:
+                future.cancel()
+    return output_array
+
+
+def load_sequence(
+    list_of_files, read_frame, first_image=None, max_workers=None
+):
+    """
+    Blocking version of `iter_load_sequence`, returns the 4D array.
+    """
+    return exhaust(
+        iter_load_sequence(list_of_files, read_frame, first_image, max_workers)
+    )
+
+
+def _read_tif(file):
+    """
+    Read a TIF frame, memory-mapping it when the file layout allows it
+    (uncompressed, contiguous) and decoding it otherwise.
+    """
+    import tifffile
+
+    try:
+        return tifffile.memmap(file, mode="r")
+    except ValueError:
+        return tifffile.imread(file)
+
+
+def _read_medpy(file):
+    """Read any format supported by medpy.io (mha, nrrd, nifti, ...)"""
+    from medpy.io import load
+
+    image, header = load(file)
+    return image
+
+
+def _write_tif(frame, file, compress=False):
+    """Write a TIF frame, zlib-compressed if `compress`"""
+    import tifffile
+
+    # one grayscale page per z slice, even for volumes of 3 or 4 slices
+    tifffile.imwrite(
+        file,
+        frame,
+        photometric="minisblack",
+        compression="zlib" if compress else None,
+    )
+
+
+def _write_medpy(frame, file, compress=False):
+    """Write any format supported by medpy.io (mha, nrrd, nifti, ...)"""
+    from medpy.io import save
+
+    save(frame, file, use_compression=compress)
+
+
+class SequenceReader:
+    """
+    Format backend of the sequence engine.
+
+    A reader knows which file extensions it handles, how to decode one
+    frame (and possibly encode it) and in which axis order the decoded
+    frame comes. Calling it returns the frame in (z, y, x) order, so that
+    every format goes through the same loading, caching and axis handling
+    code.
+
+    Parameters
+    ----------
+    name : str
+        Name of the format, used to look the reader up.
+    extensions : tuple of str
+        Lower case file extensions handled by the reader.
+    read : callable
+        Function that takes a file name and returns a 3D numpy array.
+    axes : str
+        Axis order of the arrays returned by `read`, e.g. "xyz".
+    write : callable, optional
+        Function that takes a 3D numpy array in `axes` order, a file name
+        and whether to compress, and writes the file.
+    """
+
+    def __init__(self, name, extensions, read, axes="zyx", write=None):
+        if sorted(axes) != ["x", "y", "z"]:
+            raise ValueError(
+                f"axes must be a permutation of 'zyx', not {axes!r}"
+            )
+        self.name = name
+        self.extensions = tuple(extensions)
+        self.read = read
+        self.axes = axes
+        self.write = write
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r}, axes={self.axes!r})"
+
+    def matches(self, file):
+        return str(file).lower().endswith(self.extensions)
+
+    def __call__(self, file):
+        frame = self.read(file)
+        if self.axes == "zyx":
+            return frame
+        return np.transpose(frame, [self.axes.index(axis) for axis in "zyx"])
+
+    def write_frame(self, frame, file, compress=False):
+        """Write a (z, y, x) frame to `file`, in the axis order of the format"""
+        if self.write is None:
+            raise ValueError(f"Writing {self.name} files is not supported")
+        if self.axes != "zyx":
+            frame = np.transpose(
+                frame, ["zyx".index(axis) for axis in self.axes]
+            )
+        self.write(frame, file, compress)
+
+
+def raw_reader(shape, dtype, axes="zyx", offset=0, extensions=(".raw",)):
+    """
+    Create a reader for headerless raw files, which are memory-mapped.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of one frame, in the order given by `axes`.
+    dtype : np.dtype
+        Data type of the voxels (including byte order, e.g. ">u2").
+    axes : str
+        Axis order of the data on disk.
+    offset : int
+        Size of a header to skip, in bytes.
+    """
+
+    def read_raw(file):
+        return np.memmap(
+            file, dtype=dtype, mode="r", offset=offset, shape=tuple(shape)
+        )
+
+    return SequenceReader("raw", extensions, read_raw, axes=axes)
+
+
+# extensions of the directories of chunked stores
+ZARR_EXTENSIONS = (".zarr", ".n5")
+
+# chunks of converted stores: one timepoint, and blocks of slices small
+# enough that browsing or editing a region reads little more than it
+ZARR_CHUNKS = (1, 16, 256, 256)
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError(
+            "Zarr and N5 stores require the zarr package"
+        ) from None
+    return zarr
+
+
+def _zarr_store(path):
+    """Store of a .zarr or .n5 path (N5 needs zarr.N5Store, zarr 2)"""
+    zarr = _import_zarr()
+    if str(path).lower().endswith(".n5"):
+        if not hasattr(zarr, "N5Store"):
+            raise ImportError(
+                "N5 stores require a zarr version providing zarr.N5Store"
+            )
+        return zarr.N5Store(str(path))
+    return str(path)
+
+
+def zarr_chunks(shape):
+    """Chunks of a converted store of the given shape, see ZARR_CHUNKS"""
+    chunks = ZARR_CHUNKS[-len(shape) :]
+    return tuple(min(c, n) for c, n in zip(chunks, shape))
+
+
+def find_zarr_store(path):
+    """
+    Root of the Zarr or N5 store containing `path` (e.g. a file selected
+    inside the store directory), None if `path` is not in a store
+    """
+    path = os.path.normpath(str(path))
+    while True:
+        if path.lower().endswith(ZARR_EXTENSIONS):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def open_zarr(path, mode="r"):
+    """
+    Open the Zarr or N5 store containing `path` without reading it. With
+    mode "r+", the regions assigned to the arrays are written to the
+    store, e.g. to edit labels in place chunk by chunk.
+
+    Returns
+    -------
+    data : zarr.Array or list of zarr.Array
+        The array of the store, or the levels of a multiscale store (a
+        group of arrays named 0, 1, ... from the full resolution down).
+    """
+    zarr = _import_zarr()
+    root = find_zarr_store(path) or str(path)
+    node = zarr.open(_zarr_store(root), mode=mode)
+    if not hasattr(node, "array_keys"):
+        return node
+    keys = sorted((key for key in node.array_keys() if key.isdigit()), key=int)
+    if not keys:
+        raise ValueError(f"{root} does not contain arrays named 0, 1, ...")
+    if len(keys) == 1:
+        return node[keys[0]]
+    return [node[key] for key in keys]
+
+
+# medpy returns images in (x, y, z) order
+READERS = {
+    "tif": SequenceReader(
+        "tif", (".tif", ".tiff"), _read_tif, write=_write_tif
+    ),
+    "mha": SequenceReader(
+        "mha", (".mha", ".mhd"), _read_medpy, axes="xyz", write=_write_medpy
+    ),
+    "nrrd": SequenceReader(
+        "nrrd", (".nrrd", ".nhdr"), _read_medpy, axes="xyz", write=_write_medpy
+    ),
+    "nifti": SequenceReader(
+        "nifti",
+        (".nii", ".nii.gz"),
+        _read_medpy,
+        axes="xyz",
+        write=_write_medpy,
+    ),
+}
+
+
+def get_reader(reader):
+    """
+    Return a SequenceReader from a reader, a format name or a file name
+    """
+    if isinstance(reader, SequenceReader):
+        return reader
+    if reader in READERS:
+        return READERS[reader]
+    for candidate in READERS.values():
+        if candidate.matches(reader):
+            return candidate
+    raise ValueError(f"No sequence reader for {reader!r}")
+
+
+def find_sequence_files(path, regex="", reader=None):
+    """
+    List the files of the sequence starting with the image at `path`.
+
+    Parameters
+    ----------
+    path : str
+        Path to the first image of the sequence.
+    regex : str, optional
+        Glob pattern of the sequence files, relative to the folder of
+        `path`. By default all files of the same format are used.
+    reader : SequenceReader or str, optional
+        Format of the sequence, deduced from `path` by default.
+
+    Returns
+    -------
+    list_of_files : list of str
+        Sorted files of the sequence. Files sorting before `path` are left out.
+
+    Raises
+    ------
+    ValueError
+        If `path` or one of the selected files is not of the reader's format.
+    """
+    reader = get_reader(path if reader is None else reader)
+    path = os.path.normpath(str(path))
+    if not reader.matches(path):
+        raise ValueError(f"{path} is not a {reader.name} file")
+    folder = os.path.dirname(path)
+    if regex:
+        list_of_files = glob.glob(os.path.join(folder, regex))
+    else:
+        list_of_files = [
+            file
+            for file in glob.glob(os.path.join(folder, "*"))
+            if reader.matches(file)
+        ]
+    list_of_files = sorted(os.path.normpath(file) for file in list_of_files)
+    if path in list_of_files:
+        list_of_files = list_of_files[list_of_files.index(path) :]
+    else:
+        list_of_files.insert(0, path)
+    for file in list_of_files:
+        if not reader.matches(file):
+            raise ValueError(f"{file} is not a {reader.name} file")
+    return list_of_files
+
+
+def open_sequence(
+    path,
+    regex="",
+    reader=None,
+    lazy=False,
+    dtype=None,
+    max_workers=None,
+    cache_size=8,
+):
+    """
+    Open a sequence of 3D images as a 4D (t, z, y, x) array.
+
+    This is the headless entry point of the sequence engine, used by the
+    opener widgets and usable from scripts and batch jobs.
+
+    Parameters
+    ----------
+    path : str
+        Path to the first image of the sequence.
+    regex : str, optional
+        Glob pattern of the sequence files, see `find_sequence_files`.
+    reader : SequenceReader or str, optional
+        Format backend, deduced from the extension of `path` by default.
+    lazy : bool
+        If True return a LazySequence that reads frames on demand,
+        otherwise load all frames in parallel into one array.
+    dtype : np.dtype, optional
+        Output dtype, the native dtype of the files by default.
+    max_workers : int, optional
+        Number of reading threads for the eager loading.
+    cache_size : int
+        Number of frames cached by a LazySequence.
+
+    Returns
+    -------
+    movie : np.ndarray or LazySequence
+    """
+    reader = get_reader(path if reader is None else reader)
+    list_of_files = find_sequence_files(path, regex, reader)
+    first_image = reader(list_of_files[0])
+    if lazy:
+        return LazySequence(
+            list_of_files,
+            reader,
+            first_image=first_image,
+            dtype=dtype,
+            cache_size=cache_size,
+        )
+    output_array = load_sequence(
+        list_of_files, reader, first_image, max_workers
+    )
+    if dtype is not None:
+        output_array = output_array.astype(dtype, copy=False)
+    return output_array
+
+
+def sequence_file_names(folder, prefix, n_frames, reader="tif"):
+    """
+    Files of a sequence of `n_frames` frames written to `folder`, numbered
+    with zero-padded indices so that `find_sequence_files` lists them in
+    temporal order (e.g. labels_t000.tif, labels_t001.tif, ...)
+    """
+    reader = get_reader(reader)
+    digits = max(3, len(str(n_frames - 1)))
+    return [
+        os.path.join(folder, f"{prefix}{t:0{digits}d}{reader.extensions[0]}")
+        for t in range(n_frames)
+    ]
+
+
+def iter_write_sequence(
+    image, folder, prefix="t", reader="tif", compress=False, max_workers=None
+):
+    """
+    Write a 4D (t, z, y, x) image as a sequence of 3D files that the
+    openers read back, one frame per thread.
+
+    Frames are read from `image` when their thread starts, so at most one
+    frame per thread is in memory: lazy, memory-mapped or Zarr movies are
+    streamed to disk without being loaded. The compression runs in the
+    threads too. This is a generator: it yields the index of every frame
+    once it has been written and returns the list of files.
+
+    Parameters
+    ----------
+    image : array-like
+        4D image (a 3D image is written as a single frame).
+    folder : str
+        Output folder, created if needed. Other files of the same format
+        in it would be opened as part of the sequence.
+    prefix : str
+        Start of the file names, followed by the frame index.
+    reader : SequenceReader or str
+        Format of the files, e.g. "tif" or "mha".
+    compress : bool
+        Compress the files (zlib for TIF), which is slower.
+    max_workers : int, optional
+        Number of writing threads, the number of CPUs by default.
+
+    Returns
+    -------
+    list_of_files : list of str
+    """
+    reader = get_reader(reader)
+    if reader.write is None:
+        raise ValueError(f"Writing {reader.name} files is not supported")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    n_frames = image.shape[0] if image.ndim == 4 else 1
+    os.makedirs(folder, exist_ok=True)
+    list_of_files = sequence_file_names(folder, prefix, n_frames, reader)
+
+    def write(t):
+        frame = image[t] if image.ndim == 4 else image
+        reader.write_frame(np.asarray(frame), list_of_files[t], compress)
+        return t
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # map only reads a frame when its task starts
+        for t in executor.map(write, range(n_frames)):
+            yield t
+    return list_of_files
+
+
+def iter_write_zarr(image, path, chunk_size=None, max_workers=None):
+    """
+    Copy an image to a chunked, compressed Zarr array at `path`, block by
+    block in parallel threads (see thresholding.create_output for the
+    chunks), yielding after each block and returning the Zarr array.
+    """
+    from image_manipulation_plugin.thresholding import (
+        create_output,
+        iter_blocks,
+    )
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    out = create_output(image.shape, path, image.dtype, chunk_size)
+
+    def copy(block):
+        out[block] = np.asarray(image[block])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in executor.map(copy, iter_blocks(image.shape, chunk_size)):
+            yield
+    return out
+
+
+def iter_convert_to_zarr(
+    path,
+    output,
+    regex="",
+    reader=None,
+    chunks=None,
+    dtype=None,
+    max_workers=None,
+    overwrite=False,
+):
+    """
+    Convert a sequence of 3D images into a chunked, compressed Zarr (or N5)
+    array, one frame per thread.
+
+    Every frame is decoded once, when its thread starts, and written to
+    chunks of its own, so that threads never write to the same chunk and
+    at most one frame per thread is in memory. This is a generator: it
+    yields the index of every converted frame and returns the array.
+
+    Parameters
+    ----------
+    path : str
+        Path to the first image of the sequence.
+    output : str
+        Path of the store, ending with .zarr or .n5.
+    regex : str, optional
+        Glob pattern of the sequence files, see `find_sequence_files`.
+    reader : SequenceReader or str, optional
+        Format of the sequence, deduced from the extension of `path` by
+        default.
+    chunks : tuple of int, optional
+        Chunks of the array, see `zarr_chunks` for the default.
+    dtype : np.dtype, optional
+        dtype of the array, the native dtype of the files by default. A
+        ValueError is raised if the IDs of a frame do not fit in it.
+    max_workers : int, optional
+        Number of threads, the number of CPUs by default.
+    overwrite : bool
+        Replace an existing store at `output`.
+
+    Returns
+    -------
+    movie : zarr.Array
+        4D (t, z, y, x) array.
+
+    Raises
+    ------
+    FileExistsError
+        If `output` exists and `overwrite` is False.
+    """
+    if os.path.exists(output) and not overwrite:
+        raise FileExistsError(f"{output} already exists")
+    zarr = _import_zarr()
+    reader = get_reader(path if reader is None else reader)
+    list_of_files = find_sequence_files(path, regex, reader)
+    first_image = np.asarray(reader(list_of_files[0]))
+    shape = (len(list_of_files),) + first_image.shape
+    if chunks is None:
+        chunks = zarr_chunks(shape)
+    if chunks[0] != 1:
+        raise ValueError("Chunks must hold a single timepoint")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    movie = zarr.open_array(
+        _zarr_store(output),
+        mode="w",
+        shape=shape,
+        chunks=chunks,
+        dtype=dtype or first_image.dtype,
+    )
+
+    def convert(t):
+        frame = first_image if t == 0 else reader(list_of_files[t])
+        movie[t] = cast_labels(frame, movie.dtype)
+        return t
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for t in executor.map(convert, range(len(list_of_files))):
+            yield t
+    return movie
+
+
+def convert_to_zarr(path, output, **kwargs):
+    """
+    Blocking version of `iter_convert_to_zarr`, returns the Zarr array
+    """
+    return exhaust(iter_convert_to_zarr(path, output, **kwargs))
+
+
+class LazySequence:
+    """
+    Array-like 4D (t, z, y, x) view on a sequence of 3D image files.
+
+    Nothing but the first frame is read at creation. Every other timepoint
+    is read when it is indexed, e.g. when napari slices into the layer,
+    and the most recently used frames are kept in a bounded LRU cache.
+
+    Parameters
+    ----------
+    list_of_files : list of str
+        Files of the sequence, in temporal order.
+    read_frame : callable
+        Function that takes a file name and returns a 3D numpy array.
+    first_image : np.ndarray, optional
+        Already decoded first frame, defines the frame shape and dtype.
+    dtype : np.dtype, optional
+        Cast frames to this dtype when they are read, reading a frame
+        raises a ValueError if its IDs do not fit in an integer dtype.
+    cache_size : int
+        Maximum number of frames kept in memory.
+    """
+
+    def __init__(
+        self,
+        list_of_files,
+        read_frame,
+        first_image=None,
+        dtype=None,
+        cache_size=8,
+    ):
+        self.list_of_files = list(list_of_files)
+        self.read_frame = read_frame
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+        if first_image is None:
+            first_image = read_frame(self.list_of_files[0])
+        first_image = np.asarray(first_image)
+        self.dtype = np.dtype(dtype or first_image.dtype)
+        self.shape = (len(self.list_of_files),) + first_image.shape
+        self._store(0, first_image)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def frame_shape(self):
+        return self.shape[1:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return (
+            f"{type(self).__name__}(shape={self.shape}, dtype={self.dtype}, "
+            f"cached_frames={len(self._cache)})"
+        )
+
+    def _store(self, t, frame):
+        frame = np.asarray(frame)
+        if frame.shape != self.frame_shape:
+            raise ValueError(
+                f"Frame {t} ({self.list_of_files[t]}) has shape "
+                f"{frame.shape}, expected {self.frame_shape}"
+            )
+        # IDs that do not fit in the dtype raise instead of wrapping
+        frame = cast_labels(frame, self.dtype)
+        with self._lock:
+            self._cache[t] = frame
+            self._cache.move_to_end(t)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return frame
+
+    def get_frame(self, t):
+        """Return timepoint `t` as a 3D array, reading it if not cached"""
+        t = range(len(self))[t]
+        with self._lock:
+            if t in self._cache:
+                self._cache.move_to_end(t)
+                return self._cache[t]
+        # decode outside the lock so other timepoints can be served meanwhile
+        return self._store(t, self.read_frame(self.list_of_files[t]))
+
+    def _normalize_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            idx = [k is Ellipsis for k in key].index(True)
+            n_missing = self.ndim - len(key) + 1
+            key = key[:idx] + (slice(None),) * n_missing + key[idx + 1 :]
+        if len(key) == 0:
+            key = (slice(None),)
+        return key[0], key[1:]
+
+    def __getitem__(self, key):
+        t_key, frame_key = self._normalize_key(key)
+        if isinstance(t_key, (int, np.integer)) or (
+            isinstance(t_key, np.ndarray) and t_key.ndim == 0
+        ):
+            return self.get_frame(int(t_key))[frame_key]
+
+        timepoints = np.arange(len(self))[t_key]
+        if len(timepoints) == 0:
+            empty_frame = np.broadcast_to(
+                np.zeros((), dtype=self.dtype), self.frame_shape
+            )
+            return np.empty(
+                (0,) + empty_frame[frame_key].shape, dtype=self.dtype
+            )
+        return np.stack([self.get_frame(t)[frame_key] for t in timepoints])
+
+    def __array__(self, dtype=None, copy=None):
+        output_array = self[:]
+        if dtype is not None:
+            output_array = output_array.astype(dtype, copy=False)
+        return output_array
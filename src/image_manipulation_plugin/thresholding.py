@@ -0,0 +1,238 @@
+"""
+Thresholding of images larger than memory.
+
+The image is compared to the threshold block by block in a pool of
+threads (numpy releases the GIL during the comparison) and the result is
+written into a compact uint8 labels image, which can be a memory-mapped
+.npy file or a Zarr array instead of an in-memory array. Only a few
+blocks are in flight at any time, which bounds the temporaries.
+The timepoints of a movie can also be thresholded independently, each
+frame being read once by one thread. The functions do not depend on
+napari or Qt.
+"""
+
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from image_manipulation_plugin.generators import exhaust
+
+# number of voxels thresholded at once by one thread
+CHUNK_SIZE = 2**24
+
+
+def iter_blocks(shape, chunk_size=None):
+    """
+    Split an array of the given shape into blocks of at most `chunk_size`
+    voxels (or a single row), along its first axes.
+
+    Yields
+    ------
+    block : tuple of int and slices
+        Key of the block, e.g. `image[block]`.
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    if len(shape) == 0:
+        yield ()
+        return
+    # first axis along which blocks of whole trailing planes fit
+    axis = 0
+    while axis < len(shape) - 1 and np.prod(shape[axis + 1 :]) > chunk_size:
+        axis += 1
+    plane_size = int(np.prod(shape[axis + 1 :]))
+    step = max(1, chunk_size // max(plane_size, 1))
+    for lead in np.ndindex(*shape[:axis]):
+        for i0 in range(0, shape[axis], step):
+            yield lead + (slice(i0, min(i0 + step, shape[axis])),)
+
+
+def n_blocks(shape, chunk_size=None):
+    """Number of blocks yielded by `iter_blocks`, for progress bars"""
+    return sum(1 for _ in iter_blocks(shape, chunk_size))
+
+
+def block_chunks(shape, chunk_size=None):
+    """
+    Zarr chunks of the blocks of `iter_blocks`, so that the threads
+    writing different blocks never write to the same chunk
+    """
+    block = next(iter_blocks(shape, chunk_size))
+    chunks = [1] * len(block) + list(shape[len(block) :])
+    chunks[len(block) - 1] = block[-1].stop - block[-1].start
+    return tuple(chunks)
+
+
+def frame_chunks(shape, chunk_size=None):
+    """
+    Zarr chunks of a 4D image never spanning two timepoints, for outputs
+    written one frame per thread (see `iter_threshold_frames`)
+    """
+    return (1,) + block_chunks(shape[1:], chunk_size)
+
+
+def create_output(
+    shape, path=None, dtype=np.uint8, chunk_size=None, chunks=None
+):
+    """
+    Create the output labels image of a thresholding.
+
+    Parameters
+    ----------
+    shape : tuple of int
+    path : str, optional
+        In memory by default. A path ending with ".npy" creates a
+        memory-mapped file, one ending with ".zarr" a Zarr array (the zarr
+        package must then be installed).
+    dtype : np.dtype
+    chunk_size : int, optional
+        Size of the thresholded blocks, used as Zarr chunks.
+    chunks : tuple of int, optional
+        Zarr chunks, the blocks of `iter_blocks` by default. Writers must
+        never write parts of the same chunk from two threads: Zarr writes
+        a partial chunk by reading and rewriting it whole.
+
+    Returns
+    -------
+    out : np.ndarray, np.memmap or zarr.Array
+    """
+    if path is None:
+        return np.zeros(shape, dtype=dtype)
+    path = str(path)
+    if path.endswith(".npy"):
+        return np.lib.format.open_memmap(
+            path, mode="w+", dtype=dtype, shape=tuple(shape)
+        )
+    if path.endswith(".zarr"):
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError(
+                "Writing to a .zarr store requires the zarr package"
+            ) from None
+        if chunks is None:
+            chunks = block_chunks(shape, chunk_size)
+        return zarr.open_array(
+            path, mode="w", shape=tuple(shape), chunks=chunks, dtype=dtype
+        )
+    raise ValueError(f"Unknown output format (.npy or .zarr): {path}")
+
+
+def iter_threshold(
+    image,
+    threshold,
+    below=False,
+    out=None,
+    chunk_size=None,
+    max_workers=None,
+):
+    """
+    Threshold an image block by block in parallel threads, yielding after
+    each block (e.g. for progress) and returning the output.
+
+    Parameters
+    ----------
+    image : array-like
+        Intensity image (np.ndarray, memmap, LazySequence or Zarr array).
+    threshold : float
+    below : bool
+        Select the voxels below the threshold instead of above it (e.g.
+        for electron microscopy).
+    out : array-like, optional
+        Output labels image of the same shape (see `create_output`), a new
+        uint8 array by default.
+    chunk_size : int, optional
+        Number of voxels of each block, CHUNK_SIZE by default.
+    max_workers : int, optional
+        Number of threads, the number of CPUs by default.
+    """
+    if out is None:
+        out = create_output(image.shape)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    compare = np.less if below else np.greater
+
+    def threshold_block(block):
+        out[block] = compare(np.asarray(image[block]), threshold)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for block in iter_blocks(image.shape, chunk_size):
+            pending.add(executor.submit(threshold_block, block))
+            # a couple of blocks per thread in flight bounds the memory
+            while len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    yield
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+                yield
+    return out
+
+
+def threshold_image(image, threshold, below=False, out=None, **kwargs):
+    """
+    Threshold an image block by block in parallel threads, see
+    `iter_threshold` for the parameters.
+
+    Returns
+    -------
+    out : array-like
+        uint8 labels image, 1 where the voxels pass the threshold.
+    """
+    return exhaust(iter_threshold(image, threshold, below, out, **kwargs))
+
+
+def iter_threshold_frames(
+    image, threshold, below=False, out=None, max_workers=None
+):
+    """
+    Threshold every timepoint of a 4D image with its own threshold, one
+    frame per thread, yielding after each frame and returning the
+    thresholds and the output. Each frame is read once and only one frame
+    per thread is in memory at a time.
+
+    Parameters
+    ----------
+    image : array-like
+        4D intensity image (np.ndarray, memmap, LazySequence or Zarr array).
+    threshold : callable
+        Threshold of a frame, `threshold(frame)` is called in the threads
+        with the frame loaded as an np.ndarray.
+    below : bool
+        Select the voxels below the thresholds instead of above them.
+    out : array-like, optional
+        Output labels image of the same shape (see `create_output`), a new
+        uint8 array by default. A Zarr array must have chunks never
+        spanning two timepoints, see `frame_chunks`.
+    max_workers : int, optional
+        Number of threads, the number of CPUs by default.
+
+    Returns
+    -------
+    thresholds : np.ndarray
+        Threshold of every timepoint.
+    out : array-like
+    """
+    if out is None:
+        out = create_output(image.shape)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    compare = np.less if below else np.greater
+    thresholds = np.zeros(image.shape[0])
+
+    def threshold_frame(t):
+        frame = np.asarray(image[t])
+        thresholds[t] = threshold(frame)
+        out[t] = compare(frame, thresholds[t])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # frames are read when their task starts, so map does not load
+        # more than one frame per thread
+        for _ in executor.map(threshold_frame, range(image.shape[0])):
+            yield
+    return thresholds, out
@@ -1,5 +1,9 @@
 from qtpy.QtWidgets import QMessageBox
 import numpy as np
+# shared with the caches of the layers, which do not depend on Qt
+from image_manipulation_plugin.pyramids import (
+    full_resolution as _get_full_resolution,
+)
 
 def error_image_selection():
     """
@@ -0,0 +1,127 @@
+"""
+Background execution of the widget actions.
+
+Computations run in napari thread workers so that the viewer stays
+responsive, and their results are passed back to the widget in the GUI
+thread, where layers can be added or refreshed. Generator functions
+report their progress with each `yield` and can be cancelled between two
+yields; the result of a cancelled plain function is discarded.
+"""
+
+from napari.qt.threading import thread_worker
+from qtpy.QtWidgets import QPushButton
+
+from image_manipulation_plugin.profiling import profiled
+
+
+class BackgroundTasks:
+    """
+    Runs the computations of one widget in a background thread, one at a
+    time, with a progress bar in the napari activity dock and a cancel
+    button to add to the widget.
+
+    Parameters
+    ----------
+    message : magicgui.widgets.Label
+        Label of the widget showing the state of the task and its errors.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.worker = None
+
+        self.btn_cancel = QPushButton("Cancel")
+        self.btn_cancel.native = self.btn_cancel
+        self.btn_cancel.name = "Cancel"
+        self.btn_cancel.clicked.connect(self.cancel)
+        self.btn_cancel.setEnabled(False)
+
+    @property
+    def busy(self):
+        return self.worker is not None
+
+    def start(
+        self,
+        function,
+        *args,
+        returned=None,
+        aborted=None,
+        desc=None,
+        total=0,
+        **kwargs,
+    ):
+        """
+        Run `function(*args, **kwargs)` in a background thread.
+
+        Parameters
+        ----------
+        function : callable
+            Function or generator function, which must not touch Qt.
+        returned : callable, optional
+            Called with the result, in the GUI thread. It may start the
+            next task of the widget.
+        aborted : callable, optional
+            Called in the GUI thread if the task was cancelled.
+        desc : str, optional
+            Description shown in the progress bar and in the message.
+        total : int
+            Number of values yielded by a generator function (0 if
+            unknown), to report the progress.
+
+        Returns
+        -------
+        worker : napari worker or None
+            None if another task of the widget is still running.
+
+        Notes
+        -----
+        The task is recorded by the profiler (profiling.py) when it is
+        enabled.
+        """
+        if self.busy:
+            self.message.value = (
+                "Please wait for the current task to finish (or cancel it)."
+            )
+            return None
+        # errors are reported in the message of the widget instead of
+        # being raised again in the GUI thread
+        worker = thread_worker(
+            profiled(function),
+            progress={"total": total, "desc": desc or "Processing"},
+            ignore_errors=True,
+        )(*args, **kwargs)
+        worker.returned.connect(
+            lambda result: self._on_returned(worker, returned, result)
+        )
+        worker.errored.connect(self._on_errored)
+        worker.finished.connect(lambda: self._on_finished(worker, aborted))
+        self.worker = worker
+        self.btn_cancel.setEnabled(True)
+        if desc:
+            self.message.value = f"{desc}..."
+        worker.start()
+        return worker
+
+    def cancel(self):
+        if self.worker is not None:
+            self.worker.quit()
+
+    def _release(self, worker):
+        if worker is self.worker:
+            self.worker = None
+            self.btn_cancel.setEnabled(False)
+
+    def _on_returned(self, worker, returned, result):
+        self._release(worker)
+        if returned is not None:
+            returned(result)
+
+    def _on_errored(self, error):
+        self.message.value = f"An error occurred:\n{error}"
+
+    def _on_finished(self, worker, aborted):
+        self._release(worker)
+        if worker.abort_requested:
+            self.message.value = "Cancelled."
+            if aborted is not None:
+                aborted()